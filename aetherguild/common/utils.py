@@ -3,6 +3,24 @@
 import os
 import binascii
 
+from aetherguild import config
+
 
 def generate_random_key():
     return binascii.hexlify(os.urandom(16))
+
+
+def format_datetime(value):
+    """ Formats a datetime as an ISO 8601 string, like arrow.get(value).isoformat() but without building an Arrow
+    object. Naive datetimes (eg. from SQLite) are taken to be in UTC.
+    """
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.isoformat() + '+00:00'
+    return value.isoformat()
+
+
+def get_node_queue(node_id):
+    """ Returns the name of the queue that a socket service node receives its messages from """
+    return u'{}/{}'.format(config.MQ_FROM_LISTENER, node_id)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from sqlalchemy import text, bindparam
+
+from aetherguild.listener_service.tables import User, Session, utc_now
+
+log = logging.getLogger(__name__)
+
+# Maximum amount of rows to update with a single statement
+BATCH_SIZE = 500
+
+
+def _bulk_update(db, table, column, values):
+    """ Sets column to the given timestamps for a batch of row IDs
+
+    On PostgreSQL, this uses a single UPDATE ... FROM (VALUES ...) statement per batch. Other databases get an
+    executemany UPDATE instead.
+    """
+    items = list(values.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        batch = items[start:start + BATCH_SIZE]
+        if db.bind.dialect.name == 'postgresql':
+            params = {}
+            rows = []
+            for n, (row_id, timestamp) in enumerate(batch):
+                rows.append('(:id{0}, :ts{0})'.format(n))
+                params['id{}'.format(n)] = row_id
+                params['ts{}'.format(n)] = timestamp
+            db.execute(text(
+                'UPDATE {table} SET {column} = v.ts '
+                '  FROM (VALUES {rows}) AS v(id, ts) '
+                ' WHERE {table}.id = v.id'.format(table=table.name, column=column, rows=', '.join(rows))), params)
+        else:
+            db.execute(
+                table.update().where(table.c.id == bindparam('row_id')).values({column: bindparam('timestamp')}),
+                [{'row_id': row_id, 'timestamp': timestamp} for row_id, timestamp in batch])
+
+
+class ActivityTracker(object):
+    """ Collects session and user activity timestamps, and writes them to the database in the background
+
+    Instead of updating Session.activity_at and User.last_contact for every handled message, the latest timestamp
+    for every session and user is kept in memory and flushed to the database every interval seconds. This means the
+    timestamps in the database may lag behind by at most interval seconds. Remember to call stop() on shutdown, so
+    that the last timestamps get written.
+    """
+    def __init__(self, db_connection, interval=30):
+        self.db_connection = db_connection
+        self.interval = interval
+        self.sessions = {}
+        self.users = {}
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def touch(self, session_id, user_id):
+        now = utc_now()
+        with self.lock:
+            if session_id is not None:
+                self.sessions[session_id] = now
+            if user_id is not None:
+                self.users[user_id] = now
+
+    def flush(self):
+        with self.lock:
+            sessions, self.sessions = self.sessions, {}
+            users, self.users = self.users, {}
+        if not sessions and not users:
+            return
+
+        db = self.db_connection.get_session()
+        try:
+            _bulk_update(db, Session.__table__, 'activity_at', sessions)
+            _bulk_update(db, User.__table__, 'last_contact', users)
+            db.commit()
+            log.info(u"Activity: Flushed %d sessions and %d users", len(sessions), len(users))
+        except Exception as e:
+            db.rollback()
+            log.error(u"Activity: Unable to flush activity timestamps", exc_info=e)
+
+            # Put the timestamps back for the next attempt, unless there are newer ones already
+            with self.lock:
+                for key, value in sessions.items():
+                    self.sessions.setdefault(key, value)
+                for key, value in users.items():
+                    self.users.setdefault(key, value)
+        finally:
+            db.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='activity-tracker', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops the background thread and writes out everything that is still pending """
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.flush()
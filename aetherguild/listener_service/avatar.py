@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import io
+import logging
+import os
+import tempfile
+
+import requests
+from PIL import Image
+from sqlalchemy.exc import IntegrityError
+
+from aetherguild.listener_service.tables import User, File
+from aetherguild.listener_service.mq_session import MQSession
+from aetherguild.listener_service.handlers.basehandler import BaseHandler, ErrorList
+from aetherguild import config
+
+log = logging.getLogger(__name__)
+
+# Accepted image types by file signature
+IMAGE_MAGIC = {
+    b'\xff\xd8\xff': 'JPEG',
+    b'\x89PNG\r\n\x1a\n': 'PNG',
+    b'GIF87a': 'GIF',
+    b'GIF89a': 'GIF',
+}
+MAGIC_SIZE = max(len(magic) for magic in IMAGE_MAGIC)
+
+# Image headers are checked while streaming for at most this many bytes from the beginning of the file. JPEG headers
+# may be behind more metadata than this (EXIF thumbnails, ICC profiles), and are then checked once the download is done.
+SNIFF_MAX_SIZE = 64 * 1024
+CHUNK_SIZE = 8 * 1024
+
+# Make Pillow refuse to decode anything larger than an avatar may be, whatever the header claimed
+Image.MAX_IMAGE_PIXELS = config.AVATAR_REQUIREMENTS['max_input_pixels']
+
+
+class AvatarError(Exception):
+    """ Avatar could not be fetched or processed. The message is safe to show to the user. """
+    def __init__(self, message):
+        super(AvatarError, self).__init__(message)
+        self.message = message
+
+
+def check_image_size(width, height):
+    """ Makes sure somebody is not size/decompression bombing us """
+    max_width = config.AVATAR_REQUIREMENTS['max_input_width']
+    max_height = config.AVATAR_REQUIREMENTS['max_input_height']
+    if width >= max_width or height >= max_height or width * height > config.AVATAR_REQUIREMENTS['max_input_pixels']:
+        raise AvatarError(u"Image is too large; Maximum size is {}x{}".format(max_width, max_height))
+
+
+def sniff_image(header, complete=False):
+    """ Identifies an image from the beginning of the file, and checks that it is acceptable as an avatar
+    :param header: Data received so far
+    :param complete: True if header is the whole file
+    :return: Image format, or None if more data is needed
+    """
+    if len(header) < MAGIC_SIZE and not complete:
+        return None
+    if not any(header.startswith(magic) for magic in IMAGE_MAGIC):
+        raise AvatarError(u"Given URL does not contain a supported imagefile (JPEG, PNG or GIF)")
+
+    # Image.open only parses the header. For JPEG, the header may be behind a lot of metadata.
+    try:
+        img = Image.open(io.BytesIO(header))
+    except Image.DecompressionBombError:
+        raise AvatarError(u"Image is too large; Maximum size is {}x{}".format(
+            config.AVATAR_REQUIREMENTS['max_input_width'], config.AVATAR_REQUIREMENTS['max_input_height']))
+    except IOError:
+        if complete:
+            raise AvatarError(u"Given URL does not contain a valid imagefile")
+        return None
+    if img.format not in IMAGE_MAGIC.values():
+        raise AvatarError(u"Given URL does not contain a supported imagefile (JPEG, PNG or GIF)")
+    check_image_size(img.width, img.height)
+    return img.format
+
+
+def download_image(url, out):
+    """ Downloads an image and checks that it is acceptable as an avatar
+    :param url: Image URL
+    :param out: File object to write the image to
+    :return: Tuple of image format and SHA-256 hex digest of the content
+    """
+    try:
+        r = requests.get(url, stream=True, timeout=config.AVATAR_REQUIREMENTS['connection_timeout'])
+    except requests.exceptions.ConnectionError as ex:
+        log.exception(u"Unable to fetch the image: Unable to connect to host", exc_info=ex)
+        raise AvatarError(u"Unable to fetch the image: Unable to connect to host")
+    except requests.exceptions.Timeout as ex:
+        log.exception(u"Unable to fetch the image: Connection timeout", exc_info=ex)
+        raise AvatarError(u"Unable to fetch the image: Connection timeout")
+    except (requests.exceptions.URLRequired,
+            requests.exceptions.MissingSchema,
+            requests.exceptions.InvalidSchema,
+            requests.exceptions.InvalidURL) as ex:
+        log.exception(u"Unable to fetch the image: Invalid URL", exc_info=ex)
+        raise AvatarError(u"Unable to fetch the image: Invalid URL")
+    except requests.exceptions.RequestException as ex:
+        log.exception(u"Unable to fetch the image", exc_info=ex)
+        raise AvatarError(u"Unable to fetch the image")
+
+    # Don't even start if the server tells us the file is too large
+    max_size = config.AVATAR_REQUIREMENTS['max_size']
+    if int(r.headers.get('content-length') or 0) > max_size:
+        r.close()
+        raise AvatarError(u"Unable to fetch the image: File size exceeds 5 megabytes")
+
+    # Fetch the image content. The image header is checked as soon as it has arrived, so that unsupported and
+    # oversized images are refused without downloading the rest of them.
+    done_size = 0
+    header = b''
+    image_format = None
+    content_hash = hashlib.sha256()
+    try:
+        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+            if not chunk:
+                continue
+            done_size += len(chunk)
+            if done_size > max_size:
+                log.warning(u"Unable to fetch the image: File size exceeds 5 megabytes")
+                raise AvatarError(u"Unable to fetch the image: File size exceeds 5 megabytes")
+            out.write(chunk)
+            content_hash.update(chunk)
+            if not image_format and len(header) < SNIFF_MAX_SIZE:
+                header += chunk
+                image_format = sniff_image(header)
+        if not image_format:
+            out.seek(0)
+            image_format = sniff_image(out.read(), complete=True)
+    finally:
+        r.close()
+    return image_format, content_hash.hexdigest()
+
+
+def decode_image(source, image_format):
+    """ Decodes a downloaded image, scaling it down to the avatar size
+    :param source: File object containing the image
+    :param image_format: Image format detected while downloading
+    :return: Loaded PIL image
+    """
+    # Open up the image. This only reads the header again; nothing is decoded yet.
+    source.seek(0)
+    try:
+        img = Image.open(source)
+    except IOError as ex:
+        log.exception(u"Given URL does not contain a valid imagefile", exc_info=ex)
+        raise AvatarError(u"Given URL does not contain a valid imagefile")
+    if img.format != image_format:
+        raise AvatarError(u"Given URL does not contain a valid imagefile")
+
+    # Thumbnail it. For JPEG, draft() makes the decoder scale the image down while decoding, which is a lot
+    # cheaper than decoding it at full size first. Thumbnailing loads the image, so the source file can be closed
+    # after this.
+    max_output_size = [
+        config.AVATAR_REQUIREMENTS['max_output_width'],
+        config.AVATAR_REQUIREMENTS['max_output_height']
+    ]
+    try:
+        if img.width >= max_output_size[0] or img.height >= max_output_size[1]:
+            img.draft(None, max_output_size)
+            img.thumbnail(max_output_size)
+        else:
+            img.load()
+    except (IOError, SyntaxError) as ex:
+        log.exception(u"Unable to decode the image", exc_info=ex)
+        raise AvatarError(u"Given URL does not contain a valid imagefile")
+    return img
+
+
+def save_image(img, filename, image_format):
+    """ Saves an image under the upload directory. The file is written under a temporary name first and then renamed,
+    so that jobs storing the same content at the same time never see or leave behind a partially written file.
+    """
+    path = File.format_local_path(filename)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            img.save(f, image_format)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_variants(img, key, out_format):
+    """ Saves the full size avatar and its resized variants, both in the original format and as WebP """
+    sizes = [(size, size) for size in config.AVATAR_VARIANT_SIZES]
+    sizes.append((None, None))
+    webp_img = img if img.mode in ('RGB', 'RGBA') else img.convert('RGBA')
+
+    # Smallest first, so that the full size file only appears once all variants exist
+    for size, name_size in sizes:
+        variant = img
+        webp_variant = webp_img
+        if size and (img.width > size or img.height > size):
+            variant = img.copy()
+            variant.thumbnail((size, size))
+            webp_variant = variant if variant.mode in ('RGB', 'RGBA') else variant.convert('RGBA')
+        if config.AVATAR_WEBP:
+            save_image(webp_variant, File.format_variant_name(key, name_size, 'webp'), 'WEBP')
+        save_image(variant, File.format_variant_name(key, name_size), out_format)
+
+
+def save_avatar(db, user, url):
+    """ Fetches an image and sets it as the avatar of the user. Database changes are left for the caller to commit.
+
+    Avatars are content addressed. If the same image has been uploaded before, the existing file and its variants
+    are used, and the image is not decoded again.
+    :param db: Database session
+    :param user: User database object
+    :param url: Image URL
+    """
+    with tempfile.NamedTemporaryFile() as tmp:
+        image_format, content_hash = download_image(url, tmp)
+
+        db_file = File.get_one_or_none(db, content_hash=content_hash)
+        if db_file and os.path.exists(db_file.get_local_path()):
+            log.info(u"Avatar: Using existing file %s", db_file.key)
+        else:
+            img = decode_image(tmp, image_format)
+            out_format = 'PNG' if img.format in ['PNG', 'GIF'] else 'JPEG'
+
+            # Create a new database entry, unless there already is one for the content. Another avatar job may be
+            # storing the same image at the same time; if it gets there first, use its entry.
+            if not db_file:
+                try:
+                    with db.begin_nested():
+                        db_file = File(out_format.lower(), content_hash=content_hash)
+                        db.add(db_file)
+                except IntegrityError:
+                    log.info(u"Avatar: File for %s was created by another job", content_hash)
+                    db_file = File.get_one(db, content_hash=content_hash)
+
+            # Save files to final destination
+            try:
+                save_variants(img, db_file.key, out_format)
+            except IOError as ex:
+                log.exception("Unable to save image.", exc_info=ex)
+                raise AvatarError(u"Unable to save image; try again later")
+            db_file.width = img.width
+            db_file.height = img.height
+            db_file.webp = config.AVATAR_WEBP
+
+    # Update user, too
+    user.avatar = db_file.key
+    user.avatar_file = db_file
+    db.add(user)
+
+
+class AvatarRouter(object):
+    """ Handles avatar jobs from the avatar queue
+
+    Jobs are published by AuthHandler.update_avatar, and contain the user ID and the image URL in the body, and the
+    connection, receipt and route of the original request in the head. Once the avatar has been saved, the updated
+    user (or an error) is sent to the client through the normal reply path, as if it was the reply to the original
+    request. Takes the same arguments as MessageRouter, so that Consumer and WorkerPool can run it.
+    """
+    def __init__(self, db_connection, mq_connection, activity=None):
+        self.db_connection = db_connection
+        self.mq_connection = mq_connection
+
+    def handle(self, head, body):
+        db_session = self.db_connection.get_session()
+        mq_session = MQSession(self.mq_connection, node_id=head.get('node_id'))
+        mq_session.begin()
+
+        # Replies are sent just like a handler for the original request would send them
+        reply = BaseHandler(
+            db_session, mq_session, None, head.get('connection_id'), head.get('receipt'), head.get('route'))
+
+        try:
+            user = User.get_one_or_none(db_session, id=body['user'], deleted=False)
+            if not user:
+                reply.send_error(404, u"User not found")
+                log.warning(u"Avatar: User %s not found, skipping", body['user'])
+                return
+            save_avatar(db_session, user, body['url'])
+            db_session.commit()
+            reply.send_message({
+                'user': user.serialize(include_profile=True)
+            })
+            log.info(u"Avatar: Avatar updated for user %s", user.id)
+        except AvatarError as e:
+            db_session.rollback()
+            reply.send_error(450, ErrorList(e.message, 'url'))
+        except:
+            db_session.rollback()
+            mq_session.rollback()
+            if head.get('receipt'):
+                reply.send_error(500, u'Server error')
+            log.exception("Server error while processing avatar")
+            raise
+        finally:
+            mq_session.commit()
+            db_session.close()
+            mq_session.close()
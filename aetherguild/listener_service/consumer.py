@@ -8,15 +8,24 @@ from pika.exceptions import ConnectionClosed as MQConnectionClosed
 from sqlalchemy.exc import DisconnectionError as DBConnectionClosed
 
 from aetherguild.listener_service.router import MessageRouter
+from aetherguild.listener_service.worker_pool import WorkerPool
 
 log = logging.getLogger(__name__)
 
 
 class Consumer(object):
-    def __init__(self, db_connection, mq_connection):
+    def __init__(self, db_connection, mq_connection, workers=1, shard_key='connection_id', stats_interval=0,
+                 activity=None, router_class=MessageRouter):
         self.db_connection = db_connection
         self.mq_connection = mq_connection
-        self.router = MessageRouter(db_connection, mq_connection)
+        self.router = router_class(db_connection, mq_connection, activity=activity)
+        self.pool = None
+        if workers > 1:
+            self.pool = WorkerPool(
+                db_connection, workers, shard_key=shard_key, notify=self._notify, activity=activity,
+                router_class=router_class)
+        self.stats_interval = stats_interval
+        self._stats_at = time.monotonic()
         self._run = True
 
     def _listen(self):
@@ -26,34 +35,92 @@ class Consumer(object):
         the packet from the queue. If the packet doesn't go through the handler without exceptions however, NACK the
         packet. This _should_ remove the packet from the queue and optionally add it to Dead Letter Queue in rabbitmq.
         This, of course, depends on how your rabbitmq is configured.
+
+        Packets are pushed to _on_message by the MQ connection, and this loop just blocks until there is something to
+        do. If a worker pool is in use, the workers wake the loop up whenever they have results to send out, since
+        the pika channel can't be used from the worker threads.
+        """
+        session_cache = self._get_session_cache()
+        if session_cache:
+            # Invalidations sent while we were disconnected are lost, so start over with an empty cache
+            session_cache.clear()
+            self.mq_connection.start_session_consumer(self._on_session_message)
+        self.mq_connection.start_consumer(self._on_message)
+        while self._run:
+            self.mq_connection.process_events(self.stats_interval if self.pool and self.stats_interval else None)
+            if self.pool:
+                self._log_stats()
+
+    def _on_message(self, channel, method_frame, properties, body):
+        log.info(u"MQ: Consumed packet, delivery_tag = %s", method_frame.delivery_tag)
+        if self.pool:
+            self._submit(method_frame, body)
+        else:
+            self._handle(method_frame, body)
+
+    def _get_session_cache(self):
+        router = self.pool.router if self.pool else self.router
+        return getattr(router, 'session_cache', None)
+
+    def _on_session_message(self, channel, method_frame, properties, body):
+        """ Drops sessions invalidated by any listener process (this one included) from the session cache """
+        try:
+            data = ujson.loads(body.decode('utf8'))
+            self._get_session_cache().invalidate_many(data['body']['session_keys'], data['body']['user_ids'])
+        except Exception as e:
+            log.error(u"MQ: Invalid session invalidation message", exc_info=e)
+
+    def _flush(self):
+        self.pool.flush(self.mq_connection)
+
+    def _notify(self):
+        self.mq_connection.call_threadsafe(self._flush)
+
+    def _log_stats(self):
+        if self.stats_interval and time.monotonic() - self._stats_at >= self.stats_interval:
+            self._stats_at = time.monotonic()
+            self.pool.log_stats()
+
+    def _handle(self, method_frame, body):
+        try:
+            data = ujson.loads(body.decode('utf8'))
+            self.router.handle(data['head'], data['body'])
+            self.mq_connection.ack(method_frame.delivery_tag)
+            log.info(u"MQ: ACK delivery_tag = %s", method_frame.delivery_tag)
+        except Exception as e:
+            self.mq_connection.nack(method_frame.delivery_tag)
+            log.error("MQ: NACK delivery_tag = %s", method_frame.delivery_tag, exc_info=e)
+
+    def _submit(self, method_frame, body):
+        """ Hand a packet over to the worker pool
+
+        Packets that can't be decoded are NACKed right away. Everything else is ACKed or NACKed by the worker pool
+        once the handler has run.
         """
-        for packet in self.mq_connection.consume():
-            if packet:
-                method_frame, _, body = packet
-                log.info(u"MQ: Consumed packet, delivery_tag = %s", method_frame.delivery_tag)
-                try:
-                    data = ujson.loads(body.decode('utf8'))
-                    self.router.handle(data['head'], data['body'])
-                    self.mq_connection.ack(method_frame.delivery_tag)
-                    log.info(u"MQ: ACK delivery_tag = %s", method_frame.delivery_tag)
-                except Exception as e:
-                    self.mq_connection.nack(method_frame.delivery_tag)
-                    log.error("MQ: NACK delivery_tag = %s", method_frame.delivery_tag, exc_info=e)
-
-            # Stop here if close has been called
-            if not self._run:
-                return
+        try:
+            data = ujson.loads(body.decode('utf8'))
+            self.pool.submit(method_frame.delivery_tag, data['head'], data['body'])
+        except Exception as e:
+            self.mq_connection.nack(method_frame.delivery_tag)
+            log.error("MQ: NACK delivery_tag = %s", method_frame.delivery_tag, exc_info=e)
 
     def handle(self):
         """ Connects to the server and runs the listener. Reconnects to servers if necessary.
         """
+        if self.pool:
+            self.pool.start()
         while self._run:
             try:
                 if self.mq_connection.is_closed():
                     self.mq_connection.connect()
+                    if self.pool:
+                        self.pool.new_generation()
                 if self.db_connection.is_closed():
                     self.db_connection.connect()
                 self._listen()
+                if self.pool:
+                    self.pool.stop()
+                    self.pool.flush(self.mq_connection)
                 self.mq_connection.cancel_consumer()
             except MQConnectionClosed:
                 if self._run:
@@ -67,3 +134,4 @@ class Consumer(object):
         """ Closes consumer
         """
         self._run = False
+        self.mq_connection.wakeup()
@@ -19,7 +19,10 @@ class DBConnection(object):
         if self.engine:
             self.engine.connect()
         else:
-            self.engine = create_engine(config.DATABASE_CONFIG, pool_recycle=3600)
+            self.engine = create_engine(
+                config.DATABASE_CONFIG,
+                pool_recycle=3600,
+                pool_size=max(5, config.LISTENER_WORKERS))
         self.connection = sessionmaker(bind=self.engine, autoflush=True)
         self._is_closed = False
         log.info("DB: Connected")
@@ -4,7 +4,7 @@ import logging
 
 from sqlalchemy.orm.exc import NoResultFound
 
-from aetherguild.listener_service.tables import User, Session
+from aetherguild.listener_service.tables import User
 from aetherguild.listener_service.user_session import LEVEL_ADMIN
 from .basehandler import BaseHandler, validate_message_schema, has_level
 from aetherguild.listener_service.schemas.admin import *
@@ -59,13 +59,14 @@ class AdminHandler(BaseHandler):
         self.db.add(user)
 
         # Invalidate sessions where user is the owner
-        Session.delete(self.db, user=user.id)
+        self.session.invalidate_user(user.id)
 
         # Just send an empty notification
         self.send_message({})
 
-    def get_routes(self):
+    @classmethod
+    def get_routes(cls):
         return {
-            'get_users': self.get_users,
-            'delete_user': self.delete_user
+            'get_users': cls.get_users,
+            'delete_user': cls.delete_user
         }
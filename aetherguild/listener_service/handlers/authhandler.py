@@ -1,19 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import tempfile
 import ujson
 import binascii
 import hashlib
 
-import requests
-from PIL import Image
 import bleach
-from passlib.hash import pbkdf2_sha512
 from sqlalchemy.orm.exc import NoResultFound
 
-from aetherguild.listener_service.tables import User, Session, File, OldUser
+from aetherguild.listener_service.tables import User, Session, OldUser
 from aetherguild.listener_service.user_session import UserSession, LEVEL_USER, LEVEL_GUEST
+from aetherguild.listener_service.avatar import save_avatar, AvatarError
+from aetherguild.listener_service.passwords import hash_password, verify_password, PasswordQueueFull, DUMMY_HASH
 from aetherguild.listener_service.handlers.basehandler import BaseHandler, ErrorList, is_authenticated,\
     validate_message_schema
 from aetherguild.listener_service.schemas.auth import *
@@ -26,10 +24,30 @@ log = logging.getLogger(__name__)
 
 
 class AuthHandler(BaseHandler):
+    # LoginRateLimiter shared by all handler instances, or None for no limits
+    login_limiter = None
+
     @validate_message_schema(login_request)
     def login(self, track_route, message):
         username = message['data']['username']
         password = message['data']['password']
+
+        # Refuse the attempt before doing any expensive password checks
+        if self.login_limiter and not self.login_limiter.allow(self.remote_ip, username):
+            self.send_error(429, u"Too many login attempts, try again later")
+            log.warning(u"Login rate limit hit for user %s from %s", username, self.remote_ip)
+            return
+
+        try:
+            # Only failed attempts count; many users may share one IP (eg. behind NAT)
+            if not self._login(username, password) and self.login_limiter:
+                self.login_limiter.add_failure(self.remote_ip, username)
+        except PasswordQueueFull:
+            self.send_error(503, u"Server is busy, try again later")
+            log.warning(u"Password hashing queue full, login refused for user %s", username)
+
+    def _login(self, username, password):
+        """ Checks the credentials and starts a session. Returns True if login was successful. """
         key = generate_random_key().decode()
 
         # Find the user by username, fail with error if not found
@@ -37,13 +55,10 @@ class AuthHandler(BaseHandler):
             user = User.get_one(self.db, username=username, deleted=False)
         except NoResultFound:
             # Attempt to protect against timing attacks
-            pbkdf2_sha512.verify(password, '$pbkdf2-sha512$25000$/d8bg5CSUuq9lxLCm'
-                                           'PNeCw$v8i0AT1iLaj77KSY15JwjzGX/JY.RvZJ'
-                                           'ACYqGO96gRdGX.8TicEfEidec/1zfuWh961kqa'
-                                           'v0osbPglBV/z.F6Q')
+            verify_password(password, DUMMY_HASH)
             self.send_error(401, u"Wrong username and/or password")
             log.warning(u"Login failed for user %s", username)
-            return
+            return False
 
         # If user has password set to None, the user is a migrated user.
         # Attempt to find OldUser data.
@@ -54,7 +69,7 @@ class AuthHandler(BaseHandler):
             except NoResultFound:
                 self.send_error(401, u"Wrong username and/or password")
                 log.warning(u"Login failed for user %s", username)
-                return
+                return False
 
         # Verify password
         password_matches = False
@@ -68,17 +83,20 @@ class AuthHandler(BaseHandler):
             old_hash = binascii.hexlify(old_user.password)
             if test_hash_hex == old_hash:
                 # Save password to new user, delete OldUser
-                user.password = pbkdf2_sha512.encrypt(password)
+                user.password = hash_password(password)
                 OldUser.delete(self.db, id=old_user.id)
                 self.db.add(user)
                 password_matches = True
 
         # ... otherwise just use the normal password.
-        if not old_user and pbkdf2_sha512.verify(password, user.password):
+        if not old_user and verify_password(password, user.password):
             password_matches = True
 
         # If password is OK, boot up a session
         if password_matches:
+            if self.login_limiter:
+                self.login_limiter.reset(self.remote_ip, username)
+
             # Create a new session to database
             # TODO: CLEANUP OLD SESSIONS
             s = Session()
@@ -103,9 +121,11 @@ class AuthHandler(BaseHandler):
                 'user': user.serialize()
             }, req_level=LEVEL_USER, avoid_self=True)
             log.info(u"Login OK for user %s", username)
-        else:
-            self.send_error(401, u"Wrong username and/or password")
-            log.warning(u"Login failed for user %s", username)
+            return True
+
+        self.send_error(401, u"Wrong username and/or password")
+        log.warning(u"Login failed for user %s", username)
+        return False
 
     @validate_message_schema(register_request)
     def register(self, track_route, message):
@@ -149,7 +169,11 @@ class AuthHandler(BaseHandler):
         user.profile_data = profile_data
         user.level = LEVEL_GUEST
         user.active = True
-        user.password = pbkdf2_sha512.encrypt(password)
+        try:
+            user.password = hash_password(password)
+        except PasswordQueueFull:
+            self.send_error(503, u"Server is busy, try again later")
+            return
         self.db.add(user)
 
         self.send_message({})
@@ -169,14 +193,18 @@ class AuthHandler(BaseHandler):
             validate_str_length('new_password', new_password, errors_list, 8)
             validate_required_field('old_password', old_password, errors_list)
 
-            # Only run this check if no other errors were detected
-            if not errors_list.get_list():
-                validate_password_field('old_password', self.session.user.password, old_password, errors_list)
-
-            # Don't change anything if there are errors
-            if not errors_list.get_list():
-                self.session.user.password = pbkdf2_sha512.encrypt(new_password)
-                self.db.add(self.session.user)
+            try:
+                # Only run this check if no other errors were detected
+                if not errors_list.get_list():
+                    validate_password_field('old_password', self.session.user.password, old_password, errors_list)
+
+                # Don't change anything if there are errors
+                if not errors_list.get_list():
+                    self.session.user.password = hash_password(new_password)
+                    self.db.add(self.session.user)
+            except PasswordQueueFull:
+                self.send_error(503, u"Server is busy, try again later")
+                return
 
         # Nickname is mandatory
         nickname = bleach.clean(nickname)
@@ -212,93 +240,25 @@ class AuthHandler(BaseHandler):
     def update_avatar(self, track_route, message):
         avatar_url = message['data']['url']
 
-        try:
-            r = requests.get(avatar_url, stream=True, timeout=config.AVATAR_REQUIREMENTS['connection_timeout'])
-        except requests.exceptions.ConnectionError as ex:
-            self.send_error(450, ErrorList(u"Unable to fetch the image: Unable to connect to host", 'url'))
-            log.exception(u"Unable to fetch the image: Unable to connect to host", exc_info=ex)
-            return
-        except requests.exceptions.Timeout as ex:
-            self.send_error(450, ErrorList(u"Unable to fetch the image: Connection timeout", 'url'))
-            log.exception(u"Unable to fetch the image: Connection timeout", exc_info=ex)
-            return
-        except (requests.exceptions.URLRequired,
-                requests.exceptions.MissingSchema,
-                requests.exceptions.InvalidSchema,
-                requests.exceptions.InvalidURL) as ex:
-            self.send_error(450, ErrorList(u"Unable to fetch the image: Invalid URL", 'url'))
-            log.exception(u"Unable to fetch the image: Invalid URL", exc_info=ex)
-            return
-        except requests.exceptions.RequestException as ex:
-            self.send_error(450, ErrorList(u"Unable to fetch the image", 'url'))
-            log.exception(u"Unable to fetch the image", exc_info=ex)
+        # Fetching and resizing is left for the avatar worker, which replies to the client when it is done
+        if config.AVATAR_WORKER_ENABLED:
+            self.mq.publish_job(config.MQ_TO_AVATAR, {
+                'user': self.session.user_id,
+                'url': avatar_url
+            }, connection_id=self.connection_id, receipt_id=self.receipt_id, route=self.full_route)
             return
 
-        # Attempt to fetch the image content to a temp file
-        max_size = config.AVATAR_REQUIREMENTS['max_size']
-        done_size = 0
-        chunk_size = 1024
-        with tempfile.NamedTemporaryFile() as tmp:
-            for chunk in r.iter_content(chunk_size=chunk_size):
-                if done_size > max_size:
-                    self.send_error(450, ErrorList(u"Unable to fetch the image: File size exceeds 5 megabytes", 'url'))
-                    log.warning(u"Unable to fetch the image: File size exceeds 5 megabytes")
-                    break
-                if chunk:
-                    done_size += chunk_size
-                    tmp.write(chunk)
-            r.close()
-
-            # Open up the image and detect type
-            tmp.seek(0)
-            try:
-                img = Image.open(tmp)
-            except IOError as ex:
-                self.send_error(450, ErrorList(u"Given URL does not contain a valid imagefile", 'url'))
-                log.exception(u"Given URL does not contain a valid imagefile", exc_info=ex)
-                return
-
-            # Make sure somebody is not size/decompression bombing us
-            max_input_size = [
-                config.AVATAR_REQUIREMENTS['max_input_width'],
-                config.AVATAR_REQUIREMENTS['max_input_height']
-            ]
-            if img.width >= max_input_size[0] or img.height >= max_input_size[1]:
-                self.send_error(450, ErrorList(u"Image is too large; Maximum size is 2048x2048", 'url'))
-                return
-
-            # Thumbnail it
-            max_output_size = [
-                config.AVATAR_REQUIREMENTS['max_output_width'],
-                config.AVATAR_REQUIREMENTS['max_output_height']
-            ]
-            if img.width >= max_output_size[0] or img.height >= max_output_size[1]:
-                img.thumbnail(max_output_size)
-
-            # Create a new database entry
-            ext = img.format.lower()
-            db_file = File(ext)
-            self.db.add(db_file)
-            self.db.flush()
-
-            # Update user, too
-            self.session.user.avatar = db_file.key
-            self.db.add(self.session.user)
-
-            # Save file to final destination
-            out_format = 'PNG' if img.format in ['PNG', 'GIF'] else 'JPEG'
-            try:
-                img.save(db_file.get_local_path(), out_format)
-            except IOError as ex:
-                self.db.rollback()
-                log.exception("Unable to save image.", exc_info=ex)
-                self.send_error(450, ErrorList(u"Unable to save image; try again later", 'url'))
-                return
+        try:
+            save_avatar(self.db, self.session.user, avatar_url)
+        except AvatarError as e:
+            self.db.rollback()
+            self.send_error(450, ErrorList(e.message, 'url'))
+            return
 
-            # Things have come this far, everything must be okay. Re-send user information.
-            self.send_message({
-                'user': self.session.user.serialize(include_profile=True)
-            })
+        # Things have come this far, everything must be okay. Re-send user information.
+        self.send_message({
+            'user': self.session.user.serialize(include_profile=True)
+        })
 
     @is_authenticated
     def get_profile(self, track_route, message):
@@ -319,7 +279,7 @@ class AuthHandler(BaseHandler):
     @validate_message_schema(authenticate_request)
     def authenticate(self, track_route, message):
         key = message['data']['session_key']
-        user_session = UserSession(self.db, key)
+        user_session = UserSession(self.db, key, cache=self.session.cache, activity=self.session.activity)
         if user_session.is_valid():
             user_session.close()
 
@@ -342,13 +302,14 @@ class AuthHandler(BaseHandler):
         else:
             self.send_error(450, u"Invalid session key")
 
-    def get_routes(self):
+    @classmethod
+    def get_routes(cls):
         return {
-            'login': self.login,
-            'logout': self.logout,
-            'authenticate': self.authenticate,
-            'register': self.register,
-            'update_profile': self.update_profile,
-            'get_profile': self.get_profile,
-            'update_avatar': self.update_avatar
+            'login': cls.login,
+            'logout': cls.logout,
+            'authenticate': cls.authenticate,
+            'register': cls.register,
+            'update_profile': cls.update_profile,
+            'get_profile': cls.get_profile,
+            'update_avatar': cls.update_avatar
         }
@@ -1,42 +1,79 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+from collections import namedtuple
+from functools import wraps
 from cerberus import Validator
 
+from aetherguild.listener_service.user_session import LEVEL_GUEST
+
 log = logging.getLogger(__name__)
 
+Route = namedtuple('Route', ['handler', 'method', 'level', 'authenticated', 'schema'])
+
+
+class ValidatorCache(object):
+    """ Keeps compiled cerberus validators for a schema
+
+    Building a Validator compiles its schema, so validators should be reused instead of built for every message.
+    Validators store the state of the latest validation though, so they can't be shared between threads. Every
+    thread gets its own validator on first use. The first one is built right away, so that broken schemas are
+    noticed on import.
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self._local = threading.local()
+        self.get()
+
+    def get(self):
+        validator = getattr(self._local, 'validator', None)
+        if validator is None:
+            validator = self._local.validator = Validator(self.schema)
+        return validator
+
 
 def has_level(level):
     """ Checks if user has required userlevel
     :param level: Required userlevel
     """
     def _inner_has_privileges(method):
+        @wraps(method)
         def inner(instance, *args, **kwargs):
             if instance.session.is_valid() and instance.session.has_level(level):
                 method(instance, *args, **kwargs)
             else:
                 instance.send_error(403, u"Forbidden")
+        inner.required_level = level
+        inner.authenticated = True
         return inner
     return _inner_has_privileges
 
 
 def is_authenticated(method):
-    """ Checks if user is authenticated
+    """ Checks if user is authenticated. Loads the user, since these routes use it, and makes sure it still exists
+    even if the session came from the cache.
     """
+    @wraps(method)
     def inner(instance, *args, **kwargs):
-        if instance.session.is_valid():
+        if instance.session.is_valid() and instance.session.user is not None:
             method(instance, *args, **kwargs)
         else:
             instance.send_error(403, u"Forbidden")
+    inner.required_level = getattr(method, 'required_level', LEVEL_GUEST)
+    inner.authenticated = True
     return inner
 
 
 def validate_message_schema(schema):
     """ Validates function input message against a schema, and returns error 400 if the check fails
     """
+    validators = ValidatorCache(schema)
+
     def _inner_has_privileges(method):
+        @wraps(method)
         def inner(instance, *args, **kwargs):
-            v = Validator(schema)
+            v = validators.get()
             if v.validate(args[1].get('data')):
                 method(instance, *args, **kwargs)
             else:
@@ -45,6 +82,7 @@ def validate_message_schema(schema):
                     for err_message in err_messages:
                         errors_list.add_error(error_message=err_message, error_field=err_field)
                 instance.send_error(400, errors_list)
+        inner.schema = schema
         return inner
     return _inner_has_privileges
 
@@ -71,30 +109,46 @@ class ErrorList(object):
 
 
 class BaseHandler(object):
-    def __init__(self, db_session, mq_session, user_session, connection_id, receipt_id, full_route):
+    def __init__(self, db_session, mq_session, user_session, connection_id, receipt_id, full_route, remote_ip=None):
         self.db = db_session
         self.mq = mq_session
         self.connection_id = connection_id
         self.session = user_session
         self.receipt_id = receipt_id
         self.full_route = full_route
+        self.remote_ip = remote_ip
 
-    def get_routes(self):
+    @classmethod
+    def get_routes(cls):
         """
         Should be overwritten to return a route description dict
-        :return: Route dict
+        :return: Dict of route name -> unbound handler method
         """
         return {}
 
+    @classmethod
+    def get_route_table(cls, prefix):
+        """ Returns the routes of this handler as a dict of full route -> Route
+        :param prefix: Route prefix of this handler, eg. 'forum'
+        """
+        routes = {}
+        for name, method in cls.get_routes().items():
+            routes[u'{}.{}'.format(prefix, name)] = Route(
+                handler=cls,
+                method=method,
+                level=getattr(method, 'required_level', LEVEL_GUEST),
+                authenticated=getattr(method, 'authenticated', False),
+                schema=getattr(method, 'schema', None))
+        return routes
+
     def handle(self, track_route, message):
-        cb = self.get_routes().copy()
         try:
-            while type(cb) == dict:
-                cb = cb[track_route.pop(0)]
-            cb(track_route, message)
+            method = self.get_routes()[track_route.pop(0)]
         except (IndexError, KeyError):
             self.send_error(404, u'Route not found')
-            log.exception(u"Route not found")
+            log.warning(u"Route %s not found", self.full_route)
+            return
+        method(self, track_route, message)
 
     def send(self, message, is_control=False):
         assert type(message) == dict, "Message type must be dict"
@@ -4,7 +4,7 @@ import logging
 
 import arrow
 import bleach
-from sqlalchemy import func, and_, text
+from sqlalchemy import func, and_, text, case, bindparam, literal, tuple_
 from sqlalchemy.orm.exc import NoResultFound
 
 from aetherguild.listener_service.handlers.basehandler import BaseHandler, is_authenticated, has_level,\
@@ -12,55 +12,97 @@ from aetherguild.listener_service.handlers.basehandler import BaseHandler, is_au
 from aetherguild.listener_service.schemas.forum import *
 from aetherguild.listener_service.tables import ForumBoard, ForumSection, ForumPost, ForumThread,\
     ForumLastRead, ForumPostEdit, User
-from aetherguild.listener_service.handlers.utils import validate_str_length, validate_required_field
+from aetherguild.listener_service.handlers.utils import validate_str_length, validate_required_field,\
+    encode_cursor, decode_cursor
 from aetherguild.listener_service.user_session import LEVEL_ADMIN
+from aetherguild.common.utils import format_datetime
 
 log = logging.getLogger(__name__)
 
 
 class ForumHandler(BaseHandler):
-    def _get_board_extra_data(self, board):
-        extra_data = {}
-
-        # Fetch board posts count
-        posts_count = self.db.query(func.count('*').label('count1')).filter(and_(
-            ForumPost.thread == ForumThread.id,
-            ForumThread.board == board.id,
-            ForumThread.deleted == False,
-            ForumPost.deleted == False
-        )).all()
-
-        # Fetch board thread count
-        threads_count = self.db.query(func.count('*').label('count1')).filter(and_(
-            ForumThread.board == board.id,
-            ForumThread.deleted == False,
-        )).all()
-
-        # Get board last post
-        last_post = self.db.query(ForumPost, ForumThread, User).filter(and_(
-            ForumPost.thread == ForumThread.id,
-            User.id == ForumPost.user,
-            ForumThread.board == board.id,
-            ForumPost.deleted == False,
-            ForumThread.deleted == False
-        )).order_by(ForumPost.id.desc()).first()
-
-        # Form a custom last post serialized object
-        if last_post:
-            last_post_ser = last_post[0].serialize()
-            last_post_ser.update({
-                'thread_title': last_post[1].title,
-                'user_nickname': last_post[2].nickname,
-            })
-            del last_post_ser['message']  # No need to send, just reduce payload size
-        else:
-            last_post_ser = None
+    def _get_boards_extra_data(self, boards):
+        """ Returns extra data for a list of boards as a dict of board id -> extra data. Uses a single query. """
+        last_post_ids = [board.last_post for board in boards if board.last_post]
+
+        # Get last posts for all boards, with thread titles and user nicknames
+        last_posts = {}
+        if last_post_ids:
+            for post, thread_title, nickname in self.db.query(ForumPost, ForumThread.title, User.nickname).filter(and_(
+                ForumPost.id.in_(last_post_ids),
+                ForumPost.thread == ForumThread.id,
+                User.id == ForumPost.user
+            )):
+                # Form a custom last post serialized object
+                last_post_ser = post.serialize()
+                last_post_ser.update({
+                    'thread_title': thread_title,
+                    'user_nickname': nickname,
+                })
+                del last_post_ser['message']  # No need to send, just reduce payload size
+                last_posts[post.id] = last_post_ser
+
+        # Post and thread counts are maintained by the handlers that insert and delete posts and threads
+        return {board.id: {
+            'posts_count': board.posts_count,
+            'threads_count': board.threads_count,
+            'last_post': last_posts.get(board.last_post),
+        } for board in boards}
+
+    def _serialize_posts(self, posts):
+        """ Serializes posts with their edits, and collects the posters and editors into a dict of user id -> user.
+        Edits and users are loaded with one query each, regardless of the number of posts.
+        """
+        post_ids = [post.id for post in posts]
+        user_ids = set(post.user for post in posts)
+
+        # Find edits for all posts
+        edits = {}
+        if post_ids:
+            for edit in self.db.query(ForumPostEdit)\
+                    .filter(ForumPostEdit.post.in_(post_ids))\
+                    .order_by(ForumPostEdit.id.asc()):
+                edits.setdefault(edit.post, []).append(edit.serialize())
+                user_ids.add(edit.user)
+
+        # Find posters and editors
+        user_list = {}
+        if user_ids:
+            for user in self.db.query(User).filter(User.id.in_(user_ids)):
+                user_list[user.id] = user.serialize()
+
+        post_list = [post.serialize(edits=edits.get(post.id, [])) for post in posts]
+        return post_list, user_list
+
+    @staticmethod
+    def _parse_cursor_date(value):
+        return arrow.get(value).datetime
+
+    @staticmethod
+    def _get_page_cursors(cursors):
+        """ Returns cursors for fetching the pages before and after the current page """
+        if not cursors:
+            return None
+        return {
+            'before': cursors[0],
+            'after': cursors[-1],
+        }
 
-        # Get correct objects from responses
-        extra_data['posts_count'] = posts_count[0][0]
-        extra_data['threads_count'] = threads_count[0][0]
-        extra_data['last_post'] = last_post_ser
-        return extra_data
+    def _add_post_to_counters(self, board, thread, post):
+        """ Updates thread and board counters for a new post. Post must be flushed first. """
+        thread.posts_count = ForumThread.posts_count + 1
+        thread.last_post = case([(ForumThread.last_post > post.id, ForumThread.last_post)], else_=post.id)
+        board.posts_count = ForumBoard.posts_count + 1
+        board.last_post = case([(ForumBoard.last_post > post.id, ForumBoard.last_post)], else_=post.id)
+        self.db.add(thread)
+        self.db.add(board)
+
+    def _refresh_counters(self, board_id, thread_id=None):
+        """ Recalculates thread and board counters after posts or threads have been deleted """
+        self.db.flush()
+        if thread_id:
+            ForumThread.refresh_counters(self.db, thread_id=thread_id)
+        ForumBoard.refresh_counters(self.db, board_id=board_id)
 
     @validate_message_schema(get_boards_request)
     def get_boards(self, track_route, message):
@@ -71,12 +113,13 @@ class ForumHandler(BaseHandler):
             .filter(ForumBoard.req_level <= self.session.get_level(), ForumBoard.deleted == False)
         if section_id:
             boards = boards.filter(ForumBoard.section == section_id)
-        boards = boards.order_by(ForumBoard.sort_index.asc())
+        boards = boards.order_by(ForumBoard.sort_index.asc()).all()
+        extra_data = self._get_boards_extra_data(boards)
 
         out = []
         for board in boards:
             serialized = board.serialize()
-            serialized.update(self._get_board_extra_data(board))
+            serialized.update(extra_data[board.id])
             out.append(serialized)
         self.send_message({'boards': out})
 
@@ -101,6 +144,8 @@ class ForumHandler(BaseHandler):
     def get_threads(self, track_route, message):
         start = message['data'].get('start', 0)
         count = message['data'].get('count', 10)
+        after = message['data'].get('after')
+        before = message['data'].get('before')
         board_id = message['data']['board']
 
         # Check if user has rights to the board. Fake out 404 if not.
@@ -109,6 +154,27 @@ class ForumHandler(BaseHandler):
             self.send_error(404, "Board not Found")
             return
 
+        # If a cursor was given, only fetch threads after or before it in the listing order
+        cursor_clause = ''
+        order = 'DESC'
+        params = {}
+        if after or before:
+            try:
+                sticky, updated_at, thread_id = decode_cursor(after or before, bool, self._parse_cursor_date, int)
+            except ValueError:
+                self.send_error(400, ErrorList(u"Invalid cursor", 'after' if after else 'before'))
+                return
+            cursor_clause = ' AND (forum_thread.sticky, forum_thread.updated_at, forum_thread.id) ' \
+                            '     {} (:cursor_sticky, :cursor_updated_at, :cursor_id) '.format('<' if after else '>')
+            params.update({
+                'cursor_sticky': sticky,
+                'cursor_updated_at': updated_at,
+                'cursor_id': thread_id,
+            })
+            if before:
+                order = 'ASC'
+            start = 0
+
         query = '   SELECT forum_thread.id,' \
                 '          forum_thread.user, ' \
                 '          forum_thread.board, ' \
@@ -119,9 +185,7 @@ class ForumHandler(BaseHandler):
                 '          forum_thread.sticky, ' \
                 '          forum_thread.closed, ' \
                 '          new_user.nickname, ' \
-                '          (SELECT COUNT(*) ' \
-                '             FROM forum_post ' \
-                '            WHERE thread = forum_thread.id AND forum_post.deleted = FALSE) AS posts_count, ' \
+                '          forum_thread.posts_count, ' \
                 '          (SELECT forum_last_read.created_at ' \
                 '             FROM forum_last_read ' \
                 '            WHERE forum_last_read.thread = forum_thread.id ' \
@@ -130,37 +194,48 @@ class ForumHandler(BaseHandler):
                 '    WHERE forum_thread.board = :board_id' \
                 '          AND forum_thread.user = new_user.id ' \
                 '          AND forum_thread.deleted = FALSE' \
-                ' ORDER BY forum_thread.sticky DESC, forum_thread.updated_at DESC ' \
+                '          {cursor_clause}' \
+                ' ORDER BY forum_thread.sticky {order}, forum_thread.updated_at {order}, forum_thread.id {order} ' \
                 '    LIMIT :limit ' \
-                '   OFFSET :offset '
-        params = {
+                '   OFFSET :offset '.format(cursor_clause=cursor_clause, order=order)
+        params.update({
             'limit': count,
             'offset': start,
             'board_id': board_id,
-            'user_id': self.session.user.id if self.session.user else 0
-        }
-        threads = self.db.execute(query, params)
-
-        # Get thread count for this board
-        threads_count = self.db.query(ForumThread).filter_by(deleted=False, board=board_id).count()
+            'user_id': self.session.user_id or 0
+        })
+        query = text(query)
+        if cursor_clause:
+            query = query.bindparams(bindparam('cursor_updated_at', type_=ForumThread.updated_at.type))
+
+        # Let the database driver return the timestamps as datetimes, whichever database it is
+        query = query.columns(
+            created_at=ForumThread.created_at.type,
+            updated_at=ForumThread.updated_at.type,
+            latest_check_time=ForumLastRead.created_at.type)
+        threads = self.db.execute(query, params).fetchall()
+        if before:
+            threads.reverse()
 
         # Walk through the threads
         thread_list = []
         users_list = {}
+        cursors = []
         for row in threads:
             thread_list.append({
                 'id': row[0],
                 'user': row[1],
                 'board': row[2],
                 'title': row[3],
-                'created_at': arrow.get(row[4]).isoformat(),
-                'updated_at': arrow.get(row[5]).isoformat(),
+                'created_at': format_datetime(row[4]),
+                'updated_at': format_datetime(row[5]),
                 'views': row[6],
                 'sticky': row[7],
                 'closed': row[8],
                 'posts_count': row[10],
-                'latest_check_time': arrow.get(row[11]).isoformat() if (row[11] and self.session.user) else None
+                'latest_check_time': format_datetime(row[11]) if self.session.is_valid() else None
             })
+            cursors.append(encode_cursor(bool(row[7]), format_datetime(row[5]), row[0]))
             if row[1] not in users_list:
                 users_list[row[1]] = {
                     'id': row[1],
@@ -169,37 +244,32 @@ class ForumHandler(BaseHandler):
 
         self.send_message({
             'board': board.serialize(),
-            'threads_count': threads_count,
+            'threads_count': board.threads_count,
             'threads': thread_list,
-            'users': users_list
+            'users': users_list,
+            'cursors': self._get_page_cursors(cursors)
         })
 
     def get_combined_boards(self, track_route, message):
-        # Get allowed sections
-        sections = self.db.query(ForumSection).filter(and_(
-            self.db.query(func.count('*').label('count1')).filter(and_(
-                ForumBoard.section == ForumSection.id,
-                ForumBoard.deleted == False,
-                ForumBoard.req_level <= self.session.get_level()
-            )).as_scalar() > 0,
+        # Get allowed boards with their sections in one go. Sections without allowed boards are left out.
+        rows = self.db.query(ForumSection, ForumBoard).filter(and_(
+            ForumBoard.section == ForumSection.id,
+            ForumBoard.req_level <= self.session.get_level(),
+            ForumBoard.deleted == False,
             ForumSection.deleted == False
-        )).order_by(ForumSection.sort_index.asc())
+        )).order_by(ForumSection.sort_index.asc(), ForumSection.id.asc(), ForumBoard.sort_index.asc()).all()
+        extra_data = self._get_boards_extra_data([board for _, board in rows])
 
-        # Iterate through sections, get boards for them
+        # Group boards under their sections
         out = []
-        for section in sections:
-            out_section = section.serialize()
-            out_section['boards'] = []
-            boards = self.db.query(ForumBoard).filter(and_(
-                ForumBoard.req_level <= self.session.get_level(),
-                ForumBoard.section == section.id,
-                ForumBoard.deleted == False
-            )).order_by(ForumBoard.sort_index.asc())
-            for board in boards:
-                serialized_board = board.serialize()
-                serialized_board.update(self._get_board_extra_data(board))
-                out_section['boards'].append(serialized_board)
-            out.append(out_section)
+        for section, board in rows:
+            if not out or out[-1]['id'] != section.id:
+                out_section = section.serialize()
+                out_section['boards'] = []
+                out.append(out_section)
+            serialized_board = board.serialize()
+            serialized_board.update(extra_data[board.id])
+            out[-1]['boards'].append(serialized_board)
         self.send_message({'sections': out})
 
     @validate_message_schema(update_thread_views_request)
@@ -215,11 +285,11 @@ class ForumHandler(BaseHandler):
             pass
 
         # If user is logged in, update last read timestamp
-        if self.session.user:
-            last_read = ForumLastRead.get_one_or_none(self.db, thread=thread_id, user=self.session.user.id)
+        if self.session.is_valid():
+            last_read = ForumLastRead.get_one_or_none(self.db, thread=thread_id, user=self.session.user_id)
             if not last_read:
                 last_read = ForumLastRead()
-                last_read.user = self.session.user.id
+                last_read.user = self.session.user_id
                 last_read.thread = thread_id
             last_read.created_at = arrow.utcnow().datetime
             self.db.add(last_read)
@@ -228,6 +298,8 @@ class ForumHandler(BaseHandler):
     def get_posts(self, track_route, message):
         start = message['data'].get('start', None)
         count = message['data'].get('count', None)
+        after = message['data'].get('after')
+        before = message['data'].get('before')
         thread_id = message['data']['thread']
 
         # Make sure thread exists first
@@ -242,44 +314,43 @@ class ForumHandler(BaseHandler):
             self.send_error(404, "Thread not Found")
             return
 
-        base_query = self.db.query(ForumPost)\
+        posts = self.db.query(ForumPost)\
             .filter(ForumPost.thread == thread_id, ForumPost.deleted == False)
 
+        # If a cursor was given, only fetch posts after or before it. Pages before the cursor are fetched in reverse.
+        if after or before:
+            try:
+                created_at, post_id = decode_cursor(after or before, self._parse_cursor_date, int)
+            except ValueError:
+                self.send_error(400, ErrorList(u"Invalid cursor", 'after' if after else 'before'))
+                return
+            sort_key = tuple_(ForumPost.created_at, ForumPost.id)
+            cursor_key = tuple_(literal(created_at, ForumPost.created_at.type), literal(post_id))
+            posts = posts.filter(sort_key > cursor_key if after else sort_key < cursor_key)
+        if before:
+            posts = posts.order_by(ForumPost.created_at.desc(), ForumPost.id.desc())
+        else:
+            posts = posts.order_by(ForumPost.created_at.asc(), ForumPost.id.asc())
+
         # Get posts, apply limit and offset if required in args
-        posts_count = base_query.count()
-        posts = base_query.order_by(ForumPost.created_at.asc())
         if start:
             posts = posts.offset(start)
         if count:
             posts = posts.limit(count)
+        posts = posts.all()
+        if before:
+            posts.reverse()
 
-        post_list = []
-        user_list = {}
-        for post in posts:
-            # Serialize post contents
-            data = post.serialize()
-
-            # Add user to a dict if not yet there
-            if post.user not in user_list:
-                user_list[post.user] = User.get_one(self.db, id=post.user).serialize()
-
-            # Find edits for post
-            data['edits'] = []
-            for edit in ForumPostEdit.get_many(self.db, post=post.id):
-                # Add editor to the userlist also (if not yet there)
-                if edit.user not in user_list:
-                    user_list[edit.user] = User.get_one(self.db, id=edit.user).serialize()
-
-                # Append the edit as serialized to edits list
-                data['edits'].append(edit.serialize())
-            post_list.append(data)
+        post_list, user_list = self._serialize_posts(posts)
+        cursors = [encode_cursor(format_datetime(post.created_at), post.id) for post in posts]
 
         self.send_message({
             'board': board.serialize(),
             'thread': thread.serialize(),
-            'posts_count': posts_count,
+            'posts_count': thread.posts_count,
             'posts': post_list,
-            'users': user_list
+            'users': user_list,
+            'cursors': self._get_page_cursors(cursors)
         })
 
     @validate_message_schema(get_post_request)
@@ -304,20 +375,9 @@ class ForumHandler(BaseHandler):
             self.send_error(404, "Post not Found")
             return
 
-        # Append post owner to the user list that is returned with the response
-        user_list = {
-            post.user: User.get_one(self.db, id=post.user).serialize()
-        }
-
-        # Serialize post data
-        post_data = post.serialize()
-
-        # Fetch edits for the post
-        post_data['edits'] = []
-        for edit in ForumPostEdit.get_many(self.db, post=post.id):
-            if edit.user not in user_list:
-                user_list[edit.user] = User.get_one(self.db, id=edit.user).serialize()
-            post_data['edits'].append(edit.serialize())
+        # Serialize post data with edits, and get the post owner and editors for the response
+        post_list, user_list = self._serialize_posts([post])
+        post_data = post_list[0]
 
         # Send post data
         self.send_message({
@@ -337,7 +397,7 @@ class ForumHandler(BaseHandler):
 
         # Get the post and make sure it belongs to the current user
         post = self._get_post(post_id=post_id)
-        if not post or post.user != self.session.user.id:
+        if not post or post.user != self.session.user_id:
             self.send_error(404, "Post not found")
             return
 
@@ -367,7 +427,7 @@ class ForumHandler(BaseHandler):
         edit = ForumPostEdit()
         edit.message = bleach.clean(edit_msg) if edit_msg else None
         edit.post = post.id
-        edit.user = self.session.user.id
+        edit.user = self.session.user_id
         self.db.add(edit)
 
         # Notify the sender user about success
@@ -410,10 +470,11 @@ class ForumHandler(BaseHandler):
         # Create a new post for the thread
         post = ForumPost()
         post.message = msg
-        post.user = self.session.user.id
+        post.user = self.session.user_id
         post.thread = thread.id
         self.db.add(post)
         self.db.flush()
+        self._add_post_to_counters(board, thread, post)
 
         # Notify the sender user about success; also broadcast notification to everyone else with sufficient privileges
         self.send_message({
@@ -438,7 +499,7 @@ class ForumHandler(BaseHandler):
 
         # Get the thread
         thread = self._get_thread(thread_id=thread_id)
-        if not thread or thread.user != self.session.user.id:
+        if not thread or thread.user != self.session.user_id:
             self.send_error(404, "Thread not found")
             return
 
@@ -494,7 +555,7 @@ class ForumHandler(BaseHandler):
 
         # Create a new thread
         thread = ForumThread()
-        thread.user = self.session.user.id
+        thread.user = self.session.user_id
         thread.board = board.id
         thread.title = title
         thread.sticky = sticky
@@ -505,10 +566,12 @@ class ForumHandler(BaseHandler):
         # Create a new post for the thread
         post = ForumPost()
         post.message = msg
-        post.user = self.session.user.id
+        post.user = self.session.user_id
         post.thread = thread.id
         self.db.add(post)
         self.db.flush()
+        board.threads_count = ForumBoard.threads_count + 1
+        self._add_post_to_counters(board, thread, post)
 
         # Notify the sender user about success; also broadcast notification to everyone else with sufficient privileges
         self.send_message({
@@ -535,6 +598,10 @@ class ForumHandler(BaseHandler):
             self.send_error(404, u"Post not found")
             return
 
+        # Update post counts and last posts
+        thread = ForumThread.get_one(self.db, id=post.thread)
+        self._refresh_counters(thread.board, thread_id=thread.id)
+
         self.send_message({})
 
     @has_level(LEVEL_ADMIN)
@@ -550,6 +617,9 @@ class ForumHandler(BaseHandler):
             self.send_error(404, u"Thread not found")
             return
 
+        # Update board post and thread counts and last post
+        self._refresh_counters(thread.board)
+
         self.send_message({})
 
     @has_level(LEVEL_ADMIN)
@@ -716,25 +786,26 @@ class ForumHandler(BaseHandler):
     def _has_rights_to_board(self, board=None):
         return board and board.deleted is False and board.req_level <= self.session.get_level()
 
-    def get_routes(self):
+    @classmethod
+    def get_routes(cls):
         return {
-            'get_sections': self.get_sections,
-            'get_boards': self.get_boards,
-            'get_combined_boards': self.get_combined_boards,
-            'get_threads': self.get_threads,
-            'get_posts': self.get_posts,
-            'get_post': self.get_post,
-            'update_thread_views': self.update_thread_views,
-            'update_thread': self.update_thread,
-            'insert_thread': self.insert_thread,
-            'delete_thread': self.delete_thread,
-            'update_post': self.update_post,
-            'insert_post': self.insert_post,
-            'delete_post': self.delete_post,
-            'insert_section': self.insert_section,
-            'update_section': self.update_section,
-            'delete_section': self.delete_section,
-            'insert_board': self.insert_board,
-            'update_board': self.update_board,
-            'delete_board': self.delete_board
+            'get_sections': cls.get_sections,
+            'get_boards': cls.get_boards,
+            'get_combined_boards': cls.get_combined_boards,
+            'get_threads': cls.get_threads,
+            'get_posts': cls.get_posts,
+            'get_post': cls.get_post,
+            'update_thread_views': cls.update_thread_views,
+            'update_thread': cls.update_thread,
+            'insert_thread': cls.insert_thread,
+            'delete_thread': cls.delete_thread,
+            'update_post': cls.update_post,
+            'insert_post': cls.insert_post,
+            'delete_post': cls.delete_post,
+            'insert_section': cls.insert_section,
+            'update_section': cls.update_section,
+            'delete_section': cls.delete_section,
+            'insert_board': cls.insert_board,
+            'update_board': cls.update_board,
+            'delete_board': cls.delete_board
         }
@@ -140,11 +140,12 @@ class NewsHandler(BaseHandler):
             'post': post.serialize()
         })
 
-    def get_routes(self):
+    @classmethod
+    def get_routes(cls):
         return {
-            'get_news_posts': self.get_news_posts,
-            'get_news_post': self.get_news_post,
-            'insert_news_post': self.insert_news_post,
-            'delete_news_post': self.delete_news_post,
-            'update_news_post': self.update_news_post,
+            'get_news_posts': cls.get_news_posts,
+            'get_news_post': cls.get_news_post,
+            'insert_news_post': cls.insert_news_post,
+            'delete_news_post': cls.delete_news_post,
+            'update_news_post': cls.update_news_post,
         }
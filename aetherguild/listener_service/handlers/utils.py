@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from passlib.hash import pbkdf2_sha512
+import base64
+
+import ujson
+
+from aetherguild.listener_service.passwords import verify_password
 
 
 def validate_str_length(field, value, error_list, min_value=None, max_value=None):
@@ -19,5 +23,23 @@ def validate_required_field(field, value, error_list):
 
 
 def validate_password_field(field, old_password, test_password, error_list):
-    if not pbkdf2_sha512.verify(test_password, old_password):
+    if not verify_password(test_password, old_password):
         error_list.add_error(u"Incorrect password", field)
+
+
+def encode_cursor(*values):
+    """ Encodes the sort key values of a row into an opaque cursor token for keyset pagination """
+    return base64.urlsafe_b64encode(ujson.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token, *converters):
+    """ Decodes a cursor token made by encode_cursor, and converts the values with the given converter functions.
+    Raises ValueError if the token is not valid.
+    """
+    try:
+        values = ujson.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(converters):
+            raise ValueError(u"Wrong amount of cursor values")
+        return [converter(value) for converter, value in zip(converters, values)]
+    except Exception as e:
+        raise ValueError(u"Invalid cursor") from e
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import argparse
 import logging
+import multiprocessing
 import signal
 from logging.config import dictConfig
 
@@ -8,14 +10,61 @@ from aetherguild import config
 from aetherguild.listener_service.consumer import Consumer
 from aetherguild.listener_service.mq_connection import MQConnection
 from aetherguild.listener_service.db_connection import DBConnection
+from aetherguild.listener_service.activity import ActivityTracker
+from aetherguild.listener_service.avatar import AvatarRouter
+from aetherguild.listener_service.handlers.authhandler import AuthHandler
+from aetherguild.listener_service import passwords
 
+log = logging.getLogger(__name__)
 
-if __name__ == '__main__':
-    # Set up the global log
-    dictConfig(config.LOGGING)
-    log = logging.getLogger(__name__)
+
+def run_avatar_worker():
+    """ Runs a single avatar worker process until it is signaled to stop
+
+    The avatar worker consumes avatar jobs published by auth.update_avatar, so that slow image hosts and image
+    processing don't hold up the listener. With AVATAR_WORKERS > 1, several jobs are processed in parallel.
+    """
+    log.info("Starting avatar worker")
+
+    db_connection = DBConnection()
+    db_connection.connect()
+    mq_connection = MQConnection(queue=config.MQ_TO_AVATAR)
+    mq_connection.connect()
+    consumer = Consumer(db_connection, mq_connection, workers=config.AVATAR_WORKERS, router_class=AvatarRouter)
+
+    def sig_handler(signal, frame):
+        consumer.close()
+
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    try:
+        consumer.handle()
+    except KeyboardInterrupt:
+        pass
+    except:
+        log.exception("Error while running avatar worker")
+    consumer.close()
+    mq_connection.close()
+    db_connection.close()
+    log.info(u"All done. Shutdown.")
+
+
+def run_listener():
+    """ Runs a single listener process until it is signaled to stop """
     log.info("Starting MQ listener")
 
+    # Start the password hashing processes before anything else, so that they don't inherit any connections
+    if config.PASSWORD_HASH_PROCESSES > 0:
+        passwords.start_pool(config.PASSWORD_HASH_PROCESSES, config.PASSWORD_HASH_QUEUE_SIZE)
+
+    # Failed login attempts are limited per remote IP, and per username from each remote IP
+    if config.LOGIN_RATE_WINDOW > 0:
+        AuthHandler.login_limiter = passwords.LoginRateLimiter(
+            ip_limit=config.LOGIN_RATE_LIMIT_IP,
+            username_limit=config.LOGIN_RATE_LIMIT_USERNAME,
+            window=config.LOGIN_RATE_WINDOW)
+
     # Set up DB connection and connect
     db_connection = DBConnection()
     db_connection.connect()
@@ -24,8 +73,20 @@ if __name__ == '__main__':
     mq_connection = MQConnection()
     mq_connection.connect()
 
+    # Session and user activity timestamps are written to the database in the background
+    activity = None
+    if config.ACTIVITY_FLUSH_INTERVAL > 0:
+        activity = ActivityTracker(db_connection, interval=config.ACTIVITY_FLUSH_INTERVAL)
+        activity.start()
+
     # Create a message consumer. This handles message consumption and handling
-    consumer = Consumer(db_connection, mq_connection)
+    consumer = Consumer(
+        db_connection,
+        mq_connection,
+        workers=config.LISTENER_WORKERS,
+        shard_key=config.LISTENER_SHARD_KEY,
+        stats_interval=config.LISTENER_STATS_INTERVAL,
+        activity=activity)
 
     def sig_handler(signal, frame):
         consumer.close()
@@ -41,8 +102,55 @@ if __name__ == '__main__':
         log.exception("Error while running MQ listener")
     consumer.close()
 
+    # Write out the remaining activity timestamps before closing the database
+    if activity:
+        activity.stop()
+
     mq_connection.close()
     db_connection.close()
+    passwords.stop_pool()
 
     # All done. Close.
     log.info(u"All done. Shutdown.")
+
+
+def run_supervisor(processes, target=run_listener):
+    """ Runs a number of listener (or avatar worker) processes against the same MQ queue
+
+    Every process opens its own DB and MQ connections after it has been started. Signals received by the supervisor
+    are passed on to the listener processes, and the supervisor exits once all of them have shut down.
+    """
+    log.info("Starting %d MQ listener processes", processes)
+    children = [multiprocessing.Process(target=target, name='listener-{}'.format(n)) for n in range(processes)]
+
+    def sig_handler(signal, frame):
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+
+    # Install the handler only once all children have started, so that they don't inherit it
+    for child in children:
+        child.start()
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    for child in children:
+        child.join()
+    log.info(u"All listener processes stopped. Shutdown.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the MQ listener service')
+    parser.add_argument('--processes', type=int, default=1, help='Number of listener processes to run')
+    parser.add_argument('--stage', choices=['listener', 'avatar'], default='listener',
+                        help='Run the message listener or the avatar worker')
+    args = parser.parse_args()
+    target = run_avatar_worker if args.stage == 'avatar' else run_listener
+
+    # Set up the global log
+    dictConfig(config.LOGGING)
+
+    if args.processes > 1:
+        run_supervisor(args.processes, target)
+    else:
+        target()
@@ -7,39 +7,123 @@ from pika import BlockingConnection, URLParameters
 from pika.spec import BasicProperties
 
 from aetherguild import config
+from aetherguild.common.utils import get_node_queue
 
 log = logging.getLogger(__name__)
 
+# All outgoing messages share the same properties, so there is no need to build these for every message
+MESSAGE_PROPERTIES = BasicProperties(content_type="application/json", delivery_mode=2)
+
+
+def get_routing(head):
+    """ Returns the exchange and routing key for a message going to the socket service
+
+    Broadcasts go to every socket service node through the fanout exchange. Other messages go to the node that owns
+    the connection. Jobs for other listener stages (eg. the avatar worker) name their queue explicitly, and session
+    invalidations go to every listener process through the session exchange. Returns None for messages without a
+    node ID, since no socket service node would receive them.
+    """
+    if head.get('invalidate_sessions'):
+        return config.MQ_SESSION_EXCHANGE, ''
+    if head.get('queue'):
+        return config.MQ_EXCHANGE, head['queue']
+    if head.get('broadcast'):
+        return config.MQ_BROADCAST_EXCHANGE, ''
+    if head.get('node_id'):
+        return config.MQ_EXCHANGE, get_node_queue(head['node_id'])
+    return None
+
 
 class MQConnection(object):
-    def __init__(self):
+    def __init__(self, queue=None):
+        self.queue = queue or config.MQ_TO_LISTENER
         self.connection = None
         self.channel = None
+        self.publish_channel = None
+        self.consumer_tag = None
+        self.session_consumer_tag = None
         pika_logger = logging.getLogger('pika')
         pika_logger.setLevel(logging.CRITICAL)
 
     def connect(self):
         self.connection = BlockingConnection(URLParameters(config.MQ_CONFIG))
         self.channel = self.connection.channel()
+        self.consumer_tag = None
+        self.session_consumer_tag = None
+        self.channel.basic_qos(prefetch_count=config.MQ_PREFETCH_COUNT)
+        self.channel.exchange_declare(exchange=config.MQ_BROADCAST_EXCHANGE, exchange_type='fanout', durable=True)
+        self.channel.exchange_declare(exchange=config.MQ_SESSION_EXCHANGE, exchange_type='fanout', durable=True)
+
+        # Declare the queues of the listener stages, so that jobs published before a stage has started are kept
+        self.channel.exchange_declare(exchange=config.MQ_EXCHANGE, exchange_type='direct', durable=True)
+        for queue in (config.MQ_TO_LISTENER, config.MQ_TO_AVATAR):
+            self.channel.queue_declare(queue=queue, durable=True)
+            self.channel.queue_bind(queue=queue, exchange=config.MQ_EXCHANGE, routing_key=queue)
+
+        # In transaction mode, ACKs on the consuming channel would become transactional too. Use a separate
+        # channel for publishing.
+        if config.MQ_PUBLISH_TRANSACTIONS:
+            self.publish_channel = self.connection.channel()
+            self.publish_channel.tx_select()
+        else:
+            self.publish_channel = self.channel
         log.info("MQ: Connected")
 
     def is_closed(self):
         return self.connection.is_closed
 
     def publish(self, message):
-        self.channel.basic_publish(
-            exchange=config.MQ_EXCHANGE,
-            routing_key=config.MQ_FROM_LISTENER,
-            body=ujson.dumps(message, ensure_ascii=False),
-            properties=BasicProperties(
-                content_type="application/json",
-                delivery_mode=2))
-
-    def consume(self):
-        return self.channel.consume(config.MQ_TO_LISTENER, no_ack=False, inactivity_timeout=0.1)
+        self.publish_many([message])
+
+    def publish_many(self, messages):
+        """ Publish a batch of messages
+
+        All messages are serialized before anything is sent. If MQ_PUBLISH_TRANSACTIONS is enabled, the whole batch
+        is committed as a single AMQP transaction, so the broker confirms the batch once instead of every message.
+        """
+        bodies = []
+        for message in messages:
+            routing = get_routing(message['head'])
+            if not routing:
+                log.warning(u"MQ: Dropping message without a node ID: %s", message['head'])
+                continue
+            bodies.append((routing, ujson.dumps(message, ensure_ascii=False)))
+        for (exchange, routing_key), body in bodies:
+            self.publish_channel.basic_publish(
+                exchange=exchange,
+                routing_key=routing_key,
+                body=body,
+                properties=MESSAGE_PROPERTIES)
+        if config.MQ_PUBLISH_TRANSACTIONS:
+            self.publish_channel.tx_commit()
+
+    def start_consumer(self, callback):
+        self.consumer_tag = self.channel.basic_consume(callback, self.queue, no_ack=False)
+
+    def start_session_consumer(self, callback):
+        """ Consumes session invalidations from other listener processes through a queue of this connection only """
+        result = self.channel.queue_declare(queue='', exclusive=True, auto_delete=True)
+        queue = result.method.queue
+        self.channel.queue_bind(queue=queue, exchange=config.MQ_SESSION_EXCHANGE)
+        self.session_consumer_tag = self.channel.basic_consume(callback, queue, no_ack=True)
+
+    def process_events(self, time_limit=None):
+        """ Blocks until there is something to do or time_limit runs out, and dispatches all pending callbacks """
+        self.connection.process_data_events(time_limit=time_limit)
+
+    def call_threadsafe(self, callback):
+        """ Schedules a callback to be run in the connection thread. This may be called from any thread. """
+        if self.connection and self.connection.is_open:
+            self.connection.add_callback_threadsafe(callback)
+
+    def wakeup(self):
+        """ Wakes up process_events() from any thread """
+        self.call_threadsafe(lambda: None)
 
     def cancel_consumer(self):
-        self.channel.cancel()
+        if self.consumer_tag:
+            self.channel.basic_cancel(self.consumer_tag)
+            self.consumer_tag = None
 
     def ack(self, tag):
         self.channel.basic_ack(tag)
@@ -66,8 +150,23 @@ class MQConnectionMock(object):
     def publish(self, message):
         self.message_log.append(message)
 
-    def consume(self):
-        return []
+    def publish_many(self, messages):
+        self.message_log.extend(messages)
+
+    def start_consumer(self, callback):
+        pass
+
+    def start_session_consumer(self, callback):
+        pass
+
+    def process_events(self, time_limit=None):
+        pass
+
+    def call_threadsafe(self, callback):
+        callback()
+
+    def wakeup(self):
+        pass
 
     def cancel_consumer(self):
         pass
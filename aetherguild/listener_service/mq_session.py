@@ -6,8 +6,9 @@ log = logging.getLogger(__name__)
 
 
 class MQSession(object):
-    def __init__(self, mq_connection):
+    def __init__(self, mq_connection, node_id=None):
         self.mq_connection = mq_connection
+        self.node_id = node_id
         self.is_transaction = False
         self.messages = []
 
@@ -37,8 +38,8 @@ class MQSession(object):
         """
         Publish all messages in transaction queue
         """
-        for message in self.messages:
-            self.mq_connection.publish(message)
+        if self.messages:
+            self.mq_connection.publish_many(self.messages)
 
     def publish(self, message, connection_id=None, broadcast=False, avoid_self=False, is_control=False, req_level=0):
         """ Publish a message to the outgoing queue
@@ -52,6 +53,7 @@ class MQSession(object):
         data = {
             'head': {
                 'connection_id': connection_id,
+                'node_id': self.node_id,
                 'avoid_self': avoid_self,
                 'broadcast': broadcast,
                 'is_control': is_control,
@@ -64,5 +66,49 @@ class MQSession(object):
         else:
             self.mq_connection.publish(data)
 
+    def publish_job(self, queue, job, connection_id=None, receipt_id=None, route=None):
+        """ Publish a job for another listener stage
+
+        :param queue: Name of the queue of the stage, eg. config.MQ_TO_AVATAR
+        :param job: Job contents
+        :param connection_id: ID of the connection that should get the reply
+        :param receipt_id: Receipt ID of the original request
+        :param route: Route of the original request
+        """
+        data = {
+            'head': {
+                'queue': queue,
+                'connection_id': connection_id,
+                'node_id': self.node_id,
+                'receipt': receipt_id,
+                'route': route
+            },
+            'body': job
+        }
+        if self.is_transaction:
+            self.messages.append(data)
+        else:
+            self.mq_connection.publish(data)
+
+    def publish_session_invalidation(self, session_keys, user_ids):
+        """ Tell every listener process to drop sessions from its session cache
+
+        :param session_keys: Keys of the invalidated sessions
+        :param user_ids: IDs of the users whose sessions were all invalidated
+        """
+        data = {
+            'head': {
+                'invalidate_sessions': True
+            },
+            'body': {
+                'session_keys': session_keys,
+                'user_ids': user_ids
+            }
+        }
+        if self.is_transaction:
+            self.messages.append(data)
+        else:
+            self.mq_connection.publish(data)
+
     def close(self):
         self.messages = []
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.hash import pbkdf2_sha512
+
+log = logging.getLogger(__name__)
+
+# Verified against when the user does not exist, so that a failed login costs the same either way
+DUMMY_HASH = '$pbkdf2-sha512$25000$/d8bg5CSUuq9lxLCmPNeCw$v8i0AT1iLaj77KSY15JwjzGX/JY.RvZJACYqGO96gRdGX.8TicEfEi' \
+             'dec/1zfuWh961kqav0osbPglBV/z.F6Q'
+
+_pool = None
+_slots = None
+
+
+class PasswordQueueFull(Exception):
+    """ Raised when the password hashing pool already has as many jobs as it is allowed to queue """
+    pass
+
+
+def _hash(password):
+    return pbkdf2_sha512.encrypt(password)
+
+
+def _verify(password, password_hash):
+    return pbkdf2_sha512.verify(password, password_hash)
+
+
+def start_pool(processes, max_pending):
+    """ Starts a process pool for hashing and verifying passwords
+
+    pbkdf2 with 25000 rounds keeps a CPU busy for tens of milliseconds, holding the GIL for all of it. Running it in
+    separate processes means only the thread waiting for the result is blocked, and other worker threads keep
+    handling messages. At most max_pending jobs may be queued or running at a time; after that, PasswordQueueFull is
+    raised instead of letting a burst of logins pile up. Without a pool, passwords are hashed in the calling thread.
+    """
+    global _pool, _slots
+    _pool = ProcessPoolExecutor(max_workers=processes)
+    _slots = threading.BoundedSemaphore(max_pending)
+    log.info(u"Password hashing pool started with %d processes", processes)
+
+
+def stop_pool():
+    global _pool, _slots
+    if _pool:
+        _pool.shutdown()
+        _pool = None
+        _slots = None
+        log.info(u"Password hashing pool stopped")
+
+
+def _run(func, *args):
+    if not _pool:
+        return func(*args)
+    if not _slots.acquire(blocking=False):
+        raise PasswordQueueFull()
+    try:
+        return _pool.submit(func, *args).result()
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    return _run(_hash, password)
+
+
+def verify_password(password, password_hash):
+    return _run(_verify, password, password_hash)
+
+
+class LoginRateLimiter(object):
+    """ In-process limiter for login attempts
+
+    Counts failed login attempts per remote IP address, and per username from each remote IP address, in fixed
+    windows of window seconds. Once either count reaches its limit, further attempts are refused until the window is
+    over. Only failed attempts from the same address count against a username, so that nobody can lock another user
+    out of their account. Limits of 0 disable the check. Counts are kept per listener process, so with several
+    processes the effective limits are multiplied. Safe to use from several worker threads.
+    """
+    def __init__(self, ip_limit=20, username_limit=5, window=60, max_size=10000):
+        self.ip_limit = ip_limit
+        self.username_limit = username_limit
+        self.window = window
+        self.max_size = max_size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def _get(self, key, now):
+        window_start, count = self.entries.get(key, (now, 0))
+        if window_start + self.window <= now:
+            return now, 0
+        return window_start, count
+
+    def _add(self, key, now):
+        window_start, count = self._get(key, now)
+        self.entries[key] = (window_start, count + 1)
+        return count
+
+    def _prune(self, now):
+        if len(self.entries) > self.max_size:
+            for key in [k for k, v in self.entries.items() if v[0] + self.window <= now]:
+                del self.entries[key]
+
+    def allow(self, remote_ip, username):
+        """ Returns False if a login attempt should be refused """
+        now = time.monotonic()
+        with self.lock:
+            self._prune(now)
+            if remote_ip and self.ip_limit and self._get(('ip', remote_ip), now)[1] >= self.ip_limit:
+                return False
+            if self.username_limit and self._get(('username', remote_ip, username), now)[1] >= self.username_limit:
+                return False
+        return True
+
+    def add_failure(self, remote_ip, username):
+        """ Records a failed login attempt for the username from the remote IP """
+        now = time.monotonic()
+        with self.lock:
+            if remote_ip and self.ip_limit:
+                self._add(('ip', remote_ip), now)
+            if self.username_limit:
+                self._add(('username', remote_ip, username), now)
+
+    def reset(self, remote_ip, username):
+        """ Forgets the failed attempts for a username from the remote IP, eg. after a successful login """
+        with self.lock:
+            self.entries.pop(('username', remote_ip, username), None)
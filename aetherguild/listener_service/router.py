@@ -2,37 +2,56 @@
 
 import logging
 from copy import copy
-from cerberus import Validator
 
+from aetherguild.listener_service.handlers.basehandler import ValidatorCache
 from aetherguild.listener_service.handlers.authhandler import AuthHandler
 from aetherguild.listener_service.handlers.forumhandler import ForumHandler
 from aetherguild.listener_service.handlers.adminhandler import AdminHandler
 from aetherguild.listener_service.handlers.newshandler import NewsHandler
-from aetherguild.listener_service.user_session import UserSession
+from aetherguild.listener_service.user_session import UserSession, SessionCache
 from aetherguild.listener_service.mq_session import MQSession
 from aetherguild.listener_service.schemas.base import base_request
+from aetherguild import config
 
 log = logging.getLogger(__name__)
 
+base_request_validators = ValidatorCache(base_request)
+
+HANDLERS = {
+    'auth': AuthHandler,
+    'forum': ForumHandler,
+    'admin': AdminHandler,
+    'news': NewsHandler,
+}
+
+
+def build_route_table(handlers=None):
+    """ Builds a dict of full route (eg. 'forum.get_threads') -> Route for all handlers
+    :param handlers: Dict of route prefix -> handler class. Defaults to all handlers.
+    """
+    routes = {}
+    for prefix, handler in (handlers or HANDLERS).items():
+        routes.update(handler.get_route_table(prefix))
+    return routes
+
 
 class MessageRouter(object):
-    def __init__(self, db_connection, mq_connection):
+    def __init__(self, db_connection, mq_connection, activity=None):
         self.db_connection = db_connection
         self.mq_connection = mq_connection
-        self.handlers = {
-            'auth': AuthHandler,
-            'forum': ForumHandler,
-            'admin': AdminHandler,
-            'news': NewsHandler,
-            None: None
-        }
+        self.activity = activity
+        self.routes = build_route_table()
+        self.session_cache = None
+        if config.SESSION_CACHE_TTL > 0:
+            self.session_cache = SessionCache(max_size=config.SESSION_CACHE_SIZE, ttl=config.SESSION_CACHE_TTL)
 
     def handle(self, head, body):
         connection_id = head['connection_id']
+        node_id = head.get('node_id')
         session_key = head.get('session_key')
 
         # Validate the incoming base message first
-        v = Validator(base_request)
+        v = base_request_validators.get()
         if not v.validate(body):
             error_data = {
                 'error': True,
@@ -45,59 +64,74 @@ class MessageRouter(object):
                 error_data['receipt'] = body['receipt']
             if body.get('route'):
                 error_data['route'] = body['route']
-            MQSession(self.mq_connection).publish(error_data, connection_id=connection_id)
+            MQSession(self.mq_connection, node_id=node_id).publish(error_data, connection_id=connection_id)
             log.warning(u"MessageRouter: Invalid packet received from %s", connection_id)
             return
 
         # Sort out some vars
         full_route = copy(body['route'])
-        track_route = full_route.split('.')
         receipt_id = copy(body.get('receipt'))
 
-        # Select a correct handler according to the first entry in the route
-        r = track_route.pop(0)
+        # Find the handler for the route
         try:
-            handler = self.handlers[r]
+            route = self.routes[full_route]
         except KeyError:
+            if receipt_id:
+                MQSession(self.mq_connection, node_id=node_id).publish({
+                    'error': True,
+                    'receipt': receipt_id,
+                    'route': full_route,
+                    'data': {
+                        'error_code': 404,
+                        'error_messages': [{'message': u'Route not found'}]
+                    }
+                }, connection_id=connection_id)
             log.warning(u"MessageRouter: No handler found for packet route %s.", full_route)
             return
 
-        # If handler for the route was found, use it.
-        if handler:
-            log.info(u"MessageRouter: Packet route %s => %s", full_route, handler.__name__)
-
-            # Start a database session and transaction
-            db_session = self.db_connection.get_session()
-
-            # Start an MQ session and transaction
-            mq_session = MQSession(self.mq_connection)
-            mq_session.begin()
-
-            # Find a User session from database matching users session key
-            user_session = UserSession(db_session, session_key)
-
-            # Attempt to handle operation. If success, commit transactions. If failure, send fail packet and rollback.
-            try:
-                o = handler(db_session, mq_session, user_session, connection_id, receipt_id, full_route)
-                o.handle(track_route, body)
-                db_session.commit()
-                mq_session.commit()
-            except:
-                db_session.rollback()
-                mq_session.rollback()
-                if receipt_id:
-                    mq_session.publish({
-                        'error': True,
-                        'receipt': receipt_id,
-                        'route': full_route,
-                        'data': {
-                            'error_code': 500,
-                            'error_messages': [{'message': u'Server error'}]
-                        }
-                    }, connection_id=connection_id)
-                    log.exception("Server error while running message handler")
-                raise
-            finally:
-                user_session.close()
-                db_session.close()
-                mq_session.close()
+        log.info(u"MessageRouter: Packet route %s => %s", full_route, route.handler.__name__)
+
+        # Start a database session and transaction
+        db_session = self.db_connection.get_session()
+
+        # Start an MQ session and transaction
+        mq_session = MQSession(self.mq_connection, node_id=node_id)
+        mq_session.begin()
+
+        # Find a User session from database matching users session key
+        user_session = UserSession(db_session, session_key, cache=self.session_cache, activity=self.activity)
+
+        # Attempt to handle operation. If success, commit transactions. If failure, send fail packet and rollback.
+        try:
+            o = route.handler(
+                db_session, mq_session, user_session, connection_id, receipt_id, full_route, head.get('remote_ip'))
+            route.method(o, [], body)
+            db_session.commit()
+
+            # Sessions are dropped from the caches of all listener processes only once their deletion has been
+            # committed. Otherwise a concurrent lookup could read the session before the deletion and cache it again.
+            if user_session.has_invalidations():
+                user_session.apply_invalidations()
+                if self.session_cache:
+                    mq_session.publish_session_invalidation(
+                        user_session.invalidated_keys, user_session.invalidated_users)
+            mq_session.commit()
+        except:
+            db_session.rollback()
+            mq_session.rollback()
+            if receipt_id:
+                mq_session.publish({
+                    'error': True,
+                    'receipt': receipt_id,
+                    'route': full_route,
+                    'data': {
+                        'error_code': 500,
+                        'error_messages': [{'message': u'Server error'}]
+                    }
+                }, connection_id=connection_id)
+                log.exception("Server error while running message handler")
+            raise
+        finally:
+            user_session.close()
+            db_session.close()
+            mq_session.close()
@@ -17,6 +17,16 @@ get_threads_request = {
         'required': False,
         'min': 0
     },
+    'after': {
+        'type': 'string',
+        'required': False,
+        'excludes': ['before', 'start']
+    },
+    'before': {
+        'type': 'string',
+        'required': False,
+        'excludes': ['after', 'start']
+    },
     'board': {
         'type': 'integer',
         'required': True
@@ -34,6 +44,16 @@ get_posts_request = {
         'required': False,
         'min': 0
     },
+    'after': {
+        'type': 'string',
+        'required': False,
+        'excludes': ['before', 'start']
+    },
+    'before': {
+        'type': 'string',
+        'required': False,
+        'excludes': ['after', 'start']
+    },
     'thread': {
         'type': 'integer',
         'required': True
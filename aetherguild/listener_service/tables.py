@@ -5,10 +5,12 @@ import ujson
 
 import bleach
 import arrow
-from sqlalchemy import Column, Integer, ForeignKey, DateTime, Text, Boolean, UniqueConstraint, Binary, Index, Unicode
+from sqlalchemy import Column, Integer, ForeignKey, DateTime, Text, Boolean, UniqueConstraint, Binary, Index, Unicode,\
+    select, func, and_
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
 
-from aetherguild.common.utils import generate_random_key
+from aetherguild.common.utils import generate_random_key, format_datetime
 from aetherguild import config
 
 Base = declarative_base()
@@ -56,14 +58,18 @@ class User(Base, ModelHelperMixin):
     profile_data = Column(Text, default=u'{}', nullable=False)
     deleted = Column(Boolean, default=False, nullable=False)
 
+    # Loaded along with the user, since it is needed whenever the user is serialized
+    avatar_file = relationship('File', lazy='joined')
+
     def serialize(self, include_username=False, include_deleted=False, include_profile=False):
         out = {
             'id': self.id,
             'avatar': File.format_public_path(self.avatar),
+            'avatar_variants': self.avatar_file.get_variants() if self.avatar_file else None,
             'nickname': self.nickname,
             'level': self.level,
-            'created_at': arrow.get(self.created_at).isoformat(),
-            'last_contact': arrow.get(self.last_contact).isoformat()
+            'created_at': format_datetime(self.created_at),
+            'last_contact': format_datetime(self.last_contact)
         }
         if include_profile:
             out['profile_data'] = ujson.loads(self.profile_data)
@@ -85,21 +91,74 @@ class Session(Base, ModelHelperMixin):
     def serialize(self):
         return {
             'session_key': self.session_key,
-            'created_at': arrow.get(self.created_at).isoformat(),
-            'activity_at': arrow.get(self.activity_at).isoformat(),
+            'created_at': format_datetime(self.created_at),
+            'activity_at': format_datetime(self.activity_at),
             'user': self.user
         }
 
 
 class File(Base, ModelHelperMixin):
+    """ Uploaded file
+
+    Files with a content_hash are content addressed: the key is formed from the hash, and a file with the same content
+    is only stored once. Avatars are stored like this, along with their resized variants (see get_variants).
+    """
     __tablename__ = "file"
     id = Column(Integer, primary_key=True)
     key = Column(Unicode(32), unique=True, nullable=False)
+    content_hash = Column(Unicode(64), unique=True, nullable=True)
     created_at = Column(DateTime(timezone=True), default=utc_now, nullable=False)
 
+    # Dimensions of the stored (full size) image, and whether WebP variants were stored. Not known for older files.
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    webp = Column(Boolean, default=False, nullable=False)
+
+    # Length of the hash part of content addressed keys
+    CONTENT_KEY_LENGTH = 24
+
     def __init__(self, ext, *args, **kwargs):
-        self.key = u"{}.{}".format(generate_random_key()[:16], ext)
         super(File, self).__init__(*args, **kwargs)
+        if self.content_hash:
+            self.key = u"{}.{}".format(self.content_hash[:self.CONTENT_KEY_LENGTH], ext)
+        else:
+            self.key = u"{}.{}".format(generate_random_key()[:16], ext)
+
+    @classmethod
+    def is_content_key(cls, key):
+        base = key.rsplit('.', 1)[0]
+        return len(base) == cls.CONTENT_KEY_LENGTH and all(c in '0123456789abcdef' for c in base)
+
+    @staticmethod
+    def format_variant_name(key, size=None, ext=None):
+        """ Returns the filename of a resized and/or WebP variant of a file """
+        base, key_ext = key.rsplit('.', 1)
+        if size:
+            base = u"{}_{}".format(base, size)
+        return u"{}.{}".format(base, ext or key_ext)
+
+    def get_variants(self):
+        """ Returns public paths for the resized variants of a content addressed avatar, smallest first
+
+        The full size avatar is the last variant. Images are never scaled up, so the size of a variant is the longer
+        side of the full size image if that is smaller, or None if the dimensions of the file are not known. Files
+        that are not content addressed don't have variants.
+        """
+        if not self.is_content_key(self.key):
+            return None
+        full_size = max(self.width, self.height) if self.width and self.height else None
+        sizes = [(min(size, full_size) if full_size else None, size) for size in config.AVATAR_VARIANT_SIZES]
+        sizes.append((full_size, None))
+        out = []
+        for size, name_size in sizes:
+            variant = {
+                'size': size,
+                'url': self.format_public_path(self.format_variant_name(self.key, name_size))
+            }
+            if self.webp:
+                variant['webp_url'] = self.format_public_path(self.format_variant_name(self.key, name_size, 'webp'))
+            out.append(variant)
+        return out
 
     @staticmethod
     def format_local_path(filename):
@@ -123,7 +182,7 @@ class File(Base, ModelHelperMixin):
         return {
             'id': self.id,
             'key': self.key,
-            'created_at': arrow.get(self.created_at).isoformat()
+            'created_at': format_datetime(self.created_at)
         }
 
 
@@ -142,7 +201,7 @@ class NewsItem(Base, ModelHelperMixin):
             'nickname': self.nickname,
             'header': self.header,
             'message': self.message,
-            'created_at': arrow.get(self.created_at).isoformat()
+            'created_at': format_datetime(self.created_at)
         }
 
 
@@ -170,6 +229,26 @@ class ForumBoard(Base, ModelHelperMixin):
     req_level = Column(Integer, default=0, nullable=False)
     sort_index = Column(Integer, default=0, nullable=False)
     deleted = Column(Boolean, default=False, nullable=False)
+    posts_count = Column(Integer, default=0, nullable=False)
+    threads_count = Column(Integer, default=0, nullable=False)
+    last_post = Column(ForeignKey('forum_post.id', use_alter=True, name='forum_board_last_post_fkey'), nullable=True)
+
+    @classmethod
+    def refresh_counters(cls, session, board_id=None):
+        """ Recalculates posts_count, threads_count and last_post from the threads of the board
+
+        Thread counters must be up to date before calling this. If board_id is None, all boards are refreshed.
+        """
+        thread_filter = and_(ForumThread.board == cls.id, ForumThread.deleted == False)
+        query = session.query(cls)
+        if board_id is not None:
+            query = query.filter(cls.id == board_id)
+        query.update({
+            cls.posts_count: select([func.coalesce(func.sum(ForumThread.posts_count), 0)])
+                .where(thread_filter).as_scalar(),
+            cls.threads_count: select([func.count(ForumThread.id)]).where(thread_filter).as_scalar(),
+            cls.last_post: select([func.max(ForumThread.last_post)]).where(thread_filter).as_scalar()
+        }, synchronize_session=False)
 
     def serialize(self):
         return {
@@ -191,10 +270,30 @@ class ForumThread(Base, ModelHelperMixin):
     created_at = Column(DateTime(timezone=True), default=utc_now, nullable=False)
     updated_at = Column(DateTime(timezone=True), default=utc_now, nullable=False, index=True)
     views = Column(Integer, default=0, nullable=False)
-    sticky = Column(Boolean, default=False, nullable=False, index=True)
+    sticky = Column(Boolean, default=False, nullable=False)
     closed = Column(Boolean, default=False, nullable=False)
     deleted = Column(Boolean, default=False, nullable=False)
-    Index("desc_sort_index", 'sticky', 'updated_at')
+    posts_count = Column(Integer, default=0, nullable=False)
+    last_post = Column(ForeignKey('forum_post.id', use_alter=True, name='forum_thread_last_post_fkey'), nullable=True)
+    __table_args__ = (
+        # Thread listing for a board, see ForumHandler.get_threads
+        Index('ix_forum_thread_board_listing', 'board', 'deleted', 'sticky', 'updated_at', 'id'),
+    )
+
+    @classmethod
+    def refresh_counters(cls, session, thread_id=None):
+        """ Recalculates posts_count and last_post from the posts of the thread
+
+        If thread_id is None, all threads are refreshed.
+        """
+        post_filter = and_(ForumPost.thread == cls.id, ForumPost.deleted == False)
+        query = session.query(cls)
+        if thread_id is not None:
+            query = query.filter(cls.id == thread_id)
+        query.update({
+            cls.posts_count: select([func.count(ForumPost.id)]).where(post_filter).as_scalar(),
+            cls.last_post: select([func.max(ForumPost.id)]).where(post_filter).as_scalar()
+        }, synchronize_session=False)
 
     def serialize(self):
         return {
@@ -202,7 +301,7 @@ class ForumThread(Base, ModelHelperMixin):
             'board': self.board,
             'user': self.user,
             'title': self.title,
-            'created_at': arrow.get(self.created_at).isoformat(),
+            'created_at': format_datetime(self.created_at),
             'views': self.views,
             'sticky': self.sticky,
             'closed': self.closed
@@ -217,21 +316,28 @@ class ForumPost(Base, ModelHelperMixin):
     message = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), default=utc_now, nullable=False, index=True)
     deleted = Column(Boolean, default=False, nullable=False)
+    __table_args__ = (
+        # Post listing for a thread, see ForumHandler.get_posts
+        Index('ix_forum_post_thread_listing', 'thread', 'deleted', 'created_at', 'id'),
+    )
 
-    def serialize(self):
-        return {
+    def serialize(self, edits=None):
+        out = {
             'id': self.id,
             'thread': self.thread,
             'user': self.user,
             'message': self.message,
-            'created_at': arrow.get(self.created_at).isoformat()
+            'created_at': format_datetime(self.created_at)
         }
+        if edits is not None:
+            out['edits'] = edits
+        return out
 
 
 class ForumPostEdit(Base, ModelHelperMixin):
     __tablename__ = "forum_edit"
     id = Column(Integer, primary_key=True)
-    post = Column(ForeignKey('forum_post.id'), nullable=False)
+    post = Column(ForeignKey('forum_post.id'), nullable=False, index=True)
     user = Column(ForeignKey('new_user.id'), nullable=False)
     message = Column(Text, nullable=True)
     created_at = Column(DateTime(timezone=True), default=utc_now, nullable=False)
@@ -242,7 +348,7 @@ class ForumPostEdit(Base, ModelHelperMixin):
             'post': self.post,
             'user': self.user,
             'message': self.message,
-            'created_at': arrow.get(self.created_at).isoformat()
+            'created_at': format_datetime(self.created_at)
         }
 
 
@@ -252,12 +358,14 @@ class ForumLastRead(Base, ModelHelperMixin):
     thread = Column(ForeignKey('forum_thread.id'), nullable=False)
     user = Column(ForeignKey('new_user.id'), nullable=False)
     created_at = Column(DateTime(timezone=True), default=utc_now, nullable=False)
-    UniqueConstraint('thread', 'user', name='unique_thread_user_constraint')
+    __table_args__ = (
+        UniqueConstraint('user', 'thread', name='unique_user_thread_constraint'),
+    )
 
     def serialize(self):
         return {
             'id': self.id,
             'thread': self.thread,
             'user': self.user,
-            'created_at': arrow.get(self.created_at).isoformat()
+            'created_at': format_datetime(self.created_at)
         }
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 
 from aetherguild.listener_service.tables import User, Session
-from sqlalchemy.orm.exc import NoResultFound
 
 log = logging.getLogger(__name__)
 
@@ -12,33 +14,137 @@ LEVEL_GUEST = 0
 LEVEL_USER = 1
 LEVEL_ADMIN = 2
 
+CachedSession = namedtuple('CachedSession', ['session_id', 'user_id', 'level', 'expires_at'])
+
+
+class SessionCache(object):
+    """ In-process LRU cache for valid sessions
+
+    Maps session keys to session ID, user ID and user level, so that the session and user rows don't need to be
+    looked up for every message. Entries expire after ttl seconds, which bounds how long changes made outside the
+    listeners (eg. by manage_users) can go unnoticed. Sessions that handlers log out or delete are invalidated
+    explicitly, in every listener process, once the change has been committed.
+
+    Every invalidation bumps the cache version. A lookup that started before an invalidation may have read the
+    session before it was deleted, so set() ignores entries read with an older version. Safe to use from several
+    worker threads.
+    """
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def get(self, session_key):
+        with self.lock:
+            entry = self.entries.get(session_key)
+            if entry is None:
+                return None
+            if entry.expires_at < time.monotonic():
+                del self.entries[session_key]
+                return None
+            self.entries.move_to_end(session_key)
+            return entry
+
+    def set(self, session_key, session_id, user_id, level, version=None):
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self.entries[session_key] = CachedSession(session_id, user_id, level, time.monotonic() + self.ttl)
+            self.entries.move_to_end(session_key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, session_key):
+        self.invalidate_many([session_key], [])
+
+    def invalidate_user(self, user_id):
+        self.invalidate_many([], [user_id])
+
+    def invalidate_many(self, session_keys, user_ids):
+        """ Drops the given sessions and all sessions of the given users """
+        with self.lock:
+            self.version += 1
+            for session_key in session_keys:
+                self.entries.pop(session_key, None)
+            if user_ids:
+                for session_key in [k for k, v in self.entries.items() if v.user_id in user_ids]:
+                    del self.entries[session_key]
+
+    def clear(self):
+        with self.lock:
+            self.version += 1
+            self.entries.clear()
+
 
 class UserSession(object):
-    def __init__(self, db_session, session_key):
+    def __init__(self, db_session, session_key, cache=None, activity=None):
         self.db = db_session
-        self.user = None
-        self.session = None
+        self.cache = cache
+        self.activity = activity
+        self.session_key = session_key
+        self.session_id = None
+        self.user_id = None
+        self.level = LEVEL_GUEST
+        self._session = None
+        self._user = None
+        self.invalidated_keys = []
+        self.invalidated_users = []
+
+        if not session_key:
+            return
 
-        # Looks for existing session if session_key is not None
-        if session_key:
-            try:
-                self.session = Session.get_one(db_session, session_key=session_key)
-            except NoResultFound:
-                pass
+        # Use cached session information if we have it
+        cached = cache.get(session_key) if cache else None
+        if cached:
+            self.session_id = cached.session_id
+            self.user_id = cached.user_id
+            self.level = cached.level
+            return
+        cache_version = cache.version if cache else None
+
+        # Looks for existing session
+        self._session = Session.get_one_or_none(db_session, session_key=session_key)
 
         # Find user associated with the session. If no user exists, then invalidate the session too.
-        if self.session:
-            try:
-                self.user = User.get_one(db_session, id=self.session.user, deleted=False)
-            except NoResultFound:
+        if self._session:
+            self._user = User.get_one_or_none(db_session, id=self._session.user, deleted=False)
+            if self._user:
+                self.session_id = self._session.id
+                self.user_id = self._user.id
+                self.level = self._user.level
+                if cache:
+                    cache.set(session_key, self.session_id, self.user_id, self.level, version=cache_version)
+            else:
                 Session.delete(db_session, session_key=session_key)
-                self.session = None
+                self._session = None
+
+    @property
+    def session(self):
+        """ Session database object. Loaded on first use if the session came from the cache. """
+        if self._session is None and self.session_id is not None:
+            self._session = Session.get_one_or_none(self.db, id=self.session_id)
+        return self._session
+
+    @property
+    def user(self):
+        """ User database object. Loaded on first use if the session came from the cache. If the user has been
+        deleted since the session was cached, the session is no longer valid.
+        """
+        if self._user is None and self.user_id is not None:
+            self._user = User.get_one_or_none(self.db, id=self.user_id, deleted=False)
+            if self._user is None:
+                if self.cache:
+                    self.cache.invalidate(self.session_key)
+                self.session_id = None
+                self.user_id = None
+                self.level = LEVEL_GUEST
+        return self._user
 
     def is_valid(self):
         """ Checks if this is a valid session for authenticated user """
-        return self.session is not None \
-            and self.user is not None \
-            and not self.user.deleted
+        return self.session_id is not None and self.user_id is not None
 
     def has_level(self, level):
         """ Checks if the user has required userlevel """
@@ -46,20 +152,40 @@ class UserSession(object):
 
     def get_level(self):
         """ Returns the level of the user for this session """
-        if not self.user:
+        if self.user_id is None:
             return LEVEL_GUEST
-        return self.user.level
+        return self.level
 
     def invalidate(self):
-        """ Invalidates the current session """
-        if self.session:
-            Session.delete(self.db, id=self.session.id)
+        """ Invalidates the current session. The cache is updated by apply_invalidations() after commit. """
+        if self.session_id is not None:
+            Session.delete(self.db, id=self.session_id)
+        if self.session_key:
+            self.invalidated_keys.append(self.session_key)
+
+    def invalidate_user(self, user_id):
+        """ Invalidates all sessions of the given user. The cache is updated by apply_invalidations() after commit. """
+        Session.delete(self.db, user=user_id)
+        self.invalidated_users.append(user_id)
+
+    def has_invalidations(self):
+        return bool(self.invalidated_keys or self.invalidated_users)
+
+    def apply_invalidations(self):
+        """ Drops the invalidated sessions from the cache. Must be called only after the deletions are committed,
+        so that no other worker can read the deleted sessions and cache them again.
+        """
+        if self.cache and self.has_invalidations():
+            self.cache.invalidate_many(self.invalidated_keys, self.invalidated_users)
 
     def close(self):
-        """ Close session object. Note! Does db commit! """
-        if self.session:
-            self.db.query(Session).filter_by(id=self.session.id).update({'activity_at': datetime.utcnow()})
-        if self.user:
-            self.db.query(User).filter_by(id=self.user.id).update({'last_contact': datetime.utcnow()})
-        if self.session or self.user:
+        """ Close session object. Note! Does db commit, unless an activity tracker is used! """
+        if self.activity:
+            self.activity.touch(self.session_id, self.user_id)
+            return
+        if self.session_id is not None:
+            self.db.query(Session).filter_by(id=self.session_id).update({'activity_at': datetime.utcnow()})
+        if self.user_id is not None:
+            self.db.query(User).filter_by(id=self.user_id).update({'last_contact': datetime.utcnow()})
+        if self.session_id is not None or self.user_id is not None:
             self.db.commit()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import queue
+import threading
+import zlib
+
+from aetherguild.listener_service.router import MessageRouter
+
+log = logging.getLogger(__name__)
+
+
+class MQConnectionProxy(object):
+    """ Stand-in for MQConnection that is handed to the worker threads
+
+    Pika channels must only be touched from the thread that owns the connection. Instead of publishing directly,
+    workers push their outgoing operations to a result queue, which is then drained on the channel thread.
+    """
+    def __init__(self, results):
+        self.results = results
+
+    def publish(self, message):
+        self.publish_many([message])
+
+    def publish_many(self, messages):
+        self.results.put((None, 'publish', messages))
+
+
+class Worker(threading.Thread):
+    def __init__(self, index, router, results, notify):
+        super(Worker, self).__init__(name='listener-worker-{}'.format(index), daemon=True)
+        self.router = router
+        self.results = results
+        self.notify = notify
+        self.queue = queue.Queue()
+        self.submitted = 0
+        self.peak_depth = 0
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            generation, delivery_tag, head, body = item
+            try:
+                self.router.handle(head, body)
+                self.results.put((generation, 'ack', delivery_tag))
+            except Exception as e:
+                self.results.put((generation, 'nack', delivery_tag))
+                log.error(u"Worker: Handler failed for delivery_tag = %s", delivery_tag, exc_info=e)
+            if self.notify:
+                self.notify()
+
+
+class WorkerPool(object):
+    """ Runs message handlers concurrently in a set of worker threads
+
+    Every worker is a shard with its own inbound queue. Packets are assigned to shards by hashing a key from the
+    packet head (connection_id by default, see shard_key). This way packets from a single websocket connection are
+    always handled by the same worker in the order they arrived, while packets from different connections may be
+    handled in parallel. The router opens a separate database session for every packet, so workers never share
+    sessions.
+
+    ACKs, NACKs and publishes are collected to a shared result queue, and must be flushed to the real MQ connection
+    from the thread that owns the pika channel by calling flush(). The optional notify callback is called from the
+    worker thread every time a packet has been handled, and should arrange for flush() to be called.
+    """
+    def __init__(self, db_connection, size, shard_key='connection_id', notify=None, activity=None,
+                 router_class=MessageRouter):
+        self.size = size
+        self.shard_key = shard_key
+        self.notify = notify
+        self.results = queue.Queue()
+        self.router = router_class(db_connection, MQConnectionProxy(self.results), activity=activity)
+        self.workers = []
+        self.generation = 0
+
+    def start(self):
+        self.workers = [Worker(index, self.router, self.results, self.notify) for index in range(self.size)]
+        for worker in self.workers:
+            worker.start()
+        log.info(u"Worker pool started with %d workers", self.size)
+
+    def new_generation(self):
+        """ Marks a new MQ channel. Pending ACKs and NACKs for the old channel are dropped on flush. """
+        self.generation += 1
+
+    def get_shard(self, head):
+        """ Returns the shard index for a packet head
+
+        Packets without the configured key (eg. no session_key before login) fall back to the connection ID. CRC32
+        is used instead of hash(), since string hashes are randomized per process.
+        """
+        key = head.get(self.shard_key) or head.get('connection_id')
+        return zlib.crc32(str(key).encode('utf8')) % self.size
+
+    def submit(self, delivery_tag, head, body):
+        worker = self.workers[self.get_shard(head)]
+        worker.queue.put((self.generation, delivery_tag, head, body))
+        worker.submitted += 1
+        worker.peak_depth = max(worker.peak_depth, worker.queue.qsize())
+
+    def get_stats(self):
+        """ Returns queue statistics for each shard. Peak depth is reset on every call. """
+        stats = []
+        for index, worker in enumerate(self.workers):
+            stats.append({
+                'shard': index,
+                'depth': worker.queue.qsize(),
+                'peak_depth': worker.peak_depth,
+                'submitted': worker.submitted
+            })
+            worker.peak_depth = 0
+        return stats
+
+    def log_stats(self):
+        for stat in self.get_stats():
+            log.info(u"Worker pool: Shard %d depth = %d, peak depth = %d, submitted = %d",
+                     stat['shard'], stat['depth'], stat['peak_depth'], stat['submitted'])
+
+    def flush(self, mq_connection):
+        """ Sends out all pending results. Must be called from the MQ channel thread. """
+        while True:
+            try:
+                generation, op, arg = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if op == 'publish':
+                mq_connection.publish_many(arg)
+            elif generation != self.generation:
+                log.warning(u"MQ: Dropping %s for stale delivery_tag = %s", op.upper(), arg)
+            elif op == 'ack':
+                mq_connection.ack(arg)
+                log.info(u"MQ: ACK delivery_tag = %s", arg)
+            else:
+                mq_connection.nack(arg)
+                log.error(u"MQ: NACK delivery_tag = %s", arg)
+
+    def stop(self):
+        """ Waits for the workers to finish all queued packets and stops them """
+        for worker in self.workers:
+            worker.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        log.info(u"Worker pool stopped")
@@ -2,7 +2,7 @@
 
 import argparse
 
-from listener_service.tables import ForumBoard, ForumSection
+from listener_service.tables import ForumBoard, ForumSection, ForumThread
 import config
 
 import tabulate
@@ -56,6 +56,17 @@ def del_board(a):
     return 0
 
 
+def rebuild_counters(a):
+    s = db_session()
+    ForumThread.refresh_counters(s)
+    ForumBoard.refresh_counters(s)
+    s.commit()
+    s.close()
+
+    print("Board and thread post counts and last posts rebuilt")
+    return 0
+
+
 def list_boards(a):
     s = db_session()
     boards = []
@@ -78,7 +89,7 @@ def list_boards(a):
 
 
 if __name__ == '__main__':
-    ops_choices = ['add', 'delete', 'list']
+    ops_choices = ['add', 'delete', 'list', 'rebuild']
 
     # Form the argument parser (first argument is positional and required)
     parser = argparse.ArgumentParser(description='Manage forum sections for the website')
@@ -100,6 +111,7 @@ if __name__ == '__main__':
     op = {
         'add': add_board,
         'delete': del_board,
-        'list': list_boards
+        'list': list_boards,
+        'rebuild': rebuild_counters
     }[args.operation[0]]
     exit(op(args))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+
+import tabulate
+
+from aetherguild.listener_service.router import build_route_table
+
+LEVEL_NAMES = ['guest', 'user', 'admin']
+
+
+def list_routes(a):
+    routes = build_route_table()
+    rows = []
+    for full_route in sorted(routes):
+        if a.prefix and not full_route.startswith(a.prefix + '.'):
+            continue
+        route = routes[full_route]
+        rows.append([
+            full_route,
+            route.handler.__name__,
+            LEVEL_NAMES[route.level],
+            'yes' if route.authenticated else 'no',
+            ', '.join(sorted(route.schema.keys())) if route.schema else ''])
+    headers = ['Route', 'Handler', 'Level', 'Login', 'Fields']
+    print(tabulate.tabulate(rows, headers, tablefmt="grid"))
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the message routes of the listener service')
+    parser.add_argument('--prefix', type=str, help='Only list routes with this prefix, eg. forum')
+    args = parser.parse_args()
+    exit(list_routes(args))
@@ -5,11 +5,11 @@ from getpass import getpass
 
 from listener_service.tables import User
 import config
+from listener_service.passwords import hash_password
 
 import tabulate
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
-from passlib.hash import pbkdf2_sha512
 
 
 def check_args(a):
@@ -51,7 +51,7 @@ def add_user(a):
     user.username = a.username
     user.nickname = a.nick
     user.level = userlevels_choices.index(a.level)
-    user.password = pbkdf2_sha512.encrypt(a.password)
+    user.password = hash_password(a.password)
 
     s.add(user)
     try:
@@ -99,7 +99,7 @@ def edit_user(a):
         if a.level:
             user.level = userlevels_choices.index(a.level)
         if a.password:
-            user.password = pbkdf2_sha512.encrypt(a.password)
+            user.password = hash_password(a.password)
         s.add(user)
         s.commit()
     except User.NoResultFound:
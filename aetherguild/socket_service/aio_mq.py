@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+
+import aio_pika
+import ujson
+from aetherguild import config
+from aetherguild.common.utils import get_node_queue
+
+log = logging.getLogger(__name__)
+
+
+def install_event_loop(use_uvloop=False):
+    """ Sets up an asyncio event loop (optionally uvloop) and makes Tornado run on top of it
+
+    Must be called before the Tornado IOLoop is used for the first time.
+    """
+    if use_uvloop:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    from tornado.platform.asyncio import AsyncIOMainLoop
+    AsyncIOMainLoop().install()
+
+
+class AioMQConnection(object):
+    """ asyncio based MQ connection of a single socket service node
+
+    Declares, binds, consumes and publishes the same way as MQConnection, but uses aio-pika on the asyncio event loop
+    instead of pika's Tornado adapter. Message handlers may be plain functions or coroutine functions. Reconnecting
+    (and declaring everything again) after a lost connection is handled by aio-pika.
+    """
+    def __init__(self, node_id, msg_handler=None):
+        self.node_id = node_id
+        self.queue_name = get_node_queue(node_id)
+        self.connection = None
+        self.channel = None
+        self.exchange = None
+        self.queue = None
+        self.consumer = None
+        self.connected = False
+        self._closing = False
+        self._outgoing = asyncio.Queue()
+        self._publisher = None
+        self._on_message_handler = msg_handler
+
+    # ------------------------ Connections ------------------------
+
+    def set_msg_handler(self, msg_handler):
+        self._on_message_handler = msg_handler
+
+    def connect(self):
+        asyncio.ensure_future(self._connect())
+
+    async def _connect(self):
+        while not self.connection:
+            try:
+                self.connection = await aio_pika.connect_robust(config.MQ_CONFIG)
+            except Exception as e:
+                log.info(u"MQ: Connection error: %s. Reconnecting.", e)
+                await asyncio.sleep(5)
+        self.channel = await self.connection.channel(publisher_confirms=False)
+        log.info(u"MQ: Connected to AMQP server")
+
+        # Exchanges
+        self.exchange = await self.channel.declare_exchange(
+            config.MQ_EXCHANGE, aio_pika.ExchangeType.DIRECT, durable=True)
+        broadcast_exchange = await self.channel.declare_exchange(
+            config.MQ_BROADCAST_EXCHANGE, aio_pika.ExchangeType.FANOUT, durable=True)
+
+        # Queue for messages going to the listener
+        to_listener = await self.channel.declare_queue(config.MQ_TO_LISTENER, durable=True)
+        await to_listener.bind(self.exchange, config.MQ_TO_LISTENER)
+
+        # Node queue outlives a lost connection, so that replies sent while reconnecting are not lost. Once the node
+        # is gone for good, the broker deletes the queue after SOCKET_QUEUE_EXPIRES seconds.
+        self.queue = await self.channel.declare_queue(
+            self.queue_name, arguments={'x-expires': config.SOCKET_QUEUE_EXPIRES * 1000})
+        await self.queue.bind(self.exchange, self.queue_name)
+        await self.queue.bind(broadcast_exchange)
+        log.info(u"MQ: Queue %s bound to exchanges %s and %s.",
+                 self.queue_name, config.MQ_EXCHANGE, config.MQ_BROADCAST_EXCHANGE)
+
+        self.connected = True
+        self._publisher = asyncio.ensure_future(self._publish_loop())
+        self.consumer = await self.queue.consume(self.on_message)
+        log.info("MQ: Starting consumer for queue %s", self.queue_name)
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            asyncio.ensure_future(self._close())
+
+    async def _close(self):
+        if self.consumer:
+            log.info(u'MQ: Sending RPC Cancel.')
+            await self.queue.cancel(self.consumer)
+        if self._publisher:
+            self._publisher.cancel()
+        if self.connection:
+            await self.connection.close()
+        self.connected = False
+        log.info(u'MQ: Connection closed.')
+        asyncio.get_event_loop().stop()
+
+    def is_connected(self):
+        return self.connected
+
+    # ------------------------ Consumers ------------------------
+
+    async def on_message(self, message):
+        log.info(u"MQ: Queue %s => %s", self.queue_name, message.body)
+        try:
+            data = ujson.loads(message.body.decode('utf8'))
+        except ValueError:
+            await message.reject()
+            log.warning(u"MQ: NACK %s", message.delivery_tag)
+            return
+
+        if self._on_message_handler:
+            try:
+                result = self._on_message_handler(data)
+                if asyncio.iscoroutine(result):
+                    await result
+                await message.ack()
+                log.info(u"MQ: ACK %s", message.delivery_tag)
+            except Exception as e:
+                await message.reject()
+                log.error(u"MQ: NACK %s", message.delivery_tag, exc_info=e)
+        else:
+            await message.ack()
+
+    # ------------------------ Messaging ------------------------
+
+    def publish(self, data):
+        """ Queues a message for publishing. Messages are published in the order they were queued. """
+        data['head']['node_id'] = self.node_id
+        log.info(u"MQ: Queue %s <= %s", config.MQ_TO_LISTENER, data)
+        self._outgoing.put_nowait(ujson.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    async def _publish_loop(self):
+        while True:
+            body = await self._outgoing.get()
+            message = aio_pika.Message(
+                body, content_type="application/json", delivery_mode=aio_pika.DeliveryMode.PERSISTENT)
+            try:
+                await self.exchange.publish(message, routing_key=config.MQ_TO_LISTENER, mandatory=False)
+            except Exception as e:
+                log.error(u"MQ: Unable to publish message", exc_info=e)
@@ -1,40 +1,65 @@
 # -*- coding: utf-8 -*-
 
+import argparse
 import logging
+import multiprocessing
+import os
 import signal
+import socket
 from logging.config import dictConfig
 
-from tornado import web, ioloop
+from tornado import web, ioloop, httpserver, netutil
 
 from aetherguild import config
 from aetherguild.socket_service.wshandler import WsHandler
 from aetherguild.socket_service.mq import MQConnection
 
+log = logging.getLogger(__name__)
 
-if __name__ == '__main__':
-    # Set up the global log
-    dictConfig(config.LOGGING)
-    log = logging.getLogger(__name__)
+
+def run_server(node_id, reuse_port=False, autoreload=True):
+    """ Runs a single socket service process until it is signaled to stop
+
+    Every process has its own IOLoop, websocket connection tables and MQ connection, and nothing is shared between
+    processes. With reuse_port, several processes can listen on the same port, and the kernel spreads new connections
+    between them.
+    """
     log.info("Opening server on %s:%d", config.ADDRESS, config.PORT)
 
+    # With the asyncio transport, Tornado runs on top of the asyncio event loop
+    if config.SOCKET_MQ_TRANSPORT == 'asyncio':
+        from aetherguild.socket_service.aio_mq import AioMQConnection, install_event_loop
+        install_event_loop(use_uvloop=config.SOCKET_USE_UVLOOP)
+
     # Get our ioloop instance
     loop = ioloop.IOLoop.instance()
 
-    # Open up MQ queue connection
-    mq = MQConnection(io_loop=loop)
+    # Open up MQ queue connection. Every socket service process needs an unique node ID.
+    log.info("Using node ID %s", node_id)
+    if config.SOCKET_MQ_TRANSPORT == 'asyncio':
+        mq = AioMQConnection(node_id=node_id)
+    else:
+        mq = MQConnection(io_loop=loop, node_id=node_id)
     mq.connect()
 
     # Set up websocket handler, and set it as a message handler for MQ messages
     ws = WsHandler
     ws.mq = mq
+    ws.max_buffer_size = config.WS_MAX_BUFFER_SIZE
+    ws.slow_client_policy = config.WS_SLOW_CLIENT_POLICY
     mq.set_msg_handler(ws.on_queue_message)
 
+    # Log outbound buffer stats periodically
+    if config.WS_STATS_INTERVAL > 0:
+        ioloop.PeriodicCallback(ws.log_buffer_stats, config.WS_STATS_INTERVAL * 1000).start()
+
     # Index and static handlers
     handlers = [
         (r'/ws', ws),
     ]
     conf = {
         'debug': config.DEBUG,
+        'autoreload': config.DEBUG and autoreload,
     }
 
     def sig_handler(signal, frame):
@@ -45,6 +70,53 @@ if __name__ == '__main__':
 
     # Start up everything
     app = web.Application(handlers, **conf)
-    app.listen(port=config.PORT, address=config.ADDRESS)
+    server = httpserver.HTTPServer(app, xheaders=config.SOCKET_XHEADERS)
+    server.add_sockets(netutil.bind_sockets(config.PORT, address=config.ADDRESS, reuse_port=reuse_port))
     loop.start()
     log.info("Shutting down")
+
+
+def run_supervisor(processes):
+    """ Runs a number of socket service processes on the same port
+
+    Signals received by the supervisor are passed on to the socket service processes, and the supervisor exits once
+    all of them have shut down.
+    """
+    log.info("Starting %d socket service processes", processes)
+    base_id = config.SOCKET_NODE_ID or u'{}-{}'.format(socket.gethostname(), os.getpid())
+    children = [
+        multiprocessing.Process(
+            target=run_server,
+            args=(u'{}-{}'.format(base_id, n),),
+            kwargs={'reuse_port': True, 'autoreload': False},
+            name='socket-{}'.format(n))
+        for n in range(processes)]
+
+    def sig_handler(signal, frame):
+        for child in children:
+            if child.is_alive():
+                child.terminate()
+
+    # Install the handler only once all children have started, so that they don't inherit it
+    for child in children:
+        child.start()
+    signal.signal(signal.SIGINT, sig_handler)
+    signal.signal(signal.SIGTERM, sig_handler)
+
+    for child in children:
+        child.join()
+    log.info(u"All socket service processes stopped. Shutdown.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the websocket service')
+    parser.add_argument('--processes', type=int, default=1, help='Number of socket service processes to run')
+    args = parser.parse_args()
+
+    # Set up the global log
+    dictConfig(config.LOGGING)
+
+    if args.processes > 1:
+        run_supervisor(args.processes)
+    else:
+        run_server(config.SOCKET_NODE_ID or u'{}-{}'.format(socket.gethostname(), os.getpid()))
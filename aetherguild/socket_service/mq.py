@@ -4,12 +4,20 @@ import logging
 import pika
 import ujson
 from aetherguild import config
+from aetherguild.common.utils import get_node_queue
 
 log = logging.getLogger(__name__)
 
 
 class MQConnection(object):
-    def __init__(self, io_loop, msg_handler=None):
+    """ MQ connection of a single socket service node
+
+    Every node consumes its own queue, which receives replies for the connections of this node and every broadcast.
+    The node ID is sent to the listener in the message head, so that the listener knows where to send replies.
+    """
+    def __init__(self, io_loop, node_id, msg_handler=None):
+        self.node_id = node_id
+        self.queue = get_node_queue(node_id)
         self.connection = None
         self.channel = None
         self.consumer = None
@@ -70,21 +78,34 @@ class MQConnection(object):
 
     def on_exchange_ok(self, method_frame):
         log.info(u'MQ: Exchange %s open.', config.MQ_EXCHANGE)
-        self.channel.queue_declare(self.on_queue_from_declare_ok, config.MQ_FROM_LISTENER, durable=True)
+        self.channel.exchange_declare(
+            self.on_broadcast_exchange_ok, config.MQ_BROADCAST_EXCHANGE, 'fanout', durable=True)
+
+    def on_broadcast_exchange_ok(self, method_frame):
+        log.info(u'MQ: Exchange %s open.', config.MQ_BROADCAST_EXCHANGE)
+
+        # Node queue outlives a lost connection, so that replies sent while reconnecting are not lost. Once the node
+        # is gone for good, the broker deletes the queue after SOCKET_QUEUE_EXPIRES seconds.
+        self.channel.queue_declare(self.on_queue_from_declare_ok, self.queue,
+                                   arguments={'x-expires': config.SOCKET_QUEUE_EXPIRES * 1000})
         self.channel.queue_declare(self.on_queue_to_declare_ok, config.MQ_TO_LISTENER, durable=True)
 
     # ------------------------ Queues ------------------------
 
     def on_queue_from_declare_ok(self, method_frame):
-        log.info(u'MQ: Queue %s declared.', config.MQ_FROM_LISTENER)
-        self.channel.queue_bind(self.on_queue_from_bound_ok, config.MQ_FROM_LISTENER, config.MQ_EXCHANGE)
+        log.info(u'MQ: Queue %s declared.', self.queue)
+        self.channel.queue_bind(self.on_queue_from_bound_ok, self.queue, config.MQ_EXCHANGE, self.queue)
 
     def on_queue_to_declare_ok(self, method_frame):
         log.info(u'MQ: Queue %s declared.', config.MQ_TO_LISTENER)
         self.channel.queue_bind(self.on_queue_to_bound_ok, config.MQ_TO_LISTENER, config.MQ_EXCHANGE)
 
     def on_queue_from_bound_ok(self, method_frame):
-        log.info(u'MQ: Queue %s bound to exchange %s.', config.MQ_FROM_LISTENER, config.MQ_EXCHANGE)
+        log.info(u'MQ: Queue %s bound to exchange %s.', self.queue, config.MQ_EXCHANGE)
+        self.channel.queue_bind(self.on_queue_broadcast_bound_ok, self.queue, config.MQ_BROADCAST_EXCHANGE)
+
+    def on_queue_broadcast_bound_ok(self, method_frame):
+        log.info(u'MQ: Queue %s bound to exchange %s.', self.queue, config.MQ_BROADCAST_EXCHANGE)
         self.start_consumer()
 
     def on_queue_to_bound_ok(self, method_frame):
@@ -98,11 +119,11 @@ class MQConnection(object):
             self.channel.basic_cancel(consumer_tag=self.consumer)
 
     def start_consumer(self):
-        log.info("MQ: Starting consumer for queue %s", config.MQ_FROM_LISTENER)
-        self.consumer = self.channel.basic_consume(self.on_message, config.MQ_FROM_LISTENER)
+        log.info("MQ: Starting consumer for queue %s", self.queue)
+        self.consumer = self.channel.basic_consume(self.on_message, self.queue)
 
     def on_message(self, unused_channel, basic_deliver, properties, body):
-        log.info(u"MQ: Queue %s => %s", config.MQ_FROM_LISTENER, body)
+        log.info(u"MQ: Queue %s => %s", self.queue, body)
         try:
             data = ujson.loads(body.decode('utf8'))
         except ValueError:
@@ -124,6 +145,7 @@ class MQConnection(object):
     # ------------------------ Messaging ------------------------
 
     def publish(self, data):
+        data['head']['node_id'] = self.node_id
         log.info(u"MQ: Queue %s <= %s", config.MQ_TO_LISTENER, data)
         self.channel.basic_publish(
             exchange=config.MQ_EXCHANGE,
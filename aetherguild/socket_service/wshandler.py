@@ -2,23 +2,55 @@
 
 from aetherguild import config
 import logging
+import struct
 import uuid
 import ujson
-from tornado.websocket import WebSocketHandler
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketHandler, WebSocketClosedError
 from urllib.parse import urlparse
 
 log = logging.getLogger(__name__)
 
+# What to do with broadcasts for a client whose outbound buffer is full
+POLICY_DROP = 'drop'  # Broadcasts are dropped until the client catches up
+POLICY_COALESCE = 'coalesce'  # Only the latest broadcast is kept, and sent when the client catches up
+POLICY_CLOSE = 'close'  # Connection is closed
+
+
+def build_text_frame(payload):
+    """ Builds a complete websocket text frame for an already encoded payload
+
+    Frames sent by the server are not masked, so the same frame can be written as-is to every client that has not
+    negotiated compression.
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("BB", 0x81, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", 0x81, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x81, 127, length)
+    return header + payload
+
 
 class WsHandler(WebSocketHandler):
     mq = None
     connections = {}
+    levels = {}  # User level -> {connection id: connection}
+    max_buffer_size = 1024 * 1024  # Bytes waiting to be sent to a client before slow_client_policy is applied
+    slow_client_policy = POLICY_DROP
+    dropped_messages = 0
+    closed_connections = 0
 
     def __init__(self, application, request, **kwargs):
         super(WsHandler, self).__init__(application, request, **kwargs)
         self.id = None
         self.session_key = None
         self.user_level = 0
+        self.buffered_bytes = 0
+        self._last_write = None
+        self._coalesced = None
+        self.compressed = False
 
     def check_origin(self, origin):
         if config.DEBUG:
@@ -29,18 +61,137 @@ class WsHandler(WebSocketHandler):
 
     def open(self):
         """ Handler for opened websocket connections """
+        # Tornado accepts permessage-deflate whenever the client offers it and compression options are set
+        extensions = self.request.headers.get('Sec-WebSocket-Extensions', '')
+        self.compressed = self.get_compression_options() is not None and 'permessage-deflate' in extensions
         self.id = uuid.uuid4().hex
         self.connections[self.id] = self
+        self.levels.setdefault(self.user_level, {})[self.id] = self
         log.info("Sock: Connection opened (%s)", self.id)
 
+    def set_user_level(self, level):
+        """ Sets the user level of the connection, and moves it to the correct level registry """
+        self.levels.get(self.user_level, {}).pop(self.id, None)
+        self.user_level = level
+        self.levels.setdefault(level, {})[self.id] = self
+
+    @classmethod
+    def get_connections(cls, req_level):
+        """ Returns all connections with at least the given user level """
+        out = []
+        for level, connections in cls.levels.items():
+            if level >= req_level:
+                out.extend(connections.values())
+        return out
+
     def handle_control_packet(self, message):
         route = message['route']
         if route == 'auth.authenticate' or route == 'auth.login':
             self.session_key = message['session_key']
-            self.user_level = message['level']
+            self.set_user_level(message['level'])
         elif route == 'auth.logout':
             self.session_key = None
-            self.user_level = 0
+            self.set_user_level(0)
+
+    def write_frame(self, message, frame, essential=False):
+        """ Writes a prebuilt text frame to the client
+
+        If the client is not reading fast enough and more than max_buffer_size bytes are already waiting to be sent,
+        non-essential messages are handled according to slow_client_policy. Essential messages (replies to the
+        client's own requests) are always written.
+        """
+        ws_connection = self.ws_connection
+        if not ws_connection or ws_connection.client_terminated or ws_connection.server_terminated:
+            return
+        if ws_connection.stream.closed():
+            return
+
+        if not essential and self.buffered_bytes + len(frame) > self.max_buffer_size:
+            if self.slow_client_policy == POLICY_CLOSE:
+                log.warning(u"Sock: Closing slow connection (%s), %d bytes buffered", self.id, self.buffered_bytes)
+                WsHandler.closed_connections += 1
+                self.close(1013, u"Client is not reading fast enough")
+            elif self.slow_client_policy == POLICY_COALESCE:
+                if self._coalesced:
+                    WsHandler.dropped_messages += 1
+                self._coalesced = (message, frame)
+            else:
+                WsHandler.dropped_messages += 1
+            return
+
+        self._write(message, frame)
+
+    def _write_raw_frame(self, frame):
+        """ Writes a prebuilt frame directly to the connection stream
+
+        Does what WebSocketProtocol13.write_message does for an uncompressed text frame after the frame has been
+        built, including turning a closed stream into WebSocketClosedError. Checked against Tornado 4.4.2 (the pinned
+        version) and 6.5; recheck when upgrading Tornado.
+        """
+        try:
+            return self.ws_connection.stream.write(frame)
+        except StreamClosedError:
+            raise WebSocketClosedError()
+
+    def _write(self, message, frame):
+        # Connections using compression get the encoded message through write_message, since their frames depend
+        # on the compressor state of the connection.
+        try:
+            if self.compressed:
+                future = self.write_message(message)
+            else:
+                future = self._write_raw_frame(frame)
+        except WebSocketClosedError:
+            log.info(u"Sock: Connection %s closed while writing", self.id)
+            return
+        if future is not None:
+            self.buffered_bytes += len(frame)
+            self._last_write = future
+            future.add_done_callback(lambda f: self._on_write_done(f, len(frame)))
+
+    def _on_write_done(self, future, size):
+        """ Called when a written frame has been sent """
+        if future.exception() is not None:
+            self.buffered_bytes = 0
+            self._coalesced = None
+            return
+
+        # Later writes are always sent after earlier ones, so the buffer is empty once the last write is done
+        if future is self._last_write:
+            self.buffered_bytes = 0
+        else:
+            self.buffered_bytes = max(0, self.buffered_bytes - size)
+
+        # Send the latest coalesced broadcast once the client has caught up
+        if self._coalesced and self.buffered_bytes + len(self._coalesced[1]) <= self.max_buffer_size:
+            message, frame = self._coalesced
+            self._coalesced = None
+            self.write_frame(message, frame)
+
+    @classmethod
+    def get_buffer_stats(cls):
+        """ Returns outbound buffer stats for all connections, and resets the dropped and closed counters """
+        buffered = sorted(((c.buffered_bytes, c.id) for c in cls.connections.values()), reverse=True)
+        stats = {
+            'connections': len(buffered),
+            'buffered_bytes': sum(size for size, _ in buffered),
+            'slow_connections': len([size for size, _ in buffered if size > cls.max_buffer_size / 2]),
+            'dropped_messages': cls.dropped_messages,
+            'closed_connections': cls.closed_connections,
+            'largest': [(key, size) for size, key in buffered[:5] if size > 0],
+        }
+        WsHandler.dropped_messages = 0
+        WsHandler.closed_connections = 0
+        return stats
+
+    @classmethod
+    def log_buffer_stats(cls):
+        stats = cls.get_buffer_stats()
+        log.info(u"Sock: %d connections, %d bytes buffered, %d slow, %d messages dropped, %d connections closed",
+                 stats['connections'], stats['buffered_bytes'], stats['slow_connections'],
+                 stats['dropped_messages'], stats['closed_connections'])
+        for key, size in stats['largest']:
+            log.info(u"Sock: Connection %s has %d bytes buffered", key, size)
 
     def on_message(self, message):
         """ Handler for messages coming from websocket """
@@ -54,7 +205,8 @@ class WsHandler(WebSocketHandler):
         publish_data = {
             'head': {
                 'connection_id': self.id,
-                'session_key': self.session_key
+                'session_key': self.session_key,
+                'remote_ip': self.request.remote_ip
             },
             'body': decoded_data
         }
@@ -64,6 +216,7 @@ class WsHandler(WebSocketHandler):
         """ Handler for closed websocket connections """
         log.info("Sock: Connection closed (%s)", self.id)
         del self.connections[self.id]
+        self.levels.get(self.user_level, {}).pop(self.id, None)
 
     @classmethod
     def on_queue_message(cls, message):
@@ -78,18 +231,21 @@ class WsHandler(WebSocketHandler):
 
         # Many whelps! Handle it!!1
         if broadcast:
-            for key, connection in cls.connections.items():
+            # Encode and frame the message only once, and write the same bytes to every recipient
+            if not is_control:
+                message = ujson.dumps(body, ensure_ascii=False)
+                frame = build_text_frame(message.encode('utf-8'))
+            # Only connections with sufficient privileges are looked at
+            for connection in cls.get_connections(req_level):
                 # If broadcasting but avoiding self, skip connection if required
-                if avoid_self and key == connection_id:
+                if avoid_self and connection.id == connection_id:
                     continue
-                # Make sure client has sufficient privileges
-                if connection.user_level >= req_level:
-                    # If packet is control, handle it as such.
-                    # Otherwise broadcast standard message.
-                    if is_control:
-                        connection.handle_control_packet(body)
-                    else:
-                        connection.write_message(body)
+                # If packet is control, handle it as such.
+                # Otherwise broadcast standard message.
+                if is_control:
+                    connection.handle_control_packet(body)
+                else:
+                    connection.write_frame(message, frame)
         else:
             connection = cls.connections.get(connection_id)
             if connection:
@@ -100,4 +256,5 @@ class WsHandler(WebSocketHandler):
                     if is_control:
                         connection.handle_control_packet(body)
                     else:
-                        connection.write_message(body)
+                        message = ujson.dumps(body, ensure_ascii=False)
+                        connection.write_frame(message, build_text_frame(message.encode('utf-8')), essential=True)
@@ -0,0 +1,52 @@
+"""Forum board and thread counters
+
+Revision ID: 3f1a9c2d7b10
+Revises: cdc4dab4ac01
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+
+revision = '3f1a9c2d7b10'
+down_revision = 'cdc4dab4ac01'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('forum_thread', sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('forum_thread', sa.Column('last_post', sa.Integer(), nullable=True))
+    op.add_column('forum_board', sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('forum_board', sa.Column('threads_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('forum_board', sa.Column('last_post', sa.Integer(), nullable=True))
+
+    # Fill in the counters for existing data. Threads first, since board counters are calculated from them.
+    op.execute(
+        'UPDATE forum_thread SET '
+        '  posts_count = (SELECT COUNT(*) FROM forum_post '
+        '                  WHERE forum_post.thread = forum_thread.id AND forum_post.deleted = FALSE), '
+        '  last_post = (SELECT MAX(forum_post.id) FROM forum_post '
+        '                WHERE forum_post.thread = forum_thread.id AND forum_post.deleted = FALSE)')
+    op.execute(
+        'UPDATE forum_board SET '
+        '  posts_count = (SELECT COALESCE(SUM(forum_thread.posts_count), 0) FROM forum_thread '
+        '                  WHERE forum_thread.board = forum_board.id AND forum_thread.deleted = FALSE), '
+        '  threads_count = (SELECT COUNT(*) FROM forum_thread '
+        '                    WHERE forum_thread.board = forum_board.id AND forum_thread.deleted = FALSE), '
+        '  last_post = (SELECT MAX(forum_thread.last_post) FROM forum_thread '
+        '                WHERE forum_thread.board = forum_board.id AND forum_thread.deleted = FALSE)')
+
+    op.create_foreign_key('forum_thread_last_post_fkey', 'forum_thread', 'forum_post', ['last_post'], ['id'])
+    op.create_foreign_key('forum_board_last_post_fkey', 'forum_board', 'forum_post', ['last_post'], ['id'])
+
+
+def downgrade():
+    op.drop_constraint('forum_board_last_post_fkey', 'forum_board', type_='foreignkey')
+    op.drop_constraint('forum_thread_last_post_fkey', 'forum_thread', type_='foreignkey')
+    op.drop_column('forum_board', 'last_post')
+    op.drop_column('forum_board', 'threads_count')
+    op.drop_column('forum_board', 'posts_count')
+    op.drop_column('forum_thread', 'last_post')
+    op.drop_column('forum_thread', 'posts_count')
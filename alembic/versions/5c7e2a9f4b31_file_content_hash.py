@@ -0,0 +1,26 @@
+"""Content hash for files
+
+Revision ID: 5c7e2a9f4b31
+Revises: 8e4b6d0c2a57
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+
+revision = '5c7e2a9f4b31'
+down_revision = '8e4b6d0c2a57'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Existing files have no hash, and keep working as they are (without avatar variants)
+    op.add_column('file', sa.Column('content_hash', sa.Unicode(length=64), nullable=True))
+    op.create_unique_constraint('file_content_hash_key', 'file', ['content_hash'])
+
+
+def downgrade():
+    op.drop_constraint('file_content_hash_key', 'file', type_='unique')
+    op.drop_column('file', 'content_hash')
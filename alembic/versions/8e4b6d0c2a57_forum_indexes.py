@@ -0,0 +1,40 @@
+"""Forum listing indexes
+
+Revision ID: 8e4b6d0c2a57
+Revises: 3f1a9c2d7b10
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+
+revision = '8e4b6d0c2a57'
+down_revision = '3f1a9c2d7b10'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    # Replaced by the board listing index
+    op.drop_index('ix_forum_thread_sort_index', table_name='forum_thread')
+    op.drop_index('ix_forum_thread_sticky', table_name='forum_thread')
+    op.create_index('ix_forum_thread_board_listing', 'forum_thread',
+                    ['board', 'deleted', 'sticky', 'updated_at', 'id'], unique=False)
+
+    op.create_index('ix_forum_post_thread_listing', 'forum_post', ['thread', 'deleted', 'created_at', 'id'], unique=False)
+    op.create_index(op.f('ix_forum_edit_post'), 'forum_edit', ['post'], unique=False)
+
+    # Remove possible duplicate last read rows before adding the unique constraint; keep the newest one
+    op.execute(
+        'DELETE FROM forum_last_read '
+        ' WHERE id NOT IN (SELECT MAX(id) FROM forum_last_read GROUP BY forum_last_read.user, forum_last_read.thread)')
+    op.create_unique_constraint('unique_user_thread_constraint', 'forum_last_read', ['user', 'thread'])
+
+
+def downgrade():
+    op.drop_constraint('unique_user_thread_constraint', 'forum_last_read', type_='unique')
+    op.drop_index(op.f('ix_forum_edit_post'), table_name='forum_edit')
+    op.drop_index('ix_forum_post_thread_listing', table_name='forum_post')
+    op.drop_index('ix_forum_thread_board_listing', table_name='forum_thread')
+    op.create_index(op.f('ix_forum_thread_sticky'), 'forum_thread', ['sticky'], unique=False)
+    op.create_index(op.f('ix_forum_thread_sort_index'), 'forum_thread', ['sticky', 'updated_at'], unique=False)
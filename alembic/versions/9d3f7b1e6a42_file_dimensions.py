@@ -0,0 +1,28 @@
+"""Dimensions and WebP flag for files
+
+Revision ID: 9d3f7b1e6a42
+Revises: 5c7e2a9f4b31
+Create Date: 2026-10-18 18:00:00.000000
+
+"""
+
+revision = '9d3f7b1e6a42'
+down_revision = '5c7e2a9f4b31'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Dimensions of existing files are not known, and they are not assumed to have WebP variants
+    op.add_column('file', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('file', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('file', sa.Column('webp', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+
+def downgrade():
+    op.drop_column('file', 'webp')
+    op.drop_column('file', 'height')
+    op.drop_column('file', 'width')
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Compares decoding and thumbnailing a large JPEG avatar at full size against decoding it with Image.draft().
+
+Generates a noisy 2000x2000 JPEG in memory, and reports the time per avatar for both ways of producing a 300x300
+thumbnail.
+
+Run with: python -m benchmarks.avatar_decode
+"""
+
+import io
+import os
+import time
+
+from PIL import Image
+
+ROUNDS = 20
+SIZE = (2000, 2000)
+OUTPUT_SIZE = (300, 300)
+
+
+def create_jpeg():
+    img = Image.frombytes('RGB', SIZE, os.urandom(SIZE[0] * SIZE[1] * 3))
+    out = io.BytesIO()
+    img.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def full_decode(data):
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    img.thumbnail(OUTPUT_SIZE, reducing_gap=None)
+    return img
+
+
+def draft_decode(data):
+    img = Image.open(io.BytesIO(data))
+    img.draft(None, OUTPUT_SIZE)
+    img.thumbnail(OUTPUT_SIZE)
+    return img
+
+
+def measure(func, data):
+    start = time.perf_counter()
+    for n in range(ROUNDS):
+        func(data)
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+
+if __name__ == '__main__':
+    data = create_jpeg()
+    print("JPEG size: {} bytes".format(len(data)))
+    print("Full decode:  {:.1f} ms per avatar".format(measure(full_decode, data)))
+    print("Draft decode: {:.1f} ms per avatar".format(measure(draft_decode, data)))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the old per section and per board forum index queries with the current forum.get_combined_boards.
+
+Builds the test forum (3 sections with 4 boards each) into an in-memory SQLite database, and reports the amount of
+SQL statements and the time taken for building the forum index as an admin user. Real round trip costs to
+PostgreSQL are higher, so the statement count is the more interesting number.
+
+Run with: python -m benchmarks.forum_index_queries
+"""
+
+import time
+
+from sqlalchemy import func, and_
+
+from aetherguild.listener_service.handlers.forumhandler import ForumHandler
+from aetherguild.listener_service.mq_connection import MQConnectionMock
+from aetherguild.listener_service.mq_session import MQSession
+from aetherguild.listener_service.user_session import UserSession
+from aetherguild.listener_service.tables import ForumSection, ForumBoard, ForumThread, ForumPost, User
+from tests.helper import DatabaseTestHelper
+
+ROUNDS = 200
+
+
+def old_combined_boards(db, level):
+    """ The old implementation: one query for sections, one for boards per section, and three per board """
+    sections = db.query(ForumSection).filter(and_(
+        db.query(func.count('*').label('count1')).filter(and_(
+            ForumBoard.section == ForumSection.id,
+            ForumBoard.deleted == False,
+            ForumBoard.req_level <= level
+        )).as_scalar() > 0,
+        ForumSection.deleted == False
+    )).order_by(ForumSection.sort_index.asc())
+
+    out = []
+    for section in sections:
+        out_section = section.serialize()
+        out_section['boards'] = []
+        boards = db.query(ForumBoard).filter(and_(
+            ForumBoard.req_level <= level,
+            ForumBoard.section == section.id,
+            ForumBoard.deleted == False
+        )).order_by(ForumBoard.sort_index.asc())
+        for board in boards:
+            serialized_board = board.serialize()
+            serialized_board['posts_count'] = db.query(func.count('*').label('count1')).filter(and_(
+                ForumPost.thread == ForumThread.id,
+                ForumThread.board == board.id,
+                ForumThread.deleted == False,
+                ForumPost.deleted == False
+            )).all()[0][0]
+            serialized_board['threads_count'] = db.query(func.count('*').label('count1')).filter(and_(
+                ForumThread.board == board.id,
+                ForumThread.deleted == False,
+            )).all()[0][0]
+            serialized_board['last_post'] = db.query(ForumPost, ForumThread, User).filter(and_(
+                ForumPost.thread == ForumThread.id,
+                User.id == ForumPost.user,
+                ForumThread.board == board.id,
+                ForumPost.deleted == False,
+                ForumThread.deleted == False
+            )).order_by(ForumPost.id.desc()).first()
+            out_section['boards'].append(serialized_board)
+        out.append(out_section)
+    return out
+
+
+def run(name, func):
+    statements = helper.count_queries()
+    func()
+    count = len(statements)
+
+    start = time.perf_counter()
+    for n in range(ROUNDS):
+        func()
+    elapsed = (time.perf_counter() - start) / ROUNDS
+
+    print("{}:".format(name))
+    print("  statements: {}".format(count))
+    print("  time per request: {:.3f} ms".format(elapsed * 1000))
+
+
+if __name__ == '__main__':
+    helper = DatabaseTestHelper()
+    helper.init_database()
+    helper.create_test_users()
+    helper.create_test_sessions()
+    helper.create_test_forum()
+
+    db = helper.db()
+    admin_session = UserSession(db, helper.test_sessions[2].session_key)
+    mq_session = MQSession(MQConnectionMock())
+
+    def new_combined_boards():
+        handler = ForumHandler(db, mq_session, admin_session, 'connection_id', None, 'forum.get_combined_boards')
+        handler.handle(['get_combined_boards'], {})
+        mq_session.mq_connection.message_log.clear()
+
+    run('old get_combined_boards', lambda: old_combined_boards(db, admin_session.get_level()))
+    run('new get_combined_boards', new_combined_boards)
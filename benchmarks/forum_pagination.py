@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Compares offset and cursor pagination for forum.get_threads and forum.get_posts.
+
+Builds a board with 5000 threads and a thread with 20000 posts into an in-memory SQLite database, and measures the
+time it takes to fetch a page of 20 entries at different depths, using both start/count and after/count.
+
+Run with: python -m benchmarks.forum_pagination
+"""
+
+import time
+from datetime import timedelta
+
+from aetherguild.listener_service.handlers.forumhandler import ForumHandler
+from aetherguild.listener_service.handlers.utils import encode_cursor
+from aetherguild.listener_service.mq_connection import MQConnectionMock
+from aetherguild.listener_service.mq_session import MQSession
+from aetherguild.listener_service.user_session import UserSession
+from aetherguild.listener_service.tables import ForumSection, ForumBoard, ForumThread, ForumPost, utc_now
+from tests.helper import DatabaseTestHelper
+
+THREADS = 5000
+POSTS = 20000
+PAGE_SIZE = 20
+ROUNDS = 20
+
+
+def create_data(helper):
+    s = helper.db()
+    user_id = helper.test_users[0].id
+    section = ForumSection(title=u'Section', sort_index=0)
+    s.add(section)
+    s.flush()
+    board = ForumBoard(section=section.id, title=u'Board', description=u'Board')
+    s.add(board)
+    s.flush()
+
+    base = utc_now()
+    s.execute(ForumThread.__table__.insert(), [{
+        'board': board.id,
+        'user': user_id,
+        'title': u'Thread {}'.format(n),
+        'created_at': base + timedelta(seconds=n),
+        'updated_at': base + timedelta(seconds=n),
+        'views': 0,
+        'sticky': n % 500 == 0,
+        'closed': False,
+        'deleted': False,
+        'posts_count': 0,
+    } for n in range(THREADS)])
+    thread = s.query(ForumThread).filter_by(board=board.id).first()
+    s.execute(ForumPost.__table__.insert(), [{
+        'thread': thread.id,
+        'user': user_id,
+        'message': u'Post {}'.format(n),
+        'created_at': base + timedelta(seconds=n),
+        'deleted': False,
+    } for n in range(POSTS)])
+    ForumThread.refresh_counters(s)
+    ForumBoard.refresh_counters(s)
+    s.commit()
+    return board.id, thread.id
+
+
+def run(name, db, user_session, route, data):
+    mq_session = MQSession(MQConnectionMock())
+    start = time.perf_counter()
+    for n in range(ROUNDS):
+        handler = ForumHandler(db, mq_session, user_session, 'connection_id', None, 'forum.{}'.format(route))
+        handler.handle([route], {'data': data})
+    elapsed = (time.perf_counter() - start) / ROUNDS
+    print("  {}: {:.3f} ms".format(name, elapsed * 1000))
+    return mq_session.mq_connection.message_log[-1]['body']['data']
+
+
+if __name__ == '__main__':
+    helper = DatabaseTestHelper()
+    helper.init_database()
+    helper.create_test_users()
+    helper.create_test_sessions()
+    board_id, thread_id = create_data(helper)
+
+    db = helper.db()
+    user_session = UserSession(db, helper.test_sessions[0].session_key)
+
+    # Cursors pointing just before the measured pages, in listing order
+    threads = db.query(ForumThread).filter_by(board=board_id)\
+        .order_by(ForumThread.sticky.desc(), ForumThread.updated_at.desc(), ForumThread.id.desc()).all()
+    posts = db.query(ForumPost).filter_by(thread=thread_id).order_by(ForumPost.created_at, ForumPost.id).all()
+
+    print("get_threads, {} threads:".format(THREADS))
+    for depth in (PAGE_SIZE, 1000, 2500, THREADS - PAGE_SIZE):
+        t = threads[depth - 1]
+        cursor = encode_cursor(t.sticky, t.updated_at.isoformat(), t.id)
+        a = run('start={}'.format(depth), db, user_session, 'get_threads',
+                {'board': board_id, 'start': depth, 'count': PAGE_SIZE})
+        b = run('after cursor at {}'.format(depth), db, user_session, 'get_threads',
+                {'board': board_id, 'after': cursor, 'count': PAGE_SIZE})
+        assert [t['id'] for t in a['threads']] == [t['id'] for t in b['threads']]
+
+    print("get_posts, {} posts:".format(POSTS))
+    for depth in (PAGE_SIZE, 5000, 10000, POSTS - PAGE_SIZE):
+        p = posts[depth - 1]
+        cursor = encode_cursor(p.created_at.isoformat(), p.id)
+        a = run('start={}'.format(depth), db, user_session, 'get_posts',
+                {'thread': thread_id, 'start': depth, 'count': PAGE_SIZE})
+        b = run('after cursor at {}'.format(depth), db, user_session, 'get_posts',
+                {'thread': thread_id, 'after': cursor, 'count': PAGE_SIZE})
+        assert [p['id'] for p in a['posts']] == [p['id'] for p in b['posts']]
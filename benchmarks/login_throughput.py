@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Measures password verification throughput, and how much a burst of logins slows down other work in the listener.
+
+A number of threads (like listener workers) verify passwords as fast as they can, while one more thread runs a
+small CPU bound task standing in for a forum read. This is run with passwords verified in the worker threads and
+with the password hashing process pool. Reported are logins per second and the average and worst latency of the
+forum read task during the burst.
+
+Run with: python -m benchmarks.login_throughput
+"""
+
+import os
+import threading
+import time
+
+from aetherguild.listener_service import passwords
+
+LOGINS = 64
+LOGIN_THREADS = 4
+
+
+def forum_read():
+    """ Stands in for a cheap forum read; mostly serializing rows in Python """
+    return [{'id': n, 'title': str(n) * 4} for n in range(500)]
+
+
+def run(label):
+    password_hash = passwords.hash_password(u'password1234')
+    remaining = [LOGINS]
+    lock = threading.Lock()
+    done = threading.Event()
+    latencies = []
+
+    def login_worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            passwords.verify_password(u'password1234', password_hash)
+
+    def read_worker():
+        while not done.is_set():
+            start = time.perf_counter()
+            forum_read()
+            latencies.append(time.perf_counter() - start)
+
+    reader = threading.Thread(target=read_worker)
+    reader.start()
+    workers = [threading.Thread(target=login_worker) for n in range(LOGIN_THREADS)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    reader.join()
+
+    print("{:<24} {:>8.1f} logins/s, read avg {:>7.2f} ms, read max {:>7.2f} ms".format(
+        label, LOGINS / elapsed, sum(latencies) / len(latencies) * 1000, max(latencies) * 1000))
+
+
+if __name__ == '__main__':
+    run("inline")
+    passwords.start_pool(os.cpu_count() or 1, LOGINS)
+    try:
+        run("process pool ({})".format(os.cpu_count() or 1))
+    finally:
+        passwords.stop_pool()
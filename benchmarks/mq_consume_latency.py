@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the old polling consume loop with the push based consumer.
+
+Measures delivery latency for messages arriving at random intervals, CPU time used by the consumer thread while the
+queue is idle, and how long it takes for the consumer to stop after being asked to. Requires a running RabbitMQ
+server configured in config.MQ_CONFIG.
+
+Run with: python -m benchmarks.mq_consume_latency
+"""
+
+import statistics
+import threading
+import time
+import random
+
+from pika import BlockingConnection, URLParameters
+
+from aetherguild import config
+
+MESSAGES = 200
+IDLE_SECONDS = 5.0
+
+
+class PollingConsumer(threading.Thread):
+    """ The old consume loop: channel.consume() with a 100ms inactivity timeout """
+    def __init__(self, queue_name):
+        super(PollingConsumer, self).__init__(daemon=True)
+        self.connection = BlockingConnection(URLParameters(config.MQ_CONFIG))
+        self.channel = self.connection.channel()
+        self.queue_name = queue_name
+        self.latencies = []
+        self.cpu_time = 0
+        self._run = True
+
+    def stop(self):
+        self._run = False
+
+    def run(self):
+        start_cpu = time.thread_time()
+        for packet in self.channel.consume(self.queue_name, no_ack=False, inactivity_timeout=0.1):
+            if packet:
+                method_frame, _, body = packet
+                self.latencies.append(time.perf_counter() - float(body))
+                self.channel.basic_ack(method_frame.delivery_tag)
+            if not self._run:
+                break
+        self.cpu_time = time.thread_time() - start_cpu
+        self.channel.cancel()
+        self.connection.close()
+
+
+class PushConsumer(threading.Thread):
+    """ The new consumer: basic_consume() with a blocking process_data_events() """
+    def __init__(self, queue_name):
+        super(PushConsumer, self).__init__(daemon=True)
+        self.connection = BlockingConnection(URLParameters(config.MQ_CONFIG))
+        self.channel = self.connection.channel()
+        self.queue_name = queue_name
+        self.latencies = []
+        self.cpu_time = 0
+        self._run = True
+
+    def stop(self):
+        self._run = False
+        self.connection.add_callback_threadsafe(lambda: None)
+
+    def on_message(self, channel, method_frame, properties, body):
+        self.latencies.append(time.perf_counter() - float(body))
+        self.channel.basic_ack(method_frame.delivery_tag)
+
+    def run(self):
+        start_cpu = time.thread_time()
+        tag = self.channel.basic_consume(self.on_message, self.queue_name, no_ack=False)
+        while self._run:
+            self.connection.process_data_events(time_limit=None)
+        self.cpu_time = time.thread_time() - start_cpu
+        self.channel.basic_cancel(tag)
+        self.connection.close()
+
+
+def run(consumer_class):
+    connection = BlockingConnection(URLParameters(config.MQ_CONFIG))
+    channel = connection.channel()
+    queue_name = channel.queue_declare(exclusive=False, auto_delete=True).method.queue
+
+    consumer = consumer_class(queue_name)
+    consumer.start()
+    time.sleep(0.5)
+
+    # Messages arriving at random intervals
+    for n in range(MESSAGES):
+        channel.basic_publish(exchange='', routing_key=queue_name, body=str(time.perf_counter()))
+        time.sleep(random.uniform(0, 0.02))
+
+    # Idle queue
+    time.sleep(IDLE_SECONDS)
+
+    # Shutdown
+    stop_at = time.perf_counter()
+    consumer.stop()
+    consumer.join()
+    stop_latency = time.perf_counter() - stop_at
+
+    channel.queue_delete(queue_name)
+    connection.close()
+
+    latencies = sorted(consumer.latencies)
+    print("{}:".format(consumer_class.__name__))
+    print("  delivery latency median: {:.3f} ms, p99: {:.3f} ms".format(
+        statistics.median(latencies) * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000))
+    print("  consumer CPU time: {:.3f} s".format(consumer.cpu_time))
+    print("  stop latency: {:.3f} ms".format(stop_latency * 1000))
+
+
+if __name__ == '__main__':
+    run(PollingConsumer)
+    run(PushConsumer)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Compares serializing a page of 500 posts (the data part of a forum.get_posts reply) with arrow based timestamp
+formatting against the current serializers.
+
+Builds a thread with 500 posts, every other post having an edit, into an in-memory SQLite database. The rows are
+loaded once, and only the serialization is measured.
+
+Run with: python -m benchmarks.serialization
+"""
+
+import time
+from datetime import timedelta
+
+import arrow
+
+from aetherguild.listener_service.handlers.forumhandler import ForumHandler
+from aetherguild.listener_service.mq_connection import MQConnectionMock
+from aetherguild.listener_service.mq_session import MQSession
+from aetherguild.listener_service.user_session import UserSession
+from aetherguild.listener_service.tables import ForumSection, ForumBoard, ForumThread, ForumPost, ForumPostEdit,\
+    utc_now
+from tests.helper import DatabaseTestHelper
+
+POSTS = 500
+ROUNDS = 50
+
+
+def create_data(helper):
+    s = helper.db()
+    user_id = helper.test_users[0].id
+    section = ForumSection(title=u'Section', sort_index=0)
+    s.add(section)
+    s.flush()
+    board = ForumBoard(section=section.id, title=u'Board', description=u'Board')
+    s.add(board)
+    s.flush()
+    thread = ForumThread(board=board.id, user=user_id, title=u'Thread')
+    s.add(thread)
+    s.flush()
+
+    base = utc_now()
+    for n in range(POSTS):
+        post = ForumPost(thread=thread.id, user=user_id, message=u'Post {}'.format(n),
+                         created_at=base + timedelta(seconds=n))
+        s.add(post)
+        s.flush()
+        if n % 2:
+            s.add(ForumPostEdit(post=post.id, user=user_id, message=u'Edit', created_at=base))
+    s.commit()
+    return thread.id
+
+
+def old_serialize(posts, edits, users):
+    """ The old implementation: arrow for every timestamp, and the edits added to the post dict afterwards """
+    post_list = []
+    for post in posts:
+        data = {
+            'id': post.id,
+            'thread': post.thread,
+            'user': post.user,
+            'message': post.message,
+            'created_at': arrow.get(post.created_at).isoformat()
+        }
+        data['edits'] = [{
+            'id': edit.id,
+            'post': edit.post,
+            'user': edit.user,
+            'message': edit.message,
+            'created_at': arrow.get(edit.created_at).isoformat()
+        } for edit in edits.get(post.id, [])]
+        post_list.append(data)
+    user_list = {}
+    for user in users:
+        user_list[user.id] = {
+            'id': user.id,
+            'nickname': user.nickname,
+            'level': user.level,
+            'created_at': arrow.get(user.created_at).isoformat(),
+            'last_contact': arrow.get(user.last_contact).isoformat()
+        }
+    return post_list, user_list
+
+
+def new_serialize(posts, edits, users):
+    """ Same output through the model serializers, without the database queries of ForumHandler._serialize_posts """
+    post_list = [post.serialize(edits=[edit.serialize() for edit in edits.get(post.id, [])]) for post in posts]
+    user_list = {user.id: user.serialize() for user in users}
+    return post_list, user_list
+
+
+def measure(func, *args):
+    start = time.perf_counter()
+    for n in range(ROUNDS):
+        func(*args)
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+
+if __name__ == '__main__':
+    helper = DatabaseTestHelper()
+    helper.init_database()
+    helper.create_test_users()
+    helper.create_test_sessions()
+    thread_id = create_data(helper)
+
+    db = helper.db()
+    posts = db.query(ForumPost).filter_by(thread=thread_id).order_by(ForumPost.id).all()
+    edits = {}
+    for edit in db.query(ForumPostEdit).order_by(ForumPostEdit.id):
+        edits.setdefault(edit.post, []).append(edit)
+    users = helper.test_users
+
+    old = old_serialize(posts, edits, users)
+    new = new_serialize(posts, edits, users)
+    assert old[0] == new[0]
+
+    print("Serializing {} posts:".format(POSTS))
+    print("  arrow:           {:.2f} ms".format(measure(old_serialize, posts, edits, users)))
+    print("  format_datetime: {:.2f} ms".format(measure(new_serialize, posts, edits, users)))
+
+    # The whole page with queries, for scale
+    handler = ForumHandler(db, MQSession(MQConnectionMock()), UserSession(db, helper.test_sessions[0].session_key),
+                           'connection_id', None, 'forum.get_posts')
+    print("  _serialize_posts with queries: {:.2f} ms".format(measure(handler._serialize_posts, posts)))
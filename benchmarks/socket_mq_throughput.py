@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Compares socket service MQ consume throughput between the pika Tornado adapter and the aio-pika asyncio transport.
+
+For every transport, starts a socket service node connection in a separate process, publishes a batch of messages to
+the node queue from a separate thread, and measures how fast the node consumes and acknowledges them. Requires a
+running RabbitMQ server configured in config.MQ_CONFIG, and aio-pika (and optionally uvloop) installed.
+
+Run with: python -m benchmarks.socket_mq_throughput
+"""
+
+import multiprocessing
+import threading
+import time
+
+import ujson
+from pika import BlockingConnection, URLParameters
+
+from aetherguild import config
+from aetherguild.common.utils import get_node_queue
+
+MESSAGES = 20000
+
+
+def publish_messages(queue_name):
+    connection = BlockingConnection(URLParameters(config.MQ_CONFIG))
+    channel = connection.channel()
+    body = ujson.dumps({
+        'head': {'connection_id': 'abc', 'avoid_self': False, 'broadcast': False, 'is_control': False,
+                 'req_level': 0},
+        'body': {'route': 'forum.get_post', 'error': False, 'data': {'message': u'Lorem ipsum dolor sit amet' * 10}},
+    })
+    for n in range(MESSAGES):
+        channel.basic_publish(exchange=config.MQ_EXCHANGE, routing_key=queue_name, body=body)
+    connection.close()
+
+
+def consume(transport, use_uvloop, results):
+    if transport == 'asyncio':
+        from aetherguild.socket_service.aio_mq import AioMQConnection, install_event_loop
+        install_event_loop(use_uvloop=use_uvloop)
+
+    from tornado.ioloop import IOLoop
+    loop = IOLoop.instance()
+    node_id = 'benchmark-{}'.format(transport)
+    if transport == 'asyncio':
+        mq = AioMQConnection(node_id=node_id)
+    else:
+        from aetherguild.socket_service.mq import MQConnection
+        mq = MQConnection(io_loop=loop, node_id=node_id)
+
+    times = []
+
+    def on_message(data):
+        times.append(time.perf_counter())
+        if len(times) == MESSAGES:
+            mq.close()
+
+    def wait_for_consumer():
+        if mq.consumer:
+            threading.Thread(target=publish_messages, args=(get_node_queue(node_id),), daemon=True).start()
+        else:
+            loop.call_later(0.1, wait_for_consumer)
+
+    mq.set_msg_handler(on_message)
+    mq.connect()
+    loop.call_later(0.1, wait_for_consumer)
+    start_cpu = time.process_time()
+    loop.start()
+    results.put((times[-1] - times[0], time.process_time() - start_cpu))
+
+
+def run(name, transport, use_uvloop=False):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=consume, args=(transport, use_uvloop, results))
+    process.start()
+    elapsed, cpu_time = results.get()
+    process.join()
+    print("{}: {:.0f} messages/s, {:.1f} us CPU per message".format(
+        name, MESSAGES / elapsed, cpu_time / MESSAGES * 1000000))
+
+
+if __name__ == '__main__':
+    run('pika TornadoConnection', 'tornado')
+    run('aio-pika on asyncio', 'asyncio')
+    try:
+        import uvloop
+        run('aio-pika on uvloop', 'asyncio', use_uvloop=True)
+    except ImportError:
+        print("uvloop is not installed, skipping")
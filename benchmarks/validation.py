@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the cost of validating request data with a new cerberus Validator per message against a cached validator.
+
+Validates a generated, valid document against every request schema of the listener service.
+
+Run with: python -m benchmarks.validation
+"""
+
+import time
+
+from cerberus import Validator
+
+from aetherguild.listener_service.handlers.basehandler import ValidatorCache
+from aetherguild.listener_service.schemas import base, auth, forum, admin, news
+
+ROUNDS = 2000
+SAMPLE_VALUES = {
+    'integer': 1,
+    'string': u'abcdefgh',
+    'boolean': True,
+    'dict': {},
+    'list': [],
+}
+
+
+def create_document(schema):
+    """ Creates a document with a value for every field of the schema """
+    document = {}
+    for field, rules in schema.items():
+        if 'excludes' in rules:
+            continue
+        field_type = rules.get('type', 'string')
+        if isinstance(field_type, list):
+            field_type = field_type[0]
+        if 'allowed' in rules:
+            document[field] = rules['allowed'][0]
+        elif field_type == 'dict' and 'schema' in rules:
+            document[field] = create_document(rules['schema'])
+        else:
+            document[field] = SAMPLE_VALUES.get(field_type, u'abcdefgh')
+    return document
+
+
+def measure(func):
+    start = time.perf_counter()
+    for n in range(ROUNDS):
+        func()
+    return (time.perf_counter() - start) / ROUNDS * 1000000
+
+
+if __name__ == '__main__':
+    print("{:<40} {:>12} {:>12}".format("schema", "new (us)", "cached (us)"))
+    for module in (base, auth, forum, admin, news):
+        for name, schema in sorted(vars(module).items()):
+            if not name.endswith('_request') or not isinstance(schema, dict):
+                continue
+            document = create_document(schema)
+            validators = ValidatorCache(schema)
+            new = measure(lambda: Validator(schema).validate(document))
+            cached = measure(lambda: validators.get().validate(document))
+            print("{:<40} {:>12.1f} {:>12.1f}".format('{}.{}'.format(module.__name__.split('.')[-1], name), new, cached))
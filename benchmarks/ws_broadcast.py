@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the old per connection broadcast loop with the current WsHandler.on_queue_message broadcast.
+
+Sets up 10000 websocket handlers with in-memory streams, a third of them on each user level, and measures the time it
+takes to broadcast a typical forum post notification to everyone, and to admins only. No network traffic is involved, so this only measures encoding and framing costs.
+
+Run with: python -m benchmarks.ws_broadcast
+"""
+
+import time
+
+from tornado.web import Application
+from tornado.httputil import HTTPServerRequest
+from tornado.websocket import WebSocketProtocol13
+
+from aetherguild.socket_service.wshandler import WsHandler
+
+CONNECTIONS = 10000
+ROUNDS = 20
+
+
+class NullStream(object):
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def closed(self):
+        return False
+
+
+class FakeRequest(object):
+    pass
+
+
+class FakeHTTPConnection(object):
+    def set_close_callback(self, callback):
+        pass
+
+
+class FakeHandler(object):
+    def __init__(self):
+        self.stream = NullStream()
+        self.request = FakeRequest()
+
+
+def create_connections():
+    WsHandler.connections = {}
+    WsHandler.levels = {}
+    application = Application()
+    for n in range(CONNECTIONS):
+        handler = WsHandler(application, HTTPServerRequest(method='GET', uri='/ws', connection=FakeHTTPConnection()))
+        handler.ws_connection = WebSocketProtocol13(FakeHandler(), compression_options=None)
+        handler.open()
+        handler.set_user_level(n % 3)
+
+
+def old_broadcast(message):
+    """ The old broadcast loop: write_message() encodes and frames the body separately for every connection """
+    body = message['body']
+    for key, connection in WsHandler.connections.items():
+        if connection.user_level >= message['head']['req_level']:
+            connection.write_message(body)
+
+
+def run(name, func, message):
+    start = time.perf_counter()
+    for n in range(ROUNDS):
+        func(message)
+    elapsed = (time.perf_counter() - start) / ROUNDS
+    written = sum(c.ws_connection.stream.bytes_written for c in WsHandler.connections.values())
+    print("{}: {:.3f} ms per broadcast, {} bytes written".format(name, elapsed * 1000, written))
+
+
+if __name__ == '__main__':
+    message = {
+        'head': {
+            'connection_id': None,
+            'avoid_self': False,
+            'broadcast': True,
+            'is_control': False,
+            'req_level': 0,
+        },
+        'body': {
+            'route': 'forum.insert_post',
+            'error': False,
+            'data': {
+                'thread': {'id': 1, 'board': 1, 'user': 1, 'title': u'Thread title', 'views': 100,
+                           'created_at': '2017-01-01T00:00:00+00:00', 'sticky': False, 'closed': False},
+                'post': {'id': 1, 'thread': 1, 'user': 1, 'created_at': '2017-01-01T00:00:00+00:00',
+                         'message': u'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 10},
+                'user': {'id': 1, 'nickname': u'Nickname', 'level': 1, 'avatar': None,
+                         'created_at': '2017-01-01T00:00:00+00:00', 'last_contact': '2017-01-01T00:00:00+00:00'},
+            }
+        }
+    }
+
+    for req_level in (0, 2):
+        message['head']['req_level'] = req_level
+        print("{} connections, req_level {}:".format(CONNECTIONS, req_level))
+        create_connections()
+        run('  old broadcast', old_broadcast, message)
+        create_connections()
+        run('  new broadcast', WsHandler.on_queue_message, message)
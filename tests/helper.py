@@ -4,7 +4,7 @@ import loremipsum
 import random
 from sqlalchemy.orm import sessionmaker
 from passlib.hash import pbkdf2_sha512
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from aetherguild.listener_service.tables import Base, ForumSection, ForumBoard, ForumThread, ForumPost,\
     ForumPostEdit, User, Session
 
@@ -18,9 +18,19 @@ class DatabaseTestHelper(object):
 
     def init_database(self):
         self.engine = create_engine('sqlite:///:memory:')
-        self.db = sessionmaker(bind=self.engine, autoflush=True)
+        self.db = sessionmaker(bind=self.engine, autoflush=True, expire_on_commit=False)
         Base.metadata.create_all(self.engine)
 
+    def count_queries(self):
+        """ Returns a list that collects every SQL statement executed by the engine from now on """
+        statements = []
+
+        def on_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute', on_execute)
+        return statements
+
     def close_database(self):
         Base.metadata.drop_all(self.engine)
         self.engine.dispose()
@@ -92,4 +102,8 @@ class DatabaseTestHelper(object):
                             edit.user = post.user
                             edit.message = u'Edit for post {}'.format(post_num)
                             s.add(edit)
+
+        # Counters are normally maintained by the forum handler
+        ForumThread.refresh_counters(s)
+        ForumBoard.refresh_counters(s)
         s.commit()
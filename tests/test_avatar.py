@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import helper
+from PIL import Image
+
+from aetherguild import config
+from aetherguild.listener_service.avatar import AvatarRouter
+from aetherguild.listener_service.handlers.authhandler import AuthHandler
+from aetherguild.listener_service.mq_connection import MQConnectionMock, get_routing
+from aetherguild.listener_service.mq_session import MQSession
+from aetherguild.listener_service.tables import User, File
+from aetherguild.listener_service.user_session import UserSession
+
+
+class FakeResponse(object):
+    def __init__(self, content, headers=None):
+        self.content = content
+        self.headers = headers or {}
+        self.read_size = 0
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            self.read_size = start + chunk_size
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeDBConnection(object):
+    def __init__(self, db):
+        self.db = db
+
+    def get_session(self):
+        return self.db()
+
+
+def create_png(width, height):
+    out = io.BytesIO()
+    Image.new('RGB', (width, height)).save(out, 'PNG')
+    return out.getvalue()
+
+
+class TestAvatar(unittest.TestCase, helper.DatabaseTestHelper):
+    def setUp(self):
+        self.init_database()
+        self.create_test_users()
+        self.create_test_sessions()
+        self.upload_dir = tempfile.TemporaryDirectory()
+        self.mq_connection = MQConnectionMock()
+        self.router = AvatarRouter(FakeDBConnection(self.db), self.mq_connection)
+        self.head = {'connection_id': 'abc', 'node_id': 'node-1', 'receipt': 'r1', 'route': 'auth.update_avatar'}
+
+    def process(self, response):
+        body = {'user': self.test_users[1].id, 'url': 'http://localhost/avatar.png'}
+        with mock.patch.object(config, 'UPLOAD_LOCAL_PATH', self.upload_dir.name),\
+                mock.patch('requests.get', return_value=response):
+            self.router.handle(self.head, body)
+        return self.mq_connection.message_log[-1]
+
+    def test_update_avatar_queues_job(self):
+        s = self.db()
+        mq_session = MQSession(self.mq_connection, node_id='node-1')
+        user_session = UserSession(s, self.test_sessions[1].session_key)
+        h = AuthHandler(s, mq_session, user_session, 'abc', 'r1', 'auth.update_avatar')
+        with mock.patch.object(config, 'AVATAR_WORKER_ENABLED', True):
+            h.handle(['update_avatar'], {'data': {'url': 'http://localhost/avatar.png'}})
+        s.close()
+
+        message = self.mq_connection.message_log[0]
+        self.assertEqual(get_routing(message['head']), (config.MQ_EXCHANGE, config.MQ_TO_AVATAR))
+        self.assertEqual(message['body'], {'user': self.test_users[1].id, 'url': 'http://localhost/avatar.png'})
+        self.assertEqual(message['head']['receipt'], 'r1')
+
+    def test_router_saves_avatar(self):
+        message = self.process(FakeResponse(create_png(400, 200)))
+        self.assertEqual(message['head']['node_id'], 'node-1')
+        self.assertEqual(message['body']['receipt'], 'r1')
+        self.assertEqual(message['body']['route'], 'auth.update_avatar')
+        self.assertFalse(message['body']['error'])
+
+        s = self.db()
+        user = User.get_one(s, id=self.test_users[1].id)
+        s.close()
+        self.assertTrue(user.avatar)
+        with Image.open(os.path.join(self.upload_dir.name, user.avatar)) as img:
+            self.assertEqual(img.size, (300, 150))
+
+    def test_variants_and_dedupe(self):
+        content = create_png(400, 200)
+        self.process(FakeResponse(content))
+        s = self.db()
+        user = User.get_one(s, id=self.test_users[1].id)
+        variants = user.serialize()['avatar_variants']
+        self.assertEqual([v['size'] for v in variants], [32, 64, 128, 300])
+        self.assertEqual(variants[-1]['url'], File.format_public_path(user.avatar))
+        for size, name in [(32, '_32.png'), (64, '_64.png'), (128, '_128.png'), (300, '.png')]:
+            path = os.path.join(self.upload_dir.name, user.avatar.replace('.png', name))
+            with Image.open(path) as img:
+                self.assertEqual(img.width, size)
+            self.assertTrue(os.path.exists(path.replace('.png', '.webp')))
+
+        # Same image for another user is stored only once
+        self.process(FakeResponse(content))
+        body = {'user': self.test_users[2].id, 'url': 'http://localhost/avatar.png'}
+        with mock.patch.object(config, 'UPLOAD_LOCAL_PATH', self.upload_dir.name),\
+                mock.patch('requests.get', return_value=FakeResponse(content)):
+            self.router.handle(self.head, body)
+        other = User.get_one(s, id=self.test_users[2].id)
+        self.assertEqual(other.avatar, user.avatar)
+        self.assertEqual(s.query(File).count(), 1)
+        s.close()
+
+    def test_concurrent_dedupe(self):
+        content = create_png(400, 200)
+        self.process(FakeResponse(content))
+
+        # Another job stores the same image at the same time, and doesn't see the file entry before inserting its own
+        body = {'user': self.test_users[2].id, 'url': 'http://localhost/avatar.png'}
+        with mock.patch.object(config, 'UPLOAD_LOCAL_PATH', self.upload_dir.name),\
+                mock.patch('requests.get', return_value=FakeResponse(content)),\
+                mock.patch.object(File, 'get_one_or_none', return_value=None):
+            self.router.handle(self.head, body)
+        message = self.mq_connection.message_log[-1]
+        self.assertFalse(message['body']['error'])
+
+        s = self.db()
+        user = User.get_one(s, id=self.test_users[1].id)
+        other = User.get_one(s, id=self.test_users[2].id)
+        self.assertEqual(other.avatar, user.avatar)
+        self.assertEqual(s.query(File).count(), 1)
+        s.close()
+        self.assertFalse([f for f in os.listdir(self.upload_dir.name) if f.startswith('.tmp-')])
+
+    def test_router_user_not_found(self):
+        body = {'user': 12345, 'url': 'http://localhost/avatar.png'}
+        with mock.patch('requests.get') as get:
+            self.router.handle(self.head, body)
+        self.assertFalse(get.called)
+        message = self.mq_connection.message_log[-1]
+        self.assertEqual(message['body']['receipt'], 'r1')
+        self.assertEqual(message['body']['data']['error_code'], 404)
+
+    def test_small_avatar_variants(self):
+        with mock.patch.object(config, 'AVATAR_WEBP', False):
+            self.process(FakeResponse(create_png(50, 20)))
+        s = self.db()
+        variants = User.get_one(s, id=self.test_users[1].id).serialize()['avatar_variants']
+        s.close()
+        self.assertEqual([v['size'] for v in variants], [32, 50, 50, 50])
+        self.assertFalse([v for v in variants if 'webp_url' in v])
+
+    def test_legacy_avatar_has_no_variants(self):
+        legacy = File(u'png')
+        legacy.key = u"b'0123456789abcdef'.png"
+        self.assertIsNone(legacy.get_variants())
+
+        # Content addressed files stored before dimensions were recorded
+        variants = File(u'png', content_hash=u'0123456789abcdef' * 4).get_variants()
+        self.assertEqual([v['size'] for v in variants], [None, None, None, None])
+        self.assertFalse([v for v in variants if 'webp_url' in v])
+
+    def test_router_invalid_image(self):
+        message = self.process(FakeResponse(b'not an image'))
+        self.assertTrue(message['body']['error'])
+        self.assertEqual(message['body']['data']['error_code'], 450)
+
+    def test_router_rejects_early(self):
+        # Oversize dimensions are noticed from the header, long before the whole file has been read
+        response = FakeResponse(create_png(4000, 4000) + b'\0' * 1024 * 1024)
+        message = self.process(response)
+        self.assertEqual(message['body']['data']['error_messages'][0]['message'],
+                         u"Image is too large; Maximum size is 2048x2048")
+        self.assertLessEqual(response.read_size, 64 * 1024)
+
+        # Unsupported formats are refused from the first chunk
+        out = io.BytesIO()
+        Image.new('RGB', (10, 10)).save(out, 'BMP')
+        response = FakeResponse(out.getvalue() + b'\0' * 1024 * 1024)
+        message = self.process(response)
+        self.assertTrue(message['body']['error'])
+        self.assertLessEqual(response.read_size, 8 * 1024)
+
+    def test_jpeg_large_metadata(self):
+        # Header is behind 120 KB of ICC profile, well past the streaming check window
+        out = io.BytesIO()
+        Image.new('RGB', (400, 300)).save(out, 'JPEG', icc_profile=b'\0' * 120 * 1024)
+        message = self.process(FakeResponse(out.getvalue()))
+        self.assertFalse(message['body']['error'])
+
+    def test_router_rejects_content_length(self):
+        response = FakeResponse(create_png(10, 10), headers={'content-length': str(10 * 1024 * 1024)})
+        message = self.process(response)
+        self.assertTrue(message['body']['error'])
+        self.assertEqual(response.read_size, 0)
+
+    def test_jpeg_draft(self):
+        out = io.BytesIO()
+        Image.new('RGB', (2000, 1000)).save(out, 'JPEG')
+        message = self.process(FakeResponse(out.getvalue()))
+        self.assertFalse(message['body']['error'])
+        s = self.db()
+        user = User.get_one(s, id=self.test_users[1].id)
+        s.close()
+        with Image.open(os.path.join(self.upload_dir.name, user.avatar)) as img:
+            self.assertEqual(img.size, (300, 150))
+
+    def tearDown(self):
+        self.upload_dir.cleanup()
+        self.close_database()
@@ -5,7 +5,9 @@ import helper
 from aetherguild.listener_service.handlers.forumhandler import ForumHandler
 from aetherguild.listener_service.mq_connection import MQConnectionMock
 from aetherguild.listener_service.mq_session import MQSession
-from aetherguild.listener_service.user_session import UserSession
+from aetherguild.listener_service.user_session import UserSession, SessionCache
+from aetherguild.listener_service.handlers.utils import encode_cursor
+from aetherguild.listener_service.tables import ForumBoard, ForumThread, ForumPost, ForumPostEdit, User
 
 
 class TestForum(unittest.TestCase, helper.DatabaseTestHelper):
@@ -31,5 +33,159 @@ class TestForum(unittest.TestCase, helper.DatabaseTestHelper):
         h.handle(['get_sections'], {})
         self.assertEqual(len(self.mq_connection.message_log), 1)
 
+    def test_get_combined_boards(self):
+        statements = self.count_queries()
+        h = self.create_handler('forum.get_combined_boards', self.user_session_user)
+        h.handle(['get_combined_boards'], {})
+        self.assertEqual(len(statements), 2)
+
+        # User can only see sections with boards up to level 1
+        sections = self.mq_connection.message_log[0]['body']['data']['sections']
+        self.assertEqual([section['title'] for section in sections], [u'Section 0', u'Section 1'])
+        for section in sections:
+            self.assertEqual(len(section['boards']), 4)
+            for board in section['boards']:
+                self.assertEqual(board['posts_count'], 154)
+                self.assertEqual(board['threads_count'], 11)
+                self.assertEqual(board['last_post']['id'], ForumBoard.get_one(self.db_session, id=board['id']).last_post)
+                self.assertIn('thread_title', board['last_post'])
+                self.assertIn('user_nickname', board['last_post'])
+
+    def test_get_posts(self):
+        thread = self.db_session.query(ForumThread).first()
+        statements = self.count_queries()
+        h = self.create_handler('forum.get_posts', self.user_session_user)
+        h.handle(['get_posts'], {'data': {'thread': thread.id}})
+
+        # Thread, board, posts, edits and users
+        self.assertEqual(len(statements), 5)
+
+        data = self.mq_connection.message_log[0]['body']['data']
+        self.assertEqual(len(data['posts']), 14)
+        for post in data['posts']:
+            self.assertIn(post['user'], data['users'])
+            edits = ForumPostEdit.get_many(self.db_session, post=post['id'])
+            self.assertEqual(sorted(edit['id'] for edit in post['edits']), sorted(edit.id for edit in edits))
+            for edit in post['edits']:
+                self.assertIn(edit['user'], data['users'])
+
+    def get_data(self, route, user_session, data):
+        self.mq_connection.message_log = []
+        h = self.create_handler('forum.{}'.format(route), user_session)
+        h.handle([route], {'data': data})
+        return self.mq_connection.message_log[0]['body']['data']
+
+    def test_get_threads_cursor(self):
+        board = self.db_session.query(ForumBoard).first()
+        all_ids = [t['id'] for t in self.get_data('get_threads', self.user_session_user,
+                                                   {'board': board.id, 'count': 100})['threads']]
+        self.assertEqual(len(all_ids), 11)
+
+        # Walk forwards through the pages, and then back again
+        data = self.get_data('get_threads', self.user_session_user, {'board': board.id, 'count': 4})
+        pages = [[t['id'] for t in data['threads']]]
+        while True:
+            data = self.get_data('get_threads', self.user_session_user,
+                                 {'board': board.id, 'count': 4, 'after': data['cursors']['after']})
+            if not data['threads']:
+                self.assertIsNone(data['cursors'])
+                break
+            pages.append([t['id'] for t in data['threads']])
+        self.assertEqual(sum(pages, []), all_ids)
+        self.assertEqual([len(page) for page in pages], [4, 4, 3])
+
+        data = self.get_data('get_threads', self.user_session_user, {
+            'board': board.id, 'count': 4, 'before': encode_cursor(False, '1970-01-01T00:00:00+00:00', 0)})
+        self.assertEqual([t['id'] for t in data['threads']], all_ids[-4:])
+        data = self.get_data('get_threads', self.user_session_user,
+                             {'board': board.id, 'count': 4, 'before': data['cursors']['before']})
+        self.assertEqual([t['id'] for t in data['threads']], all_ids[3:7])
+
+    def test_get_posts_cursor(self):
+        thread = self.db_session.query(ForumThread).first()
+        all_ids = [p['id'] for p in self.get_data('get_posts', self.user_session_user, {'thread': thread.id})['posts']]
+
+        data = self.get_data('get_posts', self.user_session_user, {'thread': thread.id, 'count': 5})
+        ids = [p['id'] for p in data['posts']]
+        while data['cursors']:
+            data = self.get_data('get_posts', self.user_session_user,
+                                 {'thread': thread.id, 'count': 5, 'after': data['cursors']['after']})
+            ids.extend(p['id'] for p in data['posts'])
+        self.assertEqual(ids, all_ids)
+
+        data = self.get_data('get_posts', self.user_session_user, {'thread': thread.id, 'start': 10, 'count': 5})
+        data = self.get_data('get_posts', self.user_session_user,
+                             {'thread': thread.id, 'count': 5, 'before': data['cursors']['before']})
+        self.assertEqual([p['id'] for p in data['posts']], all_ids[5:10])
+
+    def test_invalid_cursor(self):
+        thread = self.db_session.query(ForumThread).first()
+        for cursor in ('garbage', encode_cursor(1, 2, 3)):
+            data = self.get_data('get_posts', self.user_session_user, {'thread': thread.id, 'after': cursor})
+            self.assertEqual(data['error_code'], 400)
+        data = self.get_data('get_posts', self.user_session_user, {'thread': thread.id, 'after': 'x', 'start': 1})
+        self.assertEqual(data['error_code'], 400)
+
+    def test_counters(self):
+        thread = self.db_session.query(ForumThread).first()
+        board = ForumBoard.get_one(self.db_session, id=thread.board)
+        self.assertEqual(thread.posts_count, 14)
+        self.assertEqual(board.threads_count, 11)
+        self.assertEqual(board.posts_count, 154)
+
+        # New thread adds to board counters and becomes the last post
+        h = self.create_handler('forum.insert_thread', self.user_session_admin)
+        h.handle(['insert_thread'], {'data': {
+            'board': board.id, 'title': u'Counter test', 'message': u'Test', 'sticky': False, 'closed': False}})
+        self.db_session.commit()
+        self.db_session.expire_all()
+        new_thread = ForumThread.get_one(self.db_session, title=u'Counter test')
+        self.assertEqual(new_thread.posts_count, 1)
+        self.assertEqual(board.threads_count, 12)
+        self.assertEqual(board.posts_count, 155)
+        self.assertEqual(board.last_post, new_thread.last_post)
+
+        # Deleting the last post of a thread moves last_post back
+        last_post = thread.last_post
+        h = self.create_handler('forum.delete_post', self.user_session_admin)
+        h.handle(['delete_post'], {'data': {'post': last_post}})
+        self.db_session.commit()
+        self.db_session.expire_all()
+        self.assertEqual(thread.posts_count, 13)
+        self.assertLess(thread.last_post, last_post)
+        self.assertEqual(board.posts_count, 154)
+
+        # Deleting a thread removes its posts from the board
+        h = self.create_handler('forum.delete_thread', self.user_session_admin)
+        h.handle(['delete_thread'], {'data': {'thread': new_thread.id}})
+        self.db_session.commit()
+        self.db_session.expire_all()
+        self.assertEqual(board.threads_count, 11)
+        self.assertEqual(board.posts_count, 153)
+        self.assertNotEqual(board.last_post, new_thread.last_post)
+
+    def test_update_thread_views_skips_user_lookup(self):
+        thread = self.db_session.query(ForumThread).first()
+        user_session = UserSession(self.db_session, self.test_sessions[1].session_key)
+        user_session._user = None
+        statements = self.count_queries()
+        h = self.create_handler('forum.update_thread_views', user_session)
+        h.handle(['update_thread_views'], {'data': {'thread': thread.id}})
+        self.db_session.flush()
+        self.assertFalse([s for s in statements if 'FROM new_user' in s])
+
+    def test_update_post_of_deleted_user(self):
+        cache = SessionCache()
+        session_key = self.test_sessions[1].session_key
+        UserSession(self.db_session, session_key, cache=cache)
+        User.get_one(self.db_session, id=self.test_users[1].id).deleted = True
+        self.db_session.commit()
+
+        # Session is still in the cache, but the user is gone
+        post = ForumPost.get_one(self.db_session, id=self.db_session.query(ForumPost.id).first()[0])
+        data = self.get_data('update_post', UserSession(self.db_session, session_key, cache=cache), {
+            'post': post.id, 'message': u'Test'})
+        self.assertEqual(data['error_code'], 403)
+
     def tearDown(self):
         self.close_database()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import helper
+from aetherguild.listener_service.handlers.forumhandler import ForumHandler
+from aetherguild.listener_service.mq_connection import MQConnectionMock
+from aetherguild.listener_service.mq_session import MQSession
+from aetherguild.listener_service.user_session import UserSession
+from aetherguild.listener_service.tables import ForumThread
+
+
+class TestIndexes(unittest.TestCase, helper.DatabaseTestHelper):
+    """ Checks that the forum queries use the indexes declared for them, by reading SQLite query plans """
+    def setUp(self):
+        self.init_database()
+        self.create_test_users()
+        self.create_test_sessions()
+        self.create_test_forum()
+        self.db_session = self.db()
+        self.mq_connection = MQConnectionMock()
+        self.mq_session = MQSession(self.mq_connection)
+
+    def get_plan(self, statements, table):
+        """ Returns the query plan for the first captured statement that selects from the given table. The plan
+        does not depend on the parameter values, so NULLs are bound for all of them.
+        """
+        statement = [s for s in statements if 'FROM {}'.format(table) in s][0]
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, [None] * statement.count('?'))
+            return u'\n'.join(row[3] for row in cursor.fetchall())
+        finally:
+            connection.close()
+
+    def handle(self, route, data):
+        user_session = UserSession(self.db_session, self.test_sessions[1].session_key)
+        h = ForumHandler(self.db_session, self.mq_session, user_session, 'connection_id', None, 'forum.' + route)
+        h.handle([route], {'data': data})
+        return self.mq_connection.message_log[-1]['body']['data']
+
+    def test_session_lookup(self):
+        queries = self.count_queries()
+        UserSession(self.db_session, self.test_sessions[1].session_key)
+        self.assertIn('SEARCH session USING INDEX', self.get_plan(queries, 'session'))
+
+    def test_get_threads(self):
+        thread = self.db_session.query(ForumThread).first()
+        queries = self.count_queries()
+        data = self.handle('get_threads', {'board': thread.board})
+        plan = self.get_plan(queries, 'forum_thread, new_user')
+        self.assertIn('ix_forum_thread_board_listing', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        self.assertIn('SEARCH forum_last_read USING INDEX', plan)
+
+        # Cursor pages use the same index
+        queries = self.count_queries()
+        self.handle('get_threads', {'board': thread.board, 'after': data['cursors']['after']})
+        plan = self.get_plan(queries, 'forum_thread, new_user')
+        self.assertIn('ix_forum_thread_board_listing', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_get_posts(self):
+        thread = self.db_session.query(ForumThread).first()
+        queries = self.count_queries()
+        data = self.handle('get_posts', {'thread': thread.id, 'count': 5})
+        plan = self.get_plan(queries, 'forum_post')
+        self.assertIn('ix_forum_post_thread_listing', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+        self.assertIn('ix_forum_edit_post', self.get_plan(queries, 'forum_edit'))
+
+        queries = self.count_queries()
+        self.handle('get_posts', {'thread': thread.id, 'count': 5, 'after': data['cursors']['after']})
+        self.assertIn('ix_forum_post_thread_listing', self.get_plan(queries, 'forum_post'))
+
+    def tearDown(self):
+        self.db_session.close()
+        self.close_database()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest import mock
+from aetherguild import config
+from aetherguild.common.utils import get_node_queue
+from aetherguild.listener_service.mq_connection import MQConnection, MQConnectionMock, get_routing
+from aetherguild.listener_service.mq_session import MQSession
+
+
+class TestMQRouting(unittest.TestCase):
+    def setUp(self):
+        self.mq_connection = MQConnectionMock()
+        self.mq_session = MQSession(self.mq_connection, node_id='node-1')
+        self.mq_session.begin()
+
+    def test_reply_goes_to_node(self):
+        self.mq_session.publish({'data': 1}, connection_id='abc')
+        self.mq_session.commit()
+        head = self.mq_connection.message_log[0]['head']
+        self.assertEqual(head['node_id'], 'node-1')
+        self.assertEqual(get_routing(head), (config.MQ_EXCHANGE, get_node_queue('node-1')))
+
+    def test_broadcast_goes_to_all_nodes(self):
+        self.mq_session.publish({'data': 1}, connection_id='abc', broadcast=True)
+        self.mq_session.commit()
+        head = self.mq_connection.message_log[0]['head']
+        self.assertEqual(get_routing(head), (config.MQ_BROADCAST_EXCHANGE, ''))
+
+    def test_no_node(self):
+        mq_session = MQSession(self.mq_connection)
+        mq_session.publish({'data': 1}, connection_id='abc')
+        head = self.mq_connection.message_log[0]['head']
+        self.assertIsNone(get_routing(head))
+
+    def test_no_node_is_not_published(self):
+        connection = MQConnection()
+        connection.publish_channel = mock.Mock()
+        connection.publish_many([
+            {'head': {'connection_id': 'abc'}, 'body': {}},
+            {'head': {'connection_id': 'abc', 'node_id': 'node-1'}, 'body': {}},
+        ])
+        self.assertEqual(connection.publish_channel.basic_publish.call_count, 1)
+        self.assertEqual(
+            connection.publish_channel.basic_publish.call_args[1]['routing_key'], get_node_queue('node-1'))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest import mock
+from aetherguild.listener_service import passwords
+from aetherguild.listener_service.passwords import LoginRateLimiter, PasswordQueueFull
+
+
+class TestLoginRateLimiter(unittest.TestCase):
+    def test_username_limit(self):
+        limiter = LoginRateLimiter(ip_limit=0, username_limit=2, window=60)
+        self.assertTrue(limiter.allow('127.0.0.1', 'user'))
+        limiter.add_failure('127.0.0.1', 'user')
+        self.assertTrue(limiter.allow('127.0.0.1', 'user'))
+        limiter.add_failure('127.0.0.1', 'user')
+        self.assertFalse(limiter.allow('127.0.0.1', 'user'))
+        self.assertTrue(limiter.allow('127.0.0.1', 'other'))
+        limiter.reset('127.0.0.1', 'user')
+        self.assertTrue(limiter.allow('127.0.0.1', 'user'))
+
+    def test_username_flood_from_other_ip(self):
+        limiter = LoginRateLimiter(ip_limit=20, username_limit=5, window=60)
+
+        # Somebody guessing the password of a user from one address doesn't lock the user out
+        for n in range(10):
+            limiter.allow('10.0.0.1', 'admin')
+            limiter.add_failure('10.0.0.1', 'admin')
+        self.assertFalse(limiter.allow('10.0.0.1', 'admin'))
+        self.assertTrue(limiter.allow('127.0.0.1', 'admin'))
+
+    def test_ip_limit(self):
+        limiter = LoginRateLimiter(ip_limit=2, username_limit=0, window=60)
+
+        # Successful logins don't count against the IP
+        for n in range(5):
+            self.assertTrue(limiter.allow('127.0.0.1', 'a'))
+
+        limiter.add_failure('127.0.0.1', 'a')
+        self.assertTrue(limiter.allow('127.0.0.1', 'b'))
+        limiter.add_failure('127.0.0.1', 'b')
+        self.assertFalse(limiter.allow('127.0.0.1', 'c'))
+        self.assertTrue(limiter.allow('127.0.0.2', 'c'))
+
+    def test_window(self):
+        limiter = LoginRateLimiter(ip_limit=1, username_limit=1, window=60)
+        with mock.patch('time.monotonic', return_value=1000.0):
+            self.assertTrue(limiter.allow('127.0.0.1', 'user'))
+            limiter.add_failure('127.0.0.1', 'user')
+            self.assertFalse(limiter.allow('127.0.0.1', 'user'))
+            self.assertFalse(limiter.allow('127.0.0.1', 'other'))
+        with mock.patch('time.monotonic', return_value=1061.0):
+            self.assertTrue(limiter.allow('127.0.0.1', 'user'))
+
+
+class TestPasswordPool(unittest.TestCase):
+    def tearDown(self):
+        passwords.stop_pool()
+
+    def test_hash_in_pool(self):
+        passwords.start_pool(1, 2)
+        password_hash = passwords.hash_password(u'password')
+        self.assertTrue(passwords.verify_password(u'password', password_hash))
+        self.assertFalse(passwords.verify_password(u'wrong', password_hash))
+
+    def test_queue_full(self):
+        passwords.start_pool(1, 1)
+        passwords._slots.acquire()
+        self.assertRaises(PasswordQueueFull, passwords.hash_password, u'password')
+        passwords._slots.release()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from aetherguild.listener_service.router import build_route_table
+from aetherguild.listener_service.handlers.forumhandler import ForumHandler
+from aetherguild.listener_service.user_session import LEVEL_GUEST, LEVEL_ADMIN
+from aetherguild.listener_service.schemas.forum import get_threads_request
+
+
+class TestRouteTable(unittest.TestCase):
+    def setUp(self):
+        self.routes = build_route_table()
+
+    def test_full_routes(self):
+        route = self.routes['forum.get_threads']
+        self.assertIs(route.handler, ForumHandler)
+        self.assertIs(route.method, ForumHandler.get_threads)
+        self.assertIs(route.schema, get_threads_request)
+        self.assertNotIn('forum', self.routes)
+        self.assertNotIn('get_threads', self.routes)
+
+    def test_levels(self):
+        self.assertEqual(self.routes['forum.get_threads'].level, LEVEL_GUEST)
+        self.assertFalse(self.routes['forum.get_threads'].authenticated)
+        self.assertEqual(self.routes['forum.delete_post'].level, LEVEL_ADMIN)
+        self.assertTrue(self.routes['forum.delete_post'].authenticated)
+        self.assertEqual(self.routes['admin.get_users'].level, LEVEL_ADMIN)
+
+        # Logged in users may still have the guest level, so is_authenticated only requires a login
+        self.assertEqual(self.routes['forum.insert_post'].level, LEVEL_GUEST)
+        self.assertTrue(self.routes['forum.insert_post'].authenticated)
+        self.assertEqual(self.routes['auth.update_profile'].level, LEVEL_GUEST)
+        self.assertTrue(self.routes['auth.update_profile'].authenticated)
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import ujson
+from unittest import mock
+import helper
+from aetherguild import config
+from aetherguild.listener_service.user_session import UserSession, SessionCache, LEVEL_GUEST
+from aetherguild.listener_service.activity import ActivityTracker
+from aetherguild.listener_service.consumer import Consumer
+from aetherguild.listener_service.mq_connection import MQConnectionMock, get_routing
+from aetherguild.listener_service.router import MessageRouter
+from aetherguild.listener_service.tables import Session, User
+
+
+class TestDBConnection(object):
+    def __init__(self, db):
+        self.db = db
+
+    def get_session(self):
+        return self.db()
+
+
+class TestUserSession(unittest.TestCase, helper.DatabaseTestHelper):
+    def setUp(self):
+        self.init_database()
+        self.create_test_users()
+        self.create_test_sessions()
+        self.db_session = self.db()
+        self.cache = SessionCache()
+        self.session_key = self.test_sessions[1].session_key
+
+    def test_cached_session_skips_lookups(self):
+        UserSession(self.db_session, self.session_key, cache=self.cache)
+        statements = self.count_queries()
+        user_session = UserSession(self.db_session, self.session_key, cache=self.cache)
+        self.assertTrue(user_session.is_valid())
+        self.assertEqual(user_session.get_level(), self.test_users[1].level)
+        self.assertEqual(len(statements), 0)
+
+        # User object is still available, but only loaded when needed
+        self.assertEqual(user_session.user.id, self.test_users[1].id)
+        self.assertEqual(len(statements), 1)
+
+    def test_cached_session_of_deleted_user(self):
+        UserSession(self.db_session, self.session_key, cache=self.cache)
+        User.get_one(self.db_session, id=self.test_users[1].id).deleted = True
+        self.db_session.commit()
+
+        # Cached entry still looks valid until the user is loaded
+        user_session = UserSession(self.db_session, self.session_key, cache=self.cache)
+        self.assertTrue(user_session.is_valid())
+        self.assertIsNone(user_session.user)
+        self.assertFalse(user_session.is_valid())
+        self.assertEqual(user_session.get_level(), LEVEL_GUEST)
+        self.assertIsNone(self.cache.get(self.session_key))
+
+    def test_invalidate(self):
+        user_session = UserSession(self.db_session, self.session_key, cache=self.cache)
+        user_session.invalidate()
+
+        # Cache is only updated once the deletion has been committed
+        self.assertIsNotNone(self.cache.get(self.session_key))
+        self.db_session.commit()
+        user_session.apply_invalidations()
+        self.assertIsNone(self.cache.get(self.session_key))
+        user_session = UserSession(self.db_session, self.session_key, cache=self.cache)
+        self.assertFalse(user_session.is_valid())
+        self.assertEqual(user_session.get_level(), LEVEL_GUEST)
+
+    def test_invalidate_user(self):
+        user_session = UserSession(self.db_session, self.session_key, cache=self.cache)
+        user_session.invalidate_user(self.test_users[1].id)
+        self.db_session.commit()
+        user_session.apply_invalidations()
+        self.assertIsNone(self.cache.get(self.session_key))
+
+    def logout(self, router):
+        router.handle(
+            {'connection_id': 'abc', 'node_id': 'node-1', 'session_key': self.session_key},
+            {'route': 'auth.logout', 'receipt': 'r1', 'data': {}})
+
+    def test_logout_during_concurrent_lookup(self):
+        router = MessageRouter(TestDBConnection(self.db), MQConnectionMock())
+        lookup_db = self.db()
+        get_session = Session.get_one_or_none
+
+        # Another worker looks the session up, and reads it just before the logout is committed
+        def lookup(db, **kwargs):
+            session = get_session(db, **kwargs)
+            if db is lookup_db:
+                self.logout(router)
+            return session
+
+        with mock.patch.object(Session, 'get_one_or_none', side_effect=lookup):
+            user_session = UserSession(lookup_db, self.session_key, cache=router.session_cache)
+        lookup_db.close()
+
+        # Lookup was valid when it started, but must not be cached after the logout
+        self.assertTrue(user_session.is_valid())
+        self.assertIsNone(router.session_cache.get(self.session_key))
+        self.assertFalse(UserSession(self.db_session, self.session_key, cache=router.session_cache).is_valid())
+
+    def test_logout_invalidates_other_processes(self):
+        mq_connection = MQConnectionMock()
+        router = MessageRouter(TestDBConnection(self.db), mq_connection)
+        self.logout(router)
+        message = [m for m in mq_connection.message_log if m['head'].get('invalidate_sessions')][0]
+        self.assertEqual(get_routing(message['head']), (config.MQ_SESSION_EXCHANGE, ''))
+        self.assertEqual(message['body'], {'session_keys': [self.session_key], 'user_ids': []})
+
+        # Another listener process drops the session from its cache when it gets the message
+        consumer = Consumer(TestDBConnection(self.db), MQConnectionMock())
+        consumer.router.session_cache.set(self.session_key, 1, self.test_users[1].id, 1)
+        consumer._on_session_message(None, None, None, ujson.dumps(message).encode('utf8'))
+        self.assertIsNone(consumer.router.session_cache.get(self.session_key))
+
+    def test_authenticate_uses_activity_tracker(self):
+        activity = ActivityTracker(TestDBConnection(self.db))
+        router = MessageRouter(TestDBConnection(self.db), MQConnectionMock(), activity=activity)
+        statements = self.count_queries()
+        router.handle({'connection_id': 'abc', 'node_id': 'node-1'}, {
+            'route': 'auth.authenticate', 'receipt': 'r1', 'data': {'session_key': self.session_key}})
+        self.assertFalse([s for s in statements if s.startswith('UPDATE')])
+
+    def test_expiry_and_size(self):
+        cache = SessionCache(max_size=2, ttl=-1)
+        cache.set('a', 1, 1, 1)
+        self.assertIsNone(cache.get('a'))
+        cache = SessionCache(max_size=2)
+        cache.set('a', 1, 1, 1)
+        cache.set('b', 2, 2, 1)
+        cache.set('c', 3, 3, 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c').user_id, 3)
+
+    def test_activity_is_written_on_flush(self):
+        activity = ActivityTracker(TestDBConnection(self.db))
+        old_session = Session.get_one(self.db_session, session_key=self.session_key)
+        old_activity_at = old_session.activity_at
+        old_last_contact = User.get_one(self.db_session, id=self.test_users[1].id).last_contact
+        user_session = UserSession(self.db_session, self.session_key, cache=self.cache, activity=activity)
+        statements = self.count_queries()
+        user_session.close()
+        self.assertEqual(len(statements), 0)
+
+        activity.flush()
+        self.assertEqual(len([s for s in statements if s.startswith('UPDATE')]), 2)
+        s = self.db()
+        self.assertGreater(Session.get_one(s, id=old_session.id).activity_at, old_activity_at)
+        self.assertGreater(User.get_one(s, id=self.test_users[1].id).last_contact, old_last_contact)
+        s.close()
+
+    def tearDown(self):
+        self.db_session.close()
+        self.close_database()
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime, timezone, timedelta
+
+import arrow
+from aetherguild.common.utils import format_datetime
+
+
+class TestFormatDatetime(unittest.TestCase):
+    def test_matches_arrow(self):
+        for value in (datetime(2017, 1, 2, 3, 4, 5),
+                      datetime(2017, 1, 2, 3, 4, 5, 123456),
+                      datetime(2017, 1, 2, 3, 4, 5, 123456, tzinfo=timezone.utc),
+                      datetime(2017, 1, 2, 3, 4, 5, tzinfo=timezone(timedelta(hours=2)))):
+            self.assertEqual(format_datetime(value), arrow.get(value).isoformat())
+
+    def test_none(self):
+        self.assertIsNone(format_datetime(None))
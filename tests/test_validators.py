@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import threading
+from aetherguild.listener_service.handlers.basehandler import ValidatorCache
+from aetherguild.listener_service.schemas.forum import get_threads_request
+
+
+class TestValidatorCache(unittest.TestCase):
+    def test_reuse_per_thread(self):
+        validators = ValidatorCache(get_threads_request)
+        self.assertIs(validators.get(), validators.get())
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(validators.get()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], validators.get())
+
+    def test_errors_are_not_kept(self):
+        v = ValidatorCache(get_threads_request).get()
+        self.assertFalse(v.validate({'board': 'abc'}))
+        self.assertIn('board', v.errors)
+        self.assertTrue(v.validate({'board': 1}))
+        self.assertEqual(v.errors, {})
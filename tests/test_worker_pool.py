@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import threading
+from aetherguild.listener_service.worker_pool import WorkerPool
+from aetherguild.listener_service.mq_connection import MQConnectionMock
+
+
+class RecordingRouter(object):
+    def __init__(self, mq_connection):
+        self.mq_connection = mq_connection
+        self.handled = {}
+        self.lock = threading.Lock()
+
+    def handle(self, head, body):
+        if body.get('fail'):
+            raise Exception("Handler failure")
+        with self.lock:
+            self.handled.setdefault(head['connection_id'], []).append(body['seq'])
+        self.mq_connection.publish({'seq': body['seq']})
+
+
+class RecordingMQConnection(MQConnectionMock):
+    def __init__(self):
+        super(RecordingMQConnection, self).__init__()
+        self.acks = []
+        self.nacks = []
+
+    def ack(self, tag):
+        self.acks.append(tag)
+
+    def nack(self, tag):
+        self.nacks.append(tag)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = WorkerPool(None, 4)
+        self.pool.router = RecordingRouter(self.pool.router.mq_connection)
+        self.mq_connection = RecordingMQConnection()
+        self.pool.start()
+
+    def test_per_connection_order(self):
+        tag = 0
+        for seq in range(0, 50):
+            for connection_id in ('a', 'b', 'c', 'd', 'e'):
+                tag += 1
+                self.pool.submit(tag, {'connection_id': connection_id}, {'seq': seq})
+        self.pool.stop()
+        self.pool.flush(self.mq_connection)
+
+        for connection_id in ('a', 'b', 'c', 'd', 'e'):
+            self.assertEqual(self.pool.router.handled[connection_id], list(range(0, 50)))
+        self.assertEqual(sorted(self.mq_connection.acks), list(range(1, tag + 1)))
+        self.assertEqual(len(self.mq_connection.message_log), tag)
+
+    def test_failure_nacks(self):
+        self.pool.submit(1, {'connection_id': 'a'}, {'seq': 0, 'fail': True})
+        self.pool.submit(2, {'connection_id': 'a'}, {'seq': 1})
+        self.pool.stop()
+        self.pool.flush(self.mq_connection)
+        self.assertEqual(self.mq_connection.nacks, [1])
+        self.assertEqual(self.mq_connection.acks, [2])
+
+    def test_stale_generation_is_dropped(self):
+        self.pool.submit(1, {'connection_id': 'a'}, {'seq': 0})
+        self.pool.stop()
+        self.pool.new_generation()
+        self.pool.flush(self.mq_connection)
+        self.assertEqual(self.mq_connection.acks, [])
+        self.assertEqual(len(self.mq_connection.message_log), 1)
+
+    def test_shard_key_fallback(self):
+        pool = WorkerPool(None, 4, shard_key='session_key')
+        head = {'connection_id': 'a', 'session_key': None}
+        self.assertEqual(pool.get_shard(head), pool.get_shard({'connection_id': 'a'}))
+        self.assertEqual(pool.get_shard({'connection_id': 'b', 'session_key': 'x'}),
+                         pool.get_shard({'connection_id': 'c', 'session_key': 'x'}))
+
+    def test_stats(self):
+        for tag in range(0, 10):
+            self.pool.submit(tag, {'connection_id': 'a'}, {'seq': tag})
+        stats = self.pool.get_stats()
+        self.assertEqual(len(stats), 4)
+        self.assertEqual(sum(stat['submitted'] for stat in stats), 10)
+
+    def tearDown(self):
+        self.pool.stop()
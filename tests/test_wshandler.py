@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from unittest import mock
+from tornado.iostream import StreamClosedError
+from tornado.web import Application
+from tornado.httputil import HTTPServerRequest, HTTPHeaders
+from aetherguild.socket_service.wshandler import WsHandler, POLICY_DROP, POLICY_COALESCE, POLICY_CLOSE
+
+
+class FakeFuture(object):
+    def __init__(self):
+        self.callbacks = []
+
+    def add_done_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def exception(self):
+        return None
+
+    def resolve(self):
+        for callback in self.callbacks:
+            callback(self)
+
+
+class StalledStream(object):
+    """ Stream of a client that has stopped reading; nothing gets sent until flush() is called """
+    def __init__(self):
+        self.pending = []
+        self.sent = []
+
+    def write(self, data):
+        future = FakeFuture()
+        self.pending.append((future, data))
+        return future
+
+    def closed(self):
+        return False
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for future, data in pending:
+            self.sent.append(data)
+            future.resolve()
+
+
+class ClosedStream(StalledStream):
+    """ Stream that is closed by the time anything is written to it """
+    def write(self, data):
+        raise StreamClosedError()
+
+
+class FakeProtocol(object):
+    def __init__(self):
+        self.stream = StalledStream()
+        self.client_terminated = False
+        self.server_terminated = False
+        self.close_code = None
+        self.messages = []
+
+    def is_closing(self):
+        return False
+
+    def write_message(self, message, binary=False):
+        future = FakeFuture()
+        self.messages.append(message)
+        return future
+
+    def close(self, code=None, reason=None):
+        self.close_code = code
+        self.server_terminated = True
+
+
+class FakeHTTPConnection(object):
+    def set_close_callback(self, callback):
+        pass
+
+
+class TestWsHandler(unittest.TestCase):
+    def setUp(self):
+        WsHandler.connections = {}
+        WsHandler.levels = {}
+        WsHandler.max_buffer_size = 1000
+        WsHandler.slow_client_policy = POLICY_DROP
+        WsHandler.get_buffer_stats()
+
+    def create_connection(self, level=0, headers=None):
+        request = HTTPServerRequest(method='GET', uri='/ws', connection=FakeHTTPConnection(), headers=headers)
+        connection = WsHandler(Application(), request)
+        connection.ws_connection = FakeProtocol()
+        connection.open()
+        connection.set_user_level(level)
+        return connection
+
+    def broadcast(self, data, req_level=0):
+        WsHandler.on_queue_message({
+            'head': {'connection_id': None, 'avoid_self': False, 'broadcast': True, 'is_control': False,
+                     'req_level': req_level},
+            'body': {'data': data}
+        })
+
+    def reply(self, connection, data):
+        WsHandler.on_queue_message({
+            'head': {'connection_id': connection.id, 'avoid_self': False, 'broadcast': False, 'is_control': False,
+                     'req_level': 0},
+            'body': {'data': data}
+        })
+
+    def test_drop(self):
+        connection = self.create_connection()
+        stream = connection.ws_connection.stream
+        for n in range(0, 20):
+            self.broadcast('x' * 200)
+        self.assertLessEqual(connection.buffered_bytes, 1000)
+        self.assertEqual(len(stream.pending), 4)
+
+        # Replies are always written, and show up in the stats
+        self.reply(connection, 'y' * 200)
+        self.assertEqual(len(stream.pending), 5)
+        stats = WsHandler.get_buffer_stats()
+        self.assertEqual(stats['dropped_messages'], 16)
+        self.assertEqual(stats['buffered_bytes'], connection.buffered_bytes)
+        self.assertEqual(stats['slow_connections'], 1)
+
+        # Once the client catches up, broadcasts go through again
+        stream.flush()
+        self.assertEqual(connection.buffered_bytes, 0)
+        self.broadcast('z')
+        self.assertEqual(len(stream.pending), 1)
+
+    def test_coalesce(self):
+        WsHandler.slow_client_policy = POLICY_COALESCE
+        connection = self.create_connection()
+        stream = connection.ws_connection.stream
+        for n in range(0, 10):
+            self.broadcast('{:03d}'.format(n) * 50)
+        self.assertEqual(len(stream.pending), 6)
+
+        # Only the latest of the coalesced broadcasts is sent after the buffer drains
+        stream.flush()
+        self.assertEqual(len(stream.pending), 1)
+        self.assertIn(b'009009', stream.pending[0][1])
+        self.assertEqual(WsHandler.get_buffer_stats()['dropped_messages'], 3)
+
+    def test_close(self):
+        WsHandler.slow_client_policy = POLICY_CLOSE
+        connection = self.create_connection()
+        protocol = connection.ws_connection
+        for n in range(0, 10):
+            self.broadcast('x' * 200)
+        self.assertEqual(protocol.close_code, 1013)
+        self.assertEqual(len(protocol.stream.pending), 4)
+        self.assertEqual(WsHandler.get_buffer_stats()['closed_connections'], 1)
+
+    def test_compressed_connection(self):
+        with mock.patch.object(WsHandler, 'get_compression_options', return_value={}):
+            headers = HTTPHeaders({'Sec-WebSocket-Extensions': 'permessage-deflate'})
+            connection = self.create_connection(headers=headers)
+            uncompressed = self.create_connection()
+        self.broadcast('x')
+
+        # Compressed connections get the message through write_message, others get the prebuilt frame
+        self.assertEqual(len(connection.ws_connection.messages), 1)
+        self.assertEqual(len(connection.ws_connection.stream.pending), 0)
+        self.assertEqual(len(uncompressed.ws_connection.messages), 0)
+        self.assertEqual(len(uncompressed.ws_connection.stream.pending), 1)
+
+    def test_closed_stream(self):
+        connection = self.create_connection()
+        other = self.create_connection()
+        connection.ws_connection.stream = ClosedStream()
+        self.broadcast('x')
+        self.assertEqual(connection.buffered_bytes, 0)
+        self.assertEqual(len(other.ws_connection.stream.pending), 1)
+
+    def test_level_registries(self):
+        guest = self.create_connection(0)
+        admin = self.create_connection(2)
+        self.broadcast('admins only', req_level=2)
+        self.assertEqual(len(guest.ws_connection.stream.pending), 0)
+        self.assertEqual(len(admin.ws_connection.stream.pending), 1)
+
+        admin.handle_control_packet({'route': 'auth.logout'})
+        self.assertEqual(WsHandler.get_connections(2), [])
+        self.assertEqual(len(WsHandler.get_connections(0)), 2)
+
+        admin.on_close()
+        self.assertEqual(WsHandler.get_connections(0), [guest])